@@ -0,0 +1,387 @@
+# Benchmark FlattenGit end to end against synthetic repositories, without TeamCity or the company git servers.
+#
+# Each run generates a source history of a given shape with 'git fast-import' into a local bare repo that stands in for
+# 'origin', and uses another local bare repo as the 'teamcity' remote. The teamcity branch is bootstrapped from the base
+# commit, then FlattenGit flattens the generated history, and the wall time, number of git invocations and time per
+# revision are reported. Results are appended to a JSON-lines file so that runs can be compared.
+#
+# The same --seed always generates the same commits, so results from different runs (or engines) are comparable.
+#
+# Parameters:
+#	--shape=<shape>					linear, merges, duplicates (the same change on a feature branch and mainline), conflicts (delete/modify), or large (linear with a large tree)
+#	--commits=<count>				The number of commits to generate on top of the base commit
+#	--files=<count>					The number of files in the base tree
+#	--engine=<engine> ...			The FlattenGit engines to benchmark
+#	--results=<file>				The JSON-lines file that results are appended to
+#	--compare						Compare each result with the last saved result with the same settings
+#	--no-batch						Start git for every read-only query, instead of using the batch backend as FlattenGit does by default (see GitBatch.py)
+#	--startup=<count>				Instead, time the startup of FlattenGit and of PackageManager.ensurePackage over this many fresh processes
+#	--filesystem=<count>			Instead, time the hard reset, soft reset and status of a resolve over a tree of --files files, this many times
+#									with each performance profile (see GitPerformance.py), and with --sparse-exclude and --worktree-dir if given
+
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import subprocess
+import GitFunctions
+import GetBranch
+import FlattenGit
+from FlattenEngines import Engines
+from GitPerformance import PerformanceProfile
+
+Shapes = ['linear', 'merges', 'duplicates', 'conflicts', 'large']
+Authors = [("Alice Smith", "alice@company.com"), ("Bob Jones", "bob@company.com"), ("Carol White", "carol@company.com")]
+
+class HistoryWriter(object):
+	# Builds a 'git fast-import' stream, tracking the content of every file on each branch so that merges can be written out
+	def __init__(self, seed, startTime=1500000000):
+		self.random = random.Random(seed)
+		self.stream = []
+		self.mark = 0
+		self.time = startTime
+		self.edits = 0
+
+	def Commit(self, ref, message, changes, parents, author=None):
+		# changes is a dict of path -> content (None to delete). parents are marks or commit hashes; the first is 'from'.
+		self.mark += 1
+		self.time += 60
+		(name, email) = author if author is not None else self.random.choice(Authors)
+		out = ["commit {0}\n".format(ref), "mark :{0}\n".format(self.mark)]
+		out.append("author {0} <{1}> {2} +0000\n".format(name, email, self.time))
+		out.append("committer {0} <{1}> {2} +0000\n".format(name, email, self.time))
+		out.append("data {0}\n{1}\n".format(len(message), message))
+		for (i, parent) in enumerate(parents):
+			out.append("{0} {1}\n".format("from" if i == 0 else "merge", ":{0}".format(parent) if isinstance(parent, int) else parent))
+		for path in sorted(changes):
+			content = changes[path]
+			if content is None:
+				out.append("D {0}\n".format(path))
+			else:
+				out.append("M 100644 inline {0}\ndata {1}\n{2}\n".format(path, len(content), content))
+		out.append("\n")
+		self.stream.append(''.join(out))
+		return self.mark
+
+	def Edit(self, files, path):
+		# Returns a new version of path with one line changed
+		self.edits += 1
+		lines = files[path].split('\n')
+		lines[self.random.randrange(len(lines) - 1)] = "edit {0}".format(self.edits)
+		return '\n'.join(lines)
+
+	def Write(self, repo):
+		process = subprocess.Popen([GitFunctions.GitExecutable, "fast-import", "--quiet"], stdin=subprocess.PIPE, cwd=repo)
+		process.communicate(''.join(self.stream))
+		if process.returncode != 0:
+			raise Exception("fast-import failed in {0}".format(repo))
+		self.stream = []
+
+def FileContent(path, lines=10):
+	return ''.join("{0} line {1}\n".format(path, i) for i in range(lines))
+
+def GenerateBase(writer, files):
+	# The base tree, spread over directories of 100 files, as the first commit of develop
+	tree = {}
+	for i in range(files):
+		path = "dir{0}/file{1}.txt".format(i / 100, i)
+		tree[path] = FileContent(path)
+	writer.Commit("refs/heads/develop", "Base commit", tree, [])
+	return tree
+
+def GenerateHistory(writer, shape, commits, tree, base):
+	# Generate at least 'commits' commits of the given shape on top of base, updating tree to match develop
+	paths = sorted(tree.keys())
+	mainline = base
+	made = 0
+	if shape in ('linear', 'large'):
+		while made < commits:
+			path = writer.random.choice(paths)
+			tree[path] = writer.Edit(tree, path)
+			mainline = writer.Commit("refs/heads/develop", "Linear change {0}".format(made), {path: tree[path]}, [mainline])
+			made += 1
+		return mainline
+	branchNumber = 0
+	while made < commits:
+		branchNumber += 1
+		feature = dict(tree)
+		featureHead = mainline
+		touched = set()
+		# A few commits on a feature branch, with a commit on mainline in the meantime
+		for i in range(3):
+			path = writer.random.choice(paths)
+			feature[path] = writer.Edit(feature, path)
+			touched.add(path)
+			featureHead = writer.Commit("refs/heads/feature{0}".format(branchNumber), "Feature {0} change {1}".format(branchNumber, i), {path: feature[path]}, [featureHead])
+			made += 1
+			if shape == 'duplicates' and i == 0:
+				# The same change made again on mainline (e.g. cherry-picked), which is already present when the feature branch's commit is replayed
+				tree[path] = feature[path]
+				mainline = writer.Commit("refs/heads/develop", "Feature {0} change {1} (cherry-picked)".format(branchNumber, i), {path: tree[path]}, [mainline])
+				made += 1
+		mainlineChanges = {}
+		if shape == 'conflicts':
+			# Delete a file on mainline that the feature branch modified; the merge resolves it by deleting
+			path = sorted(touched)[0]
+			tree[path] = None
+			mainlineChanges[path] = None
+		else:
+			path = writer.random.choice([p for p in paths if p not in touched])
+			tree[path] = writer.Edit(tree, path)
+			mainlineChanges[path] = tree[path]
+		mainline = writer.Commit("refs/heads/develop", "Mainline change {0}".format(branchNumber), mainlineChanges, [mainline])
+		made += 1
+		# Merge the feature branch
+		mergeChanges = {}
+		for path in touched:
+			if tree.get(path, '') is None:
+				continue
+			tree[path] = feature[path]
+			mergeChanges[path] = feature[path]
+		mainline = writer.Commit("refs/heads/develop", "Merge branch 'feature{0}' into develop".format(branchNumber), mergeChanges, [mainline, featureHead])
+		made += 1
+		for path in [p for p in tree if tree[p] is None]:
+			del tree[path]
+			paths.remove(path)
+	return mainline
+
+def Git(args, cwd):
+	return subprocess.check_output([GitFunctions.GitExecutable] + args, cwd=cwd).strip()
+
+def RunBenchmark(shape, commits, files, engine, seed, options, batch=True, keep=False):
+	# batch is whether to use the batch backend (see GitBatch.py)
+	root = tempfile.mkdtemp(prefix="flatten-bench-")
+	origin = os.path.join(root, "origin.git")
+	teamcity = os.path.join(root, "teamcity.git")
+	work = os.path.join(root, "work")
+	cwd = os.getcwd()
+	stdout = sys.stdout
+	# Keep FlattenGit's 'git config --global' away from the real global config
+	os.environ['GIT_CONFIG_GLOBAL'] = os.path.join(root, "gitconfig")
+	os.environ['GIT_CONFIG_NOSYSTEM'] = "1"
+	open(os.environ['GIT_CONFIG_GLOBAL'], 'w').close()
+	try:
+		for repo in [origin, teamcity]:
+			subprocess.check_call([GitFunctions.GitExecutable, "init", "--quiet", "--bare", repo])
+		writer = HistoryWriter(seed)
+		tree = GenerateBase(writer, files)
+		writer.Write(origin)
+		base = Git(["rev-parse", "refs/heads/develop"], origin)
+
+		# Point FlattenGit at the local remotes, with a branchSpec that maps develop to itself
+		GitFunctions.OriginUrl = origin
+		GitFunctions.TeamCityUrl = teamcity
+		GetBranch.BranchSpec = "+:refs/heads/(develop)"
+
+		sys.stdout = open(os.path.join(root, "flatten.log"), 'w')
+		# Bootstrap the teamcity branch at the base commit
+		FlattenGit.FlattenGit(base, "develop", work, engine=engine)
+		os.chdir(cwd)
+
+		GenerateHistory(writer, shape, commits, tree, base)
+		writer.Write(origin)
+		head = Git(["rev-parse", "refs/heads/develop"], origin)
+		revisions = int(Git(["rev-list", "--count", "{0}..{1}".format(base, head)], origin))
+
+		GitFunctions.GitInvocationCount = 0
+		GitFunctions.BatchInvocationCount = 0
+		GitFunctions.UseBatchBackend = batch
+		start = time.time()
+		try:
+			FlattenGit.FlattenGit(head, "develop", work, engine=engine, **options)
+		finally:
+			GitFunctions.UseBatchBackend = False
+		wallTime = time.time() - start
+		os.chdir(cwd)
+		sys.stdout.close()
+		sys.stdout = stdout
+
+		# Check that the flattened branch ended up with the same content as the source branch
+		flattenedTree = Git(["rev-parse", "refs/heads/teamcity/develop^{tree}"], teamcity)
+		sourceTree = Git(["rev-parse", head + "^{tree}"], origin)
+		return {
+			'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+			'gitVersion': ".".join(str(part) for part in GitFunctions.GetGitVersion()),
+			'shape': shape, 'commits': commits, 'files': files, 'seed': seed, 'engine': engine, 'options': options, 'batch': batch,
+			'revisions': revisions,
+			'wallTime': round(wallTime, 3),
+			'gitInvocations': GitFunctions.GitInvocationCount,
+			'batchInvocations': GitFunctions.BatchInvocationCount,
+			'timePerRevision': round(wallTime / revisions, 4) if revisions > 0 else None,
+			'flattenedCommits': int(Git(["rev-list", "--count", "refs/heads/teamcity/develop"], teamcity)) - 1,
+			'treesMatch': flattenedTree == sourceTree,
+		}
+	finally:
+		if sys.stdout is not stdout:
+			sys.stdout.close()
+			sys.stdout = stdout
+		os.chdir(cwd)
+		if keep:
+			print "Kept benchmark repos in {0}".format(root)
+		else:
+			shutil.rmtree(root, ignore_errors=True)
+
+# Each of these is run in a fresh python process, and prints how long the interesting part took
+StartupSteps = [
+	("import FlattenGit", "import FlattenGit"),
+	# What ensurePackage used to do for an installed package: import it, then reload site
+	("ensurePackage (reload site)", "import importlib, site, tempfile, subprocess, platform; importlib.import_module(package); reload(site)"),
+	("ensurePackage (no stamp)", "import os, PackageManager; PackageManager.StampFile = stampFile; os.path.exists(stampFile) and os.remove(stampFile); PackageManager.ensurePackage(package, silent=True)"),
+	("ensurePackage (stamped)", "import PackageManager; PackageManager.StampFile = stampFile; PackageManager.stamp(package) if not PackageManager.isStamped(package) else None; PackageManager.ensurePackage(package, silent=True)"),
+]
+
+def RunStartupBenchmark(repetitions, package):
+	# Returns {step: (median time of the step, median time of the whole process)} in seconds
+	stampFile = os.path.join(tempfile.gettempdir(), "PackageManager-benchmark-stamp.txt")
+	results = {}
+	for (name, code) in StartupSteps:
+		stepTimes = []
+		processTimes = []
+		script = "import sys, time\nsys.path.insert(0, {0!r})\npackage = {1!r}\nstampFile = {2!r}\nstart = time.time()\n{3}\nprint time.time() - start\n".format(
+			os.path.dirname(os.path.abspath(__file__)), package, stampFile, code)
+		for i in range(repetitions):
+			if name == "ensurePackage (stamped)" and i == 0:
+				# Make sure the stamp exists before timing the warm path
+				subprocess.check_output([sys.executable, "-c", script])
+			start = time.time()
+			output = subprocess.check_output([sys.executable, "-c", script])
+			processTimes.append(time.time() - start)
+			stepTimes.append(float(output.strip().split('\n')[-1]))
+		results[name] = (sorted(stepTimes)[len(stepTimes) / 2], sorted(processTimes)[len(processTimes) / 2])
+	if os.path.exists(stampFile):
+		os.remove(stampFile)
+	return results
+
+# The git commands of a resolve (see FlattenEngines.WorktreeEngine.ResolveTo), as timed by RunFilesystemBenchmark
+FilesystemSteps = ["reset --hard", "reset --soft", "status"]
+
+def RunFilesystemBenchmark(files, repetitions, seed, profiles):
+	# profiles is a list of (label, GitPerformance.PerformanceProfile). Returns a list of (label, {step: median time}) in seconds.
+	root = tempfile.mkdtemp(prefix="flatten-fs-bench-")
+	source = os.path.join(root, "source.git")
+	cwd = os.getcwd()
+	stdout = sys.stdout
+	os.environ['GIT_CONFIG_GLOBAL'] = os.path.join(root, "gitconfig")
+	os.environ['GIT_CONFIG_NOSYSTEM'] = "1"
+	open(os.environ['GIT_CONFIG_GLOBAL'], 'w').close()
+	try:
+		subprocess.check_call([GitFunctions.GitExecutable, "init", "--quiet", "--bare", source])
+		writer = HistoryWriter(seed)
+		tree = GenerateBase(writer, files)
+		# A revision that changes 1% of the files, which is what each resolve resets to and back from
+		paths = writer.random.sample(sorted(tree.keys()), max(1, files / 100))
+		writer.Commit("refs/heads/develop", "Change", dict((path, writer.Edit(tree, path)) for path in paths), [writer.mark])
+		writer.Write(source)
+		base = Git(["rev-parse", "refs/heads/develop~1"], source)
+		head = Git(["rev-parse", "refs/heads/develop"], source)
+		results = []
+		for (label, profile) in profiles:
+			work = os.path.join(root, label)
+			subprocess.check_call([GitFunctions.GitExecutable, "clone", "--quiet", "--no-checkout", "--branch=develop", source, work])
+			os.chdir(work)
+			sys.stdout = open(os.path.join(root, "profiles.log"), 'a')
+			profile.Apply(work)
+			sys.stdout.close()
+			sys.stdout = stdout
+			Git(["reset", "--quiet", "--hard", base], work)
+			times = dict((step, []) for step in FilesystemSteps)
+			for i in range(repetitions):
+				for (step, args) in [("reset --hard", ["reset", "--quiet", "--hard", head]), ("reset --soft", ["reset", "--quiet", "--soft", base]), ("status", ["status", "--porcelain=v2", "-z"])]:
+					start = time.time()
+					Git(args, work)
+					times[step].append(time.time() - start)
+				# Back to where the next resolve starts
+				Git(["reset", "--quiet", "--hard", base], work)
+			os.chdir(cwd)
+			results.append((label, dict((step, sorted(times[step])[len(times[step]) / 2]) for step in FilesystemSteps)))
+		return results
+	finally:
+		if sys.stdout is not stdout:
+			sys.stdout.close()
+			sys.stdout = stdout
+		os.chdir(cwd)
+		shutil.rmtree(root, ignore_errors=True)
+		if profiles[-1][1].worktree_dir is not None:
+			shutil.rmtree(profiles[-1][1].worktree_dir, ignore_errors=True)
+
+def LoadResults(path):
+	results = []
+	if os.path.exists(path):
+		with open(path, 'r') as f:
+			for line in f:
+				if line.strip():
+					results.append(json.loads(line))
+	return results
+
+def SameSettings(a, b):
+	# Results from before the batch backend could be turned on didn't use it
+	return all(a.get(key) == b.get(key) for key in ['shape', 'commits', 'files', 'seed', 'engine', 'options']) and a.get('batch', False) == b.get('batch', False)
+
+def PrintResult(result, previous=None):
+	print "{0:<10} {1:<9} {2:>5} revisions  {3:>8.2f}s  {4:>6} git calls ({5} batched)  {6:>7.3f}s/revision  {7} flattened commits{8}".format(
+		result['shape'], result['engine'], result['revisions'], result['wallTime'], result['gitInvocations'], result['batchInvocations'],
+		result['timePerRevision'] or 0, result['flattenedCommits'], "" if result['treesMatch'] else "  TREES DIFFER")
+	if previous is not None:
+		change = (result['wallTime'] - previous['wallTime']) / previous['wallTime'] * 100 if previous['wallTime'] > 0 else 0
+		print "{0:<20} was {1:.2f}s with {2} git calls on {3} ({4:+.1f}%)".format("", previous['wallTime'], previous['gitInvocations'], previous['time'], change)
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark FlattenGit against synthetic repositories with local bare remotes.')
+	parser.add_argument('--shape', default='merges', choices=Shapes, help='The shape of the generated history.')
+	parser.add_argument('--commits', default=50, type=int, help='The number of commits to generate on top of the base commit.')
+	parser.add_argument('--files', default=None, type=int, help='The number of files in the base tree (default 200, or 20000 for the large shape).')
+	parser.add_argument('--engine', nargs='+', default=['worktree'], choices=sorted(Engines.keys()), help='The FlattenGit engines to benchmark.')
+	parser.add_argument('--seed', default=1, type=int, help='The random seed used to generate the history.')
+	parser.add_argument('--segment-squash', default='never', choices=['never', 'over-limit', 'always'], help='Passed on to FlattenGit.')
+	parser.add_argument('--maxCommitsToCherryPick', default=100000, type=int, help='Passed on to FlattenGit. Defaults to high enough to replay everything.')
+	parser.add_argument('--results', default='benchmark-results.jsonl', help='The JSON-lines file to append results to.')
+	parser.add_argument('--compare', action='store_true', help='Compare each result with the last saved result with the same settings.')
+	parser.add_argument('--startup', default=None, type=int, metavar='COUNT', help='Instead of flattening, time the startup of FlattenGit and of PackageManager.ensurePackage over this many fresh processes.')
+	parser.add_argument('--startup-package', default='requests', help='The (installed) package that ensurePackage is timed with.')
+	parser.add_argument('--filesystem', default=None, type=int, metavar='COUNT', help="Instead of flattening, time the hard reset, soft reset and status of a resolve over a tree of --files files (default 100000) this many times, with the 'default' and 'fast' performance profiles.")
+	parser.add_argument('--sparse-exclude', nargs='+', default=None, metavar='PATTERN', help="With --filesystem, also time the 'fast' profile with these directories left out of the checkout, e.g. 'dir1*'.")
+	parser.add_argument('--worktree-dir', default=None, help="With --filesystem, also time the 'fast' profile with the working tree in this (temporary) folder, e.g. on a tmpfs.")
+	parser.add_argument('--no-batch', dest='batch', action='store_false', help='Start git for every read-only query, instead of using the batch backend as FlattenGit does by default.')
+	parser.add_argument('--keep', action='store_true', help='Keep the generated repos (and flatten.log) instead of deleting them.')
+	args = parser.parse_args()
+
+	if args.startup is not None:
+		results = RunStartupBenchmark(args.startup, args.startup_package)
+		print "{0:<30} {1:>10} {2:>10}".format("median of {0} runs".format(args.startup), "step", "process")
+		for (name, code) in StartupSteps:
+			print "{0:<30} {1:>8.1f}ms {2:>8.1f}ms".format(name, results[name][0] * 1000, results[name][1] * 1000)
+		return
+
+	if args.filesystem is not None:
+		profiles = [("default", PerformanceProfile('default')), ("fast", PerformanceProfile('fast'))]
+		if args.sparse_exclude is not None:
+			profiles.append(("fast+sparse", PerformanceProfile('fast', sparse_exclude=args.sparse_exclude)))
+		if args.worktree_dir is not None:
+			profiles.append(("fast+worktree-dir", PerformanceProfile('fast', worktree_dir=args.worktree_dir)))
+		files = args.files if args.files is not None else 100000
+		results = RunFilesystemBenchmark(files, args.filesystem, args.seed, profiles)
+		print "{0:<20} {1}".format("median of {0} runs".format(args.filesystem), " ".join("{0:>14}".format(step) for step in FilesystemSteps))
+		for (label, times) in results:
+			print "{0:<20} {1}".format(label, " ".join("{0:>12.1f}ms".format(times[step] * 1000) for step in FilesystemSteps))
+		return
+
+	files = args.files if args.files is not None else (20000 if args.shape == 'large' else 200)
+	options = {'segment_squash': args.segment_squash, 'max_commits_to_cherry_pick': args.maxCommitsToCherryPick}
+	previousResults = LoadResults(args.results)
+	allMatch = True
+	for engine in args.engine:
+		result = RunBenchmark(args.shape, args.commits, files, engine, args.seed, options, args.batch, args.keep)
+		previous = [r for r in previousResults if SameSettings(r, result)] if args.compare else []
+		PrintResult(result, previous[-1] if len(previous) > 0 else None)
+		with open(args.results, 'a') as f:
+			f.write(json.dumps(result, sort_keys=True) + '\n')
+		allMatch = allMatch and result['treesMatch']
+	if not allMatch:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
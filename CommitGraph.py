@@ -0,0 +1,60 @@
+# An in-memory view of the commits in a revision range, loaded with a single 'git log' call.
+# FlattenGit used to query the parents, subject, author and email of each revision separately, which costs a process
+# per query. CommitGraph reads all of that up front so that the number of git invocations doesn't grow with the range.
+
+from GitFunctions import StreamLogRecords, logging_function
+
+# Fields are separated by the ASCII unit separator and records by NUL (git log -z), neither of which can appear in a subject
+CommitFields = ['%H', '%P', '%an', '%ae', '%s']
+
+class CommitGraph(object):
+	def __init__(self):
+		# revisions is in 'git log' order (newest first), as FlattenGit expects
+		self.revisions = []
+		# Per-revision tuple of (parents, author, email, subject). parents is itself a tuple of hashes.
+		self.commits = {}
+
+	def Load(self, range_spec, silent=True):
+		self.revisions = []
+		self.commits = {}
+		if not silent:
+			logging_function("Loading the log of changes in {0}".format(range_spec))
+		# The log is parsed as it is read, rather than held in memory in full
+		for (revision, parents, author, email, subject) in StreamLogRecords([range_spec], CommitFields):
+			self.revisions.append(revision)
+			self.commits[revision] = (tuple(parents.split()), author, email, subject)
+		return self
+
+	def __len__(self):
+		return len(self.revisions)
+
+	def __contains__(self, revision):
+		return revision in self.commits
+
+	def Parents(self, revision):
+		return self.commits[revision][0]
+
+	def CountParents(self, revision):
+		return len(self.commits[revision][0])
+
+	def IsMerge(self, revision):
+		return self.CountParents(revision) > 1
+
+	def Author(self, revision):
+		return self.commits[revision][1]
+
+	def Email(self, revision):
+		return self.commits[revision][2]
+
+	def Subject(self, revision):
+		return self.commits[revision][3]
+
+	def LastMerge(self):
+		# revisions is newest first, so the first merge found is the last one that will be applied
+		for revision in self.revisions:
+			if self.IsMerge(revision):
+				return revision
+		return None
+
+def LoadCommitGraph(previous_commit, current_commit, silent=True):
+	return CommitGraph().Load("{0}..{1}".format(previous_commit, current_commit), silent=silent)
@@ -0,0 +1,110 @@
+# A pre-pass that works out how each revision to be cherry-picked will apply, before the sequential loop in FlattenGit
+# discovers it one revision at a time. Starting from the tree of the flattened head, each revision is merged in memory
+# (PlumbingEngine.PickTree: git merge-tree, no working tree) onto the tree that the revisions before it are predicted to
+# leave, just as the loop will pick it, and the result is classified as:
+#	* 'clean': applies (with 'theirs' resolving any conflicting hunks)
+#	* 'empty': makes no changes itself, so is kept as an empty commit
+#	* 'noop': its changes are already there, so the cherry-pick would come out empty and be aborted
+#	* 'delete-modify': modifies files that are deleted on the destination, which are resolved by deleting them
+#	* 'conflict': has conflicts that can't be resolved automatically (e.g. deletes a file that was modified)
+# Each prediction records the head tree it was made from and the tree it leaves. When the loop reaches a revision with the
+# flattened head at that tree, the prediction is exactly what the cherry-pick would do, so the engines use it instead: the
+# plumbing engine commits the predicted tree without merging again, and the worktree engine skips a revision that won't apply
+# without trying it, and checks out the tree of a delete/modify conflict rather than resolving it after a failed cherry-pick
+# (a clean cherry-pick is as quick as checking out and committing its tree, so it is still cherry-picked). Otherwise (e.g. the
+# replay cache reused a commit with a different tree) the revision is cherry-picked as usual, and the predictions after it are
+# unlikely to be used.
+#
+# Each prediction depends on the one before it, so a chain of them is worked out in order. The chains start wherever the tree
+# of the flattened head is known up front: at the start, and after the last merge, which is resolved to its own tree. The
+# chains are independent of each other, so they are worked out across a process pool. PrintReport compares the predictions
+# with what actually happened.
+
+import time
+from GitFunctions import RunGitCommandWithErrorCheck
+from PatchIdIndex import Applied
+
+Outcomes = ['clean', 'empty', 'noop', 'delete-modify', 'conflict']
+
+def TreeOf(commit):
+	return RunGitCommandWithErrorCheck(["rev-parse", commit + "^{tree}"], "Failed to retrieve tree of {0}".format(commit), silent=True).strip()
+
+def PredictChain(job):
+	# Runs in a pool process. job is (head tree, [revision, ...], {revision: patch-id}, {revision: reverted patch-id}, set of patch-ids
+	# already present), and returns {revision: (prediction, paths, head tree, tree)}. Revisions whose patch-id is already present are
+	# skipped, as FlattenGit skips them.
+	from FlattenEngines import PlumbingEngine
+	(headTree, revisions, patchIds, revertedIds, present) = job
+	engine = PlumbingEngine()
+	predictions = {}
+	for revision in revisions:
+		if patchIds.get(revision) in present:
+			continue
+		try:
+			(revisionTree, parents, author, message) = engine.ReadCommit(revision)
+			(prediction, paths, tree) = engine.PickTree(revision, revisionTree, parents, headTree)
+		except Exception:
+			# The rest of the chain depends on this revision
+			break
+		predictions[revision] = (prediction, paths, headTree, tree)
+		if prediction not in ('conflict', 'noop'):
+			Applied(present, revision, patchIds, revertedIds)
+		headTree = tree
+	return predictions
+
+def PredictConflicts(graph, revisions, start, lastMerge, jobs=None, patchIds=None, present=None, revertedIds=None):
+	# revisions are in the order they are applied, starting from the commit start. The single-parent revisions are predicted;
+	# other merges are skipped, and the last merge is resolved to its own tree. patchIds and revertedIds (see PatchIdIndex.PatchIds)
+	# and present (the patch-ids already on the destination branch) are used to skip revisions as FlattenGit does. Returns
+	# {revision: (prediction, paths, head tree, tree)}; revisions that couldn't be predicted are left out.
+	startTime = time.time()
+	patchIds = patchIds or {}
+	revertedIds = revertedIds or {}
+	present = set(present or [])
+	chains = [[TreeOf(start), []]]
+	for revision in revisions:
+		if revision == lastMerge:
+			chains.append([TreeOf(revision), []])
+		elif not graph.IsMerge(revision):
+			chains[-1][1].append(revision)
+	# A later chain can't tell which of the earlier revisions will apply, so it takes them all as applied
+	poolJobs = []
+	for (headTree, chain) in chains:
+		if len(chain) > 0:
+			poolJobs.append((headTree, chain, patchIds, revertedIds, set(present)))
+		for revision in chain:
+			Applied(present, revision, patchIds, revertedIds)
+	if len(poolJobs) == 0:
+		return {}
+	import multiprocessing
+	if multiprocessing.current_process().daemon or len(poolJobs) == 1:
+		# Already in a pool process (see FlattenGit.FlattenBranches), which can't start another pool, or only one chain
+		results = map(PredictChain, poolJobs)
+	else:
+		pool = multiprocessing.Pool(jobs or min(len(poolJobs), multiprocessing.cpu_count()))
+		try:
+			results = pool.map(PredictChain, poolJobs)
+		finally:
+			pool.close()
+			pool.join()
+	predictions = {}
+	for result in results:
+		predictions.update(result)
+	counts = dict((outcome, len([1 for prediction in predictions.values() if prediction[0] == outcome])) for outcome in Outcomes)
+	print "Predicted {0} revisions in {1:.1f}s ({2} chains): {3}".format(len(predictions), time.time() - startTime, len(poolJobs), ", ".join("{0} {1}".format(counts[outcome], outcome) for outcome in Outcomes if counts[outcome] > 0))
+	return predictions
+
+def PrintReport(predictions, outcomes, used=0):
+	# outcomes is {revision: actual outcome}, using the same names as the predictions (see Outcomes). used is how many of the
+	# predictions the engine applied instead of cherry-picking (which were made from the flattened head at the time)
+	pairs = [(predictions[revision][0], outcome) for (revision, outcome) in outcomes.items() if revision in predictions]
+	if len(pairs) == 0:
+		return
+	# The worktree engine can't tell an empty commit from any other that applied cleanly
+	correct = len([1 for (predicted, actual) in pairs if predicted == actual or (predicted, actual) == ('empty', 'clean')])
+	print "Conflict predictions: {0} of {1} correct ({2:.0f}%), {3} applied from the prediction".format(correct, len(pairs), 100.0 * correct / len(pairs), used)
+	print "\t{0:<16} {1}".format("predicted", " ".join("{0:>13}".format(outcome) for outcome in Outcomes))
+	for predicted in Outcomes:
+		row = [len([1 for pair in pairs if pair == (predicted, actual)]) for actual in Outcomes]
+		if sum(row) > 0:
+			print "\t{0:<16} {1}".format(predicted, " ".join("{0:>13}".format(count) for count in row))
@@ -0,0 +1,73 @@
+# Checkpoints for long flatten runs, so that a run that dies part way through (agent restart, killed job, failed push)
+# can be resumed by the next run for the same branch and target, instead of applying every revision again.
+#
+# A checkpoint is a small JSON file per destination branch in the working repo's git directory. It is written after each
+# revision is applied, and removed once the flattened branch has been pushed. A checkpoint is only used if it was made
+# for the same previous/current commits and the same remote branch head, and its head commit still exists.
+
+import os
+import re
+import json
+from GitFunctions import RunGitCommand, GetGitCommonDir
+
+class FlattenCheckpoint(object):
+	def __init__(self, dest_branch, path=None):
+		if path is None:
+			path = os.path.join(GetGitCommonDir(), "flatten", "checkpoint-" + re.sub(r"[^A-Za-z0-9._-]", "_", dest_branch) + ".json")
+		self.dest_branch = dest_branch
+		self.path = path
+
+	def Load(self):
+		if not os.path.exists(self.path):
+			return None
+		try:
+			with open(self.path, 'r') as f:
+				return json.load(f)
+		except ValueError:
+			print "Ignoring unreadable checkpoint {0}".format(self.path)
+			self.Clear()
+			return None
+
+	def Save(self, state):
+		directory = os.path.dirname(self.path)
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		# Write to a temporary file first, so that a crash never leaves a half-written checkpoint
+		temp = self.path + ".tmp"
+		with open(temp, 'w') as f:
+			json.dump(state, f)
+		if os.path.exists(self.path):
+			os.remove(self.path)
+		os.rename(temp, self.path)
+
+	def Clear(self):
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+	def Resume(self, previous_commit, current_commit, remote_head, revisions, mode):
+		# Returns the saved state if it can be resumed from, otherwise drops the checkpoint and returns None.
+		# revisions is the list of revisions in the order they are applied, and mode is how they are being applied (e.g. "squash").
+		state = self.Load()
+		if state is None:
+			return None
+		reason = None
+		if state.get('dest_branch') != self.dest_branch or state.get('current_commit') != current_commit or state.get('previous_commit') != previous_commit:
+			reason = "it was for a different range of revisions"
+		elif state.get('mode') != mode:
+			reason = "it was made in a different mode"
+		elif state.get('remote_head') != remote_head:
+			reason = "the remote branch has moved since it was made"
+		elif state.get('revisions') != len(revisions) or not (0 <= state.get('position', -1) <= len(revisions)):
+			reason = "the list of revisions has changed"
+		elif state['position'] > 0 and state.get('last_revision') != revisions[state['position'] - 1]:
+			reason = "the list of revisions has changed"
+		else:
+			success, output = RunGitCommand(["cat-file", "-e", state.get('head', '') + "^{commit}"], silent=True, noWarningDialog=True)
+			if not success:
+				reason = "its head commit no longer exists"
+		if reason is not None:
+			print "Dropping the checkpoint for {0}, because {1}".format(self.dest_branch, reason)
+			self.Clear()
+			return None
+		print "Resuming {0} from a checkpoint after {1} of {2} revisions".format(self.dest_branch, state['position'], len(revisions))
+		return state
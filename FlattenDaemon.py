@@ -0,0 +1,319 @@
+# A long-running flatten service, as an alternative to starting a new FlattenGit process for every TeamCity trigger.
+# It keeps the working repo warm, and takes flatten requests from a queue directory, which are added with 'submit' (or 'hook',
+# a stand-in for a post-receive hook, which reads "<old> <new> <ref>" lines from stdin).
+#
+# Pending requests for the same branch are coalesced: only the newest target commit is flattened, since flattening up to it
+# also covers the older ones. After the first job on a branch, jobs skip PrepareGitWorkingFolder and the ls-remote, using the
+# remote-tracking refs that the daemon's own pushes keep up to date, and only fetch from origin if the target commit is
+# missing. If that fails (e.g. something else pushed to teamcity), the job is retried with a full prepare.
+#
+# The queue depth, the pending and running requests, and the latency of recent requests (from being queued to being
+# flattened) are written to status.json in the queue directory, and shown by 'status'. Request files that can't be read, or
+# don't have a branch and the time they were enqueued, are renamed to <file>.bad with a warning, rather than stopping the daemon.
+#
+# Usage:
+#	FlattenDaemon.py serve --working-repo=<location> [--queue=<dir>] [FlattenGit options]
+#	FlattenDaemon.py submit --branch=<branch> [--commit=<hash>]		(no commit: the head of the source branch when the job runs)
+#	FlattenDaemon.py hook < "<old> <new> refs/heads/<branch>" lines
+#	FlattenDaemon.py status
+#	FlattenDaemon.py stop
+
+import os
+import sys
+import json
+import glob
+import time
+import traceback
+import GitFunctions
+from GitFunctions import RunGitCommand, RunGitCommandWithErrorCheck, GetOriginBranch, GetTeamCityBranches
+from FlattenEngines import Engines, WorktreeEngine, GitVersionError
+import FlattenGit
+from RepoLock import RepoLock
+from GitPerformance import Profiles, MakeProfile
+
+DefaultQueue = os.path.join(os.path.expanduser("~"), "FlattenQueue")
+
+class FlattenQueue(object):
+	# A directory of request files, one JSON object ({branch, commit, enqueued}) per file. Files are claimed by renaming them while they are being flattened.
+	def __init__(self, path):
+		self.path = os.path.abspath(path)
+		if not os.path.exists(self.path):
+			os.makedirs(self.path)
+
+	def Submit(self, branch, commit=None):
+		enqueued = time.time()
+		name = "{0:017.6f}-{1}-{2}".format(enqueued, os.getpid(), branch.replace('/', '_'))
+		temp = os.path.join(self.path, name + ".tmp")
+		with open(temp, 'w') as f:
+			json.dump({'branch': branch, 'commit': commit, 'enqueued': enqueued}, f)
+		# Renamed into place, so that the daemon never reads a half-written request
+		os.rename(temp, os.path.join(self.path, name + ".json"))
+		return name
+
+	def Pending(self):
+		# Returns a list of (file, request), oldest first. Requests that aren't valid are moved aside (see MoveAside).
+		requests = []
+		for path in sorted(glob.glob(os.path.join(self.path, "*.json"))):
+			if os.path.basename(path) == "status.json":
+				continue
+			try:
+				with open(path, 'r') as f:
+					request = json.load(f)
+			except IOError:
+				# Removed by another claim
+				continue
+			except ValueError as e:
+				self.MoveAside(path, "it isn't valid JSON ({0})".format(e))
+				continue
+			error = RequestError(request)
+			if error is not None:
+				self.MoveAside(path, error)
+				continue
+			request.setdefault('commit', None)
+			requests.append((path, request))
+		return requests
+
+	def MoveAside(self, path, reason):
+		# Rename a request file that can't be flattened to <file>.bad, so that it is kept to look at, but not read again
+		print "WARNING: Moving the request {0} aside, as {1}".format(path, reason)
+		try:
+			os.rename(path, path + ".bad")
+		except OSError:
+			# Moved aside or claimed by someone else
+			pass
+
+	def Claim(self, paths):
+		claimed = []
+		for path in paths:
+			try:
+				os.rename(path, path + ".claimed")
+				claimed.append(path + ".claimed")
+			except OSError:
+				pass
+		return claimed
+
+	def Complete(self, claimed):
+		for path in claimed:
+			if os.path.exists(path):
+				os.remove(path)
+
+	def Unclaim(self):
+		# Requests left claimed by a daemon that died are queued again
+		for path in glob.glob(os.path.join(self.path, "*.json.claimed")):
+			os.rename(path, path[:-len(".claimed")])
+
+	def NextJob(self):
+		# Coalesce the pending requests by branch, and return (branch, newest request, all of the branch's request files) for the
+		# branch that has been waiting longest, or None if there are none
+		pending = self.Pending()
+		if len(pending) == 0:
+			return None
+		branch = pending[0][1]['branch']
+		requests = [(path, request) for (path, request) in pending if request['branch'] == branch]
+		newest = max(requests, key=lambda (path, request): request['enqueued'])[1]
+		return (branch, newest, requests)
+
+	def StopFile(self):
+		return os.path.join(self.path, "stop")
+
+	def StatusFile(self):
+		return os.path.join(self.path, "status.json")
+
+def RequestError(request):
+	# Why a request read from the queue can't be flattened, or None if it can
+	if not isinstance(request, dict):
+		return "it isn't a JSON object"
+	if not isinstance(request.get('branch'), basestring) or len(request['branch'].strip()) == 0:
+		return "it has no branch"
+	if request.get('commit') is not None and (not isinstance(request['commit'], basestring) or len(request['commit'].split()) != 1):
+		return "its commit isn't a commit name"
+	if isinstance(request.get('enqueued'), bool) or not isinstance(request.get('enqueued'), (int, long, float)):
+		return "it has no time it was enqueued"
+	return None
+
+class FlattenDaemon(object):
+	def __init__(self, queue, working_repo, options, poll_interval=1.0, refresh_interval=600):
+		self.queue = queue
+		self.working_repo = os.path.abspath(working_repo)
+		self.options = options
+		self.poll_interval = poll_interval
+		self.refresh_interval = refresh_interval
+		# When each branch last had a full prepare (fetch of both remotes)
+		self.prepared = {}
+		self.latencies = []
+		self.completed = 0
+		self.failed = 0
+		self.coalesced = 0
+		self.started = time.time()
+		self.running = None
+
+	def Serve(self):
+		print "Flatten daemon serving {0} from {1}".format(self.working_repo, self.queue.path)
+		RunGitCommand(["config", "--global", "gc.auto", "0"])
+		self.queue.Unclaim()
+		if os.path.exists(self.queue.StopFile()):
+			os.remove(self.queue.StopFile())
+		while not os.path.exists(self.queue.StopFile()):
+			job = self.queue.NextJob()
+			self.WriteStatus()
+			if job is None:
+				time.sleep(self.poll_interval)
+				continue
+			(branch, request, requests) = job
+			claimed = self.queue.Claim([path for (path, pending) in requests])
+			if len(claimed) == 0:
+				continue
+			# Requests claimed by someone else in the meantime are theirs to count
+			requests = [(path, pending) for (path, pending) in requests if path + ".claimed" in claimed]
+			self.coalesced += len(claimed) - 1
+			self.running = {'branch': branch, 'commit': request['commit'], 'started': time.time(), 'requests': len(claimed)}
+			self.WriteStatus()
+			success = self.RunJob(branch, request['commit'])
+			finished = time.time()
+			for (path, pending) in requests:
+				self.latencies.append(finished - pending['enqueued'])
+			self.latencies = self.latencies[-100:]
+			if success:
+				self.completed += 1
+			else:
+				self.failed += 1
+			print "Flattened {0} ({1} request{2}) in {3:.1f}s, {4:.1f}s after the oldest request; {5} requests pending".format(branch, len(claimed),
+				"" if len(claimed) == 1 else "s", finished - self.running['started'], finished - min(pending['enqueued'] for (path, pending) in requests), len(self.queue.Pending()))
+			self.running = None
+			self.queue.Complete(claimed)
+		os.remove(self.queue.StopFile())
+		self.WriteStatus()
+		print "Flatten daemon stopped"
+
+	def RunJob(self, branch, commit):
+		warm = branch in self.prepared and time.time() - self.prepared[branch] < self.refresh_interval
+		try:
+			try:
+				self.Flatten(branch, commit, warm)
+			except Exception:
+				if not warm:
+					raise
+				print "Flattening {0} from the warm working repo failed, so trying again after a full prepare:".format(branch)
+				traceback.print_exc()
+				self.Flatten(branch, commit, False)
+			return True
+		except Exception:
+			print "Failed to flatten {0}:".format(branch)
+			traceback.print_exc()
+			# Start from scratch next time
+			self.prepared.pop(branch, None)
+			return False
+		finally:
+			if os.path.exists(self.working_repo):
+				os.chdir(self.working_repo)
+
+	def Flatten(self, branch, commit, warm):
+		if not warm:
+			if commit is None:
+				# The working repo may not even exist yet, so ask origin for the head of the source branch
+				originBranch = GetOriginBranch(branch) or branch
+				heads = RunGitCommandWithErrorCheck(["ls-remote", GitFunctions.OriginUrl, "refs/heads/" + originBranch], "Unable to find the head of {0}".format(originBranch), silent=True)
+				if len(heads.split()) == 0:
+					raise Exception("{0} does not exist on origin".format(originBranch))
+				commit = heads.split()[0]
+			self.prepared[branch] = time.time()
+			FlattenGit.FlattenGit(commit, branch, self.working_repo, **self.options)
+			return
+		os.chdir(self.working_repo)
+		originBranch = GetOriginBranch(branch) or branch
+		# Other jobs on the agent may be using the working repo too (see RepoLock.py)
+		with RepoLock(self.working_repo):
+			if commit is None:
+				RunGitCommandWithErrorCheck(["fetch", "origin", originBranch], "Could not fetch changes from origin", printstdout=True)
+				commit = RunGitCommandWithErrorCheck(["rev-parse", "--verify", "refs/remotes/origin/{0}^{{commit}}".format(originBranch)], "Unable to find origin/{0}".format(originBranch), silent=True).strip()
+			else:
+				success, output = RunGitCommand(["cat-file", "-e", commit + "^{commit}"], silent=True, noWarningDialog=True)
+				if not success:
+					RunGitCommandWithErrorCheck(["fetch", "origin", originBranch], "Could not fetch changes from origin", printstdout=True)
+		# The remote-tracking refs are kept up to date by this daemon's own pushes
+		heads = RunGitCommandWithErrorCheck(["for-each-ref", "--format=%(objectname)\trefs/heads/%(refname:strip=3)", "refs/remotes/teamcity"], "Unable to list teamcity branches", silent=True)
+		FlattenGit.FlattenGit(commit, branch, self.working_repo, prepare=False, remote_heads=heads, **self.options)
+
+	def WriteStatus(self):
+		latencies = sorted(self.latencies)
+		pending = {}
+		for (path, request) in self.queue.Pending():
+			pending.setdefault(request['branch'], []).append(request['commit'])
+		status = {'pid': os.getpid(), 'started': self.started, 'updated': time.time(), 'depth': sum(len(commits) for commits in pending.values()),
+			'pending': pending, 'running': self.running, 'completed': self.completed, 'failed': self.failed, 'coalesced': self.coalesced,
+			'latency': {'count': len(latencies), 'p50': latencies[len(latencies) / 2] if latencies else None,
+				'p90': latencies[int(len(latencies) * 0.9)] if latencies else None, 'max': latencies[-1] if latencies else None}}
+		temp = self.queue.StatusFile() + ".tmp"
+		with open(temp, 'w') as f:
+			json.dump(status, f, indent=1, sort_keys=True)
+		if os.path.exists(self.queue.StatusFile()):
+			os.remove(self.queue.StatusFile())
+		os.rename(temp, self.queue.StatusFile())
+
+def PrintStatus(queue):
+	if not os.path.exists(queue.StatusFile()):
+		print "No flatten daemon has run on {0}; {1} requests pending".format(queue.path, len(queue.Pending()))
+		return
+	with open(queue.StatusFile(), 'r') as f:
+		status = json.load(f)
+	print "Flatten daemon {0}, last updated {1:.0f}s ago".format(status['pid'], time.time() - status['updated'])
+	print "\tqueue depth:  {0} ({1})".format(status['depth'], ", ".join("{0}: {1}".format(branch, len(commits)) for (branch, commits) in sorted(status['pending'].items())) or "empty")
+	if status['running'] is not None:
+		print "\trunning:      {0} for {1:.0f}s".format(status['running']['branch'], time.time() - status['running']['started'])
+	print "\tcompleted:    {0} jobs ({1} failed), {2} requests coalesced".format(status['completed'], status['failed'], status['coalesced'])
+	latency = status['latency']
+	if latency['count'] > 0:
+		print "\tlatency:      p50 {0:.1f}s, p90 {1:.1f}s, max {2:.1f}s over the last {3} requests".format(latency['p50'], latency['p90'], latency['max'], latency['count'])
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(description='Run FlattenGit as a long-running service with a coalescing job queue, or add requests to its queue.')
+	parser.add_argument('command', choices=['serve', 'submit', 'hook', 'status', 'stop'])
+	parser.add_argument('--queue', default=DefaultQueue, help='The queue directory shared by the daemon and its clients.')
+	parser.add_argument('--branch', default=None, help="submit: the TeamCity branch to flatten (e.g. 'develop').")
+	parser.add_argument('--commit', default=None, help='submit: the commit to flatten up to. Defaults to the head of the source branch when the job runs.')
+	parser.add_argument('--working-repo', default=r'E:\Flatten\Project', help='serve: the disk location of the working repo.')
+	parser.add_argument('--poll-interval', default=1.0, type=float, help='serve: how often to check the queue, in seconds.')
+	parser.add_argument('--refresh-interval', default=600, type=float, help='serve: how often (in seconds) a branch gets a full prepare, rather than reusing the warm working repo.')
+	parser.add_argument('--maxCommitsToCherryPick', default=100, type=int, help='serve: passed on to FlattenGit.')
+	parser.add_argument('--segment-squash', default='never', choices=['never', 'over-limit', 'always'], help='serve: passed on to FlattenGit.')
+	parser.add_argument('--engine', default=WorktreeEngine.name, choices=sorted(Engines.keys()), help='serve: passed on to FlattenGit.')
+	parser.add_argument('--object-cache', default=None, help='serve: passed on to FlattenGit.')
+	parser.add_argument('--performance-profile', default=None, choices=sorted(Profiles.keys()), help='serve: passed on to FlattenGit.')
+	parser.add_argument('--sparse-exclude', nargs='+', default=None, metavar='PATTERN', help='serve: passed on to FlattenGit.')
+	parser.add_argument('--worktree-dir', default=None, help='serve: passed on to FlattenGit.')
+	parser.add_argument('--concurrent-network', action='store_true', help='serve: passed on to FlattenGit.')
+	parser.add_argument('--no-batch', dest='batch', action='store_false', help='serve: as for FlattenGit.')
+	args = parser.parse_args()
+
+	queue = FlattenQueue(args.queue)
+	if args.command == 'serve':
+		if GitVersionError(args.engine) is not None:
+			parser.error(GitVersionError(args.engine))
+		GitFunctions.UseBatchBackend = args.batch
+		options = {'max_commits_to_cherry_pick': args.maxCommitsToCherryPick, 'segment_squash': args.segment_squash, 'engine': args.engine, 'object_cache': args.object_cache,
+			'performance_profile': MakeProfile(args.performance_profile, args.sparse_exclude, args.worktree_dir), 'concurrent_network': args.concurrent_network}
+		FlattenDaemon(queue, args.working_repo, options, args.poll_interval, args.refresh_interval).Serve()
+	elif args.command == 'submit':
+		if args.branch is None:
+			parser.error("submit needs --branch")
+		print queue.Submit(args.branch, args.commit)
+	elif args.command == 'hook':
+		# Like a post-receive hook: one "<old> <new> <ref>" line per updated source branch. Deleted branches, and branches that
+		# TeamCity doesn't build, are ignored.
+		updates = []
+		for line in sys.stdin:
+			fields = line.split()
+			if len(fields) == 3 and fields[2].startswith("refs/heads/") and fields[1].strip('0') != '':
+				updates.append((fields[2][len("refs/heads/"):], fields[1]))
+		teamCityBranches = GetTeamCityBranches([originBranch for (originBranch, commit) in updates])
+		for (originBranch, commit) in updates:
+			if teamCityBranches[originBranch] is not None:
+				print queue.Submit(teamCityBranches[originBranch], commit)
+	elif args.command == 'status':
+		PrintStatus(queue)
+	elif args.command == 'stop':
+		open(queue.StopFile(), 'w').close()
+
+if __name__ == "__main__":
+	main()
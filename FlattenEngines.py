@@ -0,0 +1,572 @@
+# The engines that FlattenGit uses to build the flattened commits on the destination branch.
+# The first two engines produce the same trees; they differ in how they get there:
+#	* WorktreeEngine checks the destination branch out and uses cherry-pick, reset and commit in the working tree.
+#	* PlumbingEngine never touches the working tree. Commits are built in the object database with in-memory tree merges
+#	  (merge-tree), commit-tree and update-ref, which avoids rewriting a game-sized checkout for every revision.
+#	* BulkEngine replays the whole range at once, with one fast-export and one fast-import (see BulkEngine.Replay). Its
+#	  intermediate trees can differ, as it applies whole files rather than merging them, but the last commit is the same.
+
+import os
+import tempfile
+from GitFunctions import RunGitCommand, RunGitCommandWithErrorCheck, GitExecutable, GetGitVersion, StreamStatus, StreamGitCommand
+from GitBatch import GitObjectReader
+
+# The hash of the empty tree, which is the same in every repo
+EmptyTree = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+NullHash = "0" * 40
+
+def FormatSourceTrailer(source_branch, revision):
+	# The source revision number, for TeamCity to use to label the build, etc.
+	return 'branch: {0}, revision: {1}'.format(source_branch, revision)
+
+def ModifyLastCommitMessage(source_branch, revision):
+	# Modify the last commit message to include the source branch/revision.
+	head = RunGitCommandWithErrorCheck(["log", "-n", "1", "HEAD", "--format=%H"], "Failed to retrieve current head revision").replace('\n','')
+	message = RunGitCommandWithErrorCheck(["log", "-n", "1", head, '--format=%s'], "Failed to retrieve commit message for revision {0}".format(revision))
+	with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
+		f.write(message)
+		f.write('\n' + FormatSourceTrailer(source_branch, revision) + '\n\n')
+		temp = f.name
+	RunGitCommandWithErrorCheck(["commit", "--amend", "--file={0}".format(temp)], "Failed to amend commit message to include source branch and revision")
+
+def PushArgs(dest_branch, force=False):
+	if force:
+		# Force-push, in case the branch already existed (which will be the case if there were too many commits)
+		return ["push", "--force", "--set-upstream", "teamcity", dest_branch]
+	return ["push", "teamcity", dest_branch]
+
+def PushDestBranch(dest_branch, force=False):
+	RunGitCommandWithErrorCheck(PushArgs(dest_branch, force), "Failed to set upstream branch" if force else "Failed to push")
+
+class WorktreeEngine(object):
+	# Applies revisions by cherry-picking them onto the checked out destination branch
+	name = "worktree"
+	# Whether FlattenGit applies the revisions one at a time (False), or hands the whole range to Replay (True)
+	bulk = False
+	# The oldest git that the engine works with (see GitVersionError), if any
+	MinimumGitVersion = None
+
+	def __init__(self, graph=None):
+		self.graph = graph
+
+	def Start(self, dest_branch, start_point, track=False):
+		# Checkout start_point as dest_branch, over-writing any existing local branch of the same name
+		RunGitCommandWithErrorCheck(["checkout", "-B", dest_branch, start_point] + ([] if track else ["--no-track"]), "Checkout failed")
+
+	def Head(self):
+		return RunGitCommandWithErrorCheck(["log", "-n", "1", "HEAD", "--format=%H"], "Failed to retrieve current head revision").replace('\n','')
+
+	def Commit(self, revision, message=None, author=None):
+		# Commit the index using the commit message and author of revision, unless message and author (name, email) are given
+		if message is None:
+			message = self.graph.Subject(revision) + '\n'
+		if author is None:
+			author = (self.graph.Author(revision), self.graph.Email(revision))
+		(author, email) = author
+		# Write the message out to a file, to retain any linebreaks or quotation marks
+		with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
+			f.write(message)
+			temp = f.name
+		(success, output) = RunGitCommand(["commit", "--author='{0} <{1}>'".format(author, email), "--file={0}".format(temp)])
+		os.remove(temp)
+		return (success, output)
+
+	def ResolveTo(self, revision, message=None, author=None):
+		# Make a commit (if there are any changes) that makes the destination branch match revision. Returns True if a commit was made.
+		# The commit has the subject and author of revision, unless message and author (name, email) are given.
+		# Get the current head commit, to reset back to
+		head = self.Head()
+		# Hard reset to the merge commit.
+		RunGitCommandWithErrorCheck(["reset", "--hard", revision], "Failed to reset to source branch")
+		# Soft reset back to the destination branch
+		RunGitCommandWithErrorCheck(["reset", "--soft", head], "Failed to reset back to destination branch")
+		# Commit the index (unless it is empty, except for the last commit).
+		# An entry whose X is not '.' has been added, modified or deleted in the index; unmerged entries count too. Untracked files ('?') don't.
+		# Reading the status stops at the first such entry.
+		filesInIndex = any(kind == 'u' or (kind in '12' and xy[0] != '.') for (kind, xy, path, originalPath) in StreamStatus(silent=False))
+		if not filesInIndex:
+			return False
+		(success, output) = self.Commit(revision, message, author)
+		if not success:
+			raise Exception("Failed to commit flattened merge")
+		return True
+
+	def CherryPick(self, revision, prediction=None):
+		# Only one parent, and not the last commit, so cherry-pick this revision, using conflict-resolution strategy "theirs".
+		# If any conflicts actually arose, they will be resolved later by the last merge. Returns True if a commit was made.
+		# prediction is the (outcome, paths, head tree, tree) worked out by ConflictPrediction, if any. lastOutcome is set to what actually happened.
+		# A clean cherry-pick is as quick as checking out the predicted tree and committing it, so only the other outcomes are applied from the prediction.
+		self.lastPredicted = prediction is not None and prediction[0] not in ('clean', 'empty') and prediction[2] == self.HeadTree()
+		if self.lastPredicted:
+			return self.ApplyPrediction(revision, prediction)
+		# This call may fail if the commit made no changes, so do not use RunGitCommandsWithErrorCheck
+		success, output = RunGitCommand(["cherry-pick", "--allow-empty", "--strategy=recursive", "--strategy-option=theirs", revision])
+		self.lastOutcome = 'clean'
+		if not success:
+			# It could be that "DU" (deleted/unresolved) changes exist. A file was deleted on ours and modified on theirs. Find all such files and resolve them in one go by deleting them.
+			# The conflicts are read from the index (stage 1 is the base, 2 ours and 3 theirs), which is much cheaper than the status of the working tree
+			stages = {}
+			for record in StreamGitCommand(["ls-files", "-u", "-z"]):
+				if len(record) > 0:
+					(info, path) = record.split('\t', 1)
+					stages.setdefault(path, set()).add(int(info.split(' ')[2]))
+			deletedFiles = sorted(path for (path, entry) in stages.items() if entry == set([1, 3]))
+			otherUnresolvedFiles = len(deletedFiles) < len(stages)
+			if otherUnresolvedFiles:
+				print "WARNING: Could not resolve some files. Check output:"
+				print output
+			elif len(deletedFiles) > 0:
+				print "Resolving deleted files:"
+				for path in deletedFiles:
+					print "\t" + path
+				RunGitCommandWithErrorCheck(["rm", "--quiet", "--"] + deletedFiles, "Failed to remove deleted files")
+				(success, output) = self.Commit(revision)
+				if success:
+					self.lastOutcome = 'delete-modify'
+				else:
+					print "Failed to commit resolved cherry-pick"
+			if not success:
+				self.lastOutcome = 'conflict' if len(stages) > 0 else 'noop'
+		if not success:
+			print "WARNING: Failed to cherry pick revision {0}; check output below. This is probably due to the same commit existing in multiple branches that were merged together.".format(revision)
+			# Assume that this failed because that change was already in this branch (which would be sorted out by a subsequent merge) so print output for logging and reset
+			print output
+			RunGitCommandWithErrorCheck(["cherry-pick", "--abort"], "Failed to abort cherry-pick", printstdout=True)
+		return bool(success)
+
+	def HeadTree(self):
+		return RunGitCommandWithErrorCheck(["rev-parse", "HEAD^{tree}"], "Failed to retrieve current head tree", silent=True).strip()
+
+	def ApplyPrediction(self, revision, prediction):
+		# prediction was worked out from the current head tree, so it is what the cherry-pick would do: skip a revision that won't apply
+		# without trying it (and aborting), and resolve deleted files by checking out the predicted tree (only the files that it changes)
+		# and committing it, as resolving them after a failed cherry-pick would have
+		(outcome, paths, headTree, tree) = prediction
+		self.lastOutcome = outcome
+		if outcome in ('conflict', 'noop'):
+			print "Skipping revision {0}, which was predicted to {1}".format(revision, "have unresolvable conflicts" if outcome == 'conflict' else "make no changes")
+			for path in paths:
+				print "\t" + path
+			return False
+		RunGitCommandWithErrorCheck(["read-tree", "-m", "-u", "HEAD", tree], "Failed to check out the predicted tree of {0}".format(revision))
+		print "Resolving deleted files:"
+		for path in paths:
+			print "\t" + path
+		(success, output) = self.Commit(revision)
+		if not success:
+			raise Exception("Failed to commit the predicted tree of {0}".format(revision))
+		return True
+
+	def Reuse(self, commit):
+		# Make an existing flattened commit (see ReplayCache.py) the new head, as if it had just been made
+		RunGitCommandWithErrorCheck(["reset", "--hard", commit], "Failed to reset to {0}".format(commit))
+
+	def AmendMessage(self, source_branch, revision):
+		ModifyLastCommitMessage(source_branch, revision)
+
+	def UpdateBranch(self, dest_branch):
+		# The destination branch is checked out, so it is already up to date
+		pass
+
+	def Publish(self, dest_branch, force=False):
+		self.UpdateBranch(dest_branch)
+		PushDestBranch(dest_branch, force)
+
+class PlumbingEngine(object):
+	# Applies revisions without a working tree. The destination head is only held in memory until Publish updates the branch.
+	name = "plumbing"
+	bulk = False
+	# Revisions are merged with 'merge-tree --write-tree', which is new in git 2.38
+	MinimumGitVersion = (2, 38)
+
+	def __init__(self, graph=None):
+		versionError = GitVersionError(self.name)
+		if versionError is not None:
+			raise Exception(versionError)
+		self.graph = graph
+		self.head = None
+		self.reader = GitObjectReader(GitExecutable)
+		# merge-tree learned to take strategy options in git 2.40. Before that, conflicting hunks are resolved in favour of theirs afterwards.
+		self.mergeTreeTakesStrategyOptions = GetGitVersion() >= (2, 40)
+
+	def Start(self, dest_branch, start_point, track=False):
+		self.head = RunGitCommandWithErrorCheck(["rev-parse", "--verify", start_point + "^{commit}"], "Failed to resolve {0}".format(start_point), silent=True).strip()
+
+	def Head(self):
+		return self.head
+
+	def Tree(self, commit):
+		tree = self.reader.Tree(commit)
+		if tree is None:
+			raise Exception("Failed to retrieve tree of {0}".format(commit))
+		return tree
+
+	def CommitTree(self, tree, parents, message, author=None):
+		# author is (name, email, date); date may be None to use the current time, as 'git commit' would
+		env = None
+		if author is not None:
+			(name, email, date) = author
+			env = {'GIT_AUTHOR_NAME': name, 'GIT_AUTHOR_EMAIL': email}
+			if date is not None:
+				env['GIT_AUTHOR_DATE'] = date
+		args = ["commit-tree", tree]
+		for parent in parents:
+			args += ["-p", parent]
+		return RunGitCommandWithErrorCheck(args, "Failed to create commit for tree {0}".format(tree), silent=True, input=message, env=env, mergeStderr=False).strip()
+
+	def ReadCommit(self, commit):
+		# Returns (tree, parents, (name, email, date), message) of an existing commit
+		details = self.reader.CommitHeaders(commit)
+		if details is None:
+			raise Exception("Failed to read commit {0}".format(commit))
+		(sha, headers, message) = details
+		tree = None
+		parents = []
+		author = None
+		for (name, value) in headers:
+			if name == 'tree':
+				tree = value
+			elif name == 'parent':
+				parents.append(value)
+			elif name == 'author':
+				(identity, _, date) = value.partition('> ')
+				(authorName, _, authorEmail) = identity.partition(' <')
+				author = (authorName, authorEmail, date)
+		return (tree, parents, author, message)
+
+	def ResolveTo(self, revision, message=None, author=None):
+		# Make a commit (if there are any changes) that makes the destination branch match revision. Returns True if a commit was made.
+		# The commit has the subject and author of revision, unless message and author (name, email) are given.
+		tree = self.Tree(revision)
+		if tree == self.Tree(self.head):
+			return False
+		# As with 'git commit --author', only the name and email are taken from revision, and the message is just its subject
+		if message is None:
+			message = self.graph.Subject(revision) + '\n'
+		if author is None:
+			author = (self.graph.Author(revision), self.graph.Email(revision))
+		self.head = self.CommitTree(tree, [self.head], message, author + (None,))
+		return True
+
+	def CherryPick(self, revision, prediction=None):
+		# The equivalent of 'cherry-pick --allow-empty --strategy-option=theirs', including resolving deleted/modified
+		# conflicts by deleting the file. Returns True if a commit was made. lastOutcome is set to what happened (see ConflictPrediction.py).
+		# prediction is the (outcome, paths, head tree, tree) worked out by ConflictPrediction, if any. If it was worked out from
+		# the current head tree, it is what PickTree would return, so its tree is committed without merging again.
+		(revisionTree, parents, author, message) = self.ReadCommit(revision)
+		headTree = self.Tree(self.head)
+		self.lastPredicted = prediction is not None and prediction[2] == headTree
+		if self.lastPredicted:
+			(outcome, paths, predictedHeadTree, tree) = prediction
+		else:
+			(outcome, paths, tree) = self.PickTree(revision, revisionTree, parents, headTree)
+		self.lastOutcome = outcome
+		if outcome in ('conflict', 'noop'):
+			print "WARNING: Failed to cherry pick revision {0}. This is probably due to the same commit existing in multiple branches that were merged together.".format(revision)
+			if len(paths) > 0:
+				print "Unresolved files:"
+				for path in paths:
+					print "\t" + path
+			return False
+		if outcome == 'delete-modify':
+			print "Resolving deleted files:"
+			for path in paths:
+				print "\t" + path
+		self.head = self.CommitTree(tree, [self.head], message, author)
+		return True
+
+	def PickTree(self, revision, revisionTree, parents, headTree):
+		# The tree that cherry-picking revision (whose tree and parents are given) onto headTree makes. Returns (outcome, paths, tree),
+		# where outcome is one of ConflictPrediction.Outcomes, and paths are the unresolved or deleted files of a 'conflict' or 'delete-modify'.
+		# A 'conflict' or 'noop' makes no commit, so its tree is headTree.
+		baseTree = self.Tree(parents[0]) if len(parents) > 0 else EmptyTree
+		if revisionTree == baseTree:
+			# An empty commit is kept, because of --allow-empty
+			return ('empty', [], headTree)
+		(tree, unresolved, deleted) = self.MergeOntoHead(revision, parents[0] if len(parents) > 0 else None, headTree)
+		if tree is None:
+			return ('conflict', unresolved, headTree)
+		if tree == headTree:
+			return ('noop', [], headTree)
+		if len(deleted) > 0:
+			return ('delete-modify', deleted, tree)
+		return ('clean', [], tree)
+
+	def MergeOntoHead(self, revision, base, headTree):
+		# Merge the changes made by revision (relative to base) onto headTree. Returns (tree, unresolved paths, deleted paths); tree is None if
+		# any conflicts could not be resolved. Files deleted on ours and modified by revision are resolved by deleting them.
+		# merge-tree merges two commits using their merge base, so make a temporary commit of headTree whose parent is base.
+		# Then the merge base of that commit and revision is base, and the merge is exactly what cherry-pick would do.
+		ours = self.CommitTree(headTree, [base] if base is not None else [], "flatten\n")
+		args = ["merge-tree", "--write-tree", "-z"]
+		if self.mergeTreeTakesStrategyOptions:
+			args += ["-X", "theirs"]
+		if base is None:
+			args += ["--allow-unrelated-histories"]
+		(code, output) = RunGitCommand(args + [ours, revision], silent=True, returnerrorcode=True, mergeStderr=False)
+		if code not in (0, 1):
+			raise Exception("Failed to merge revision {0}".format(revision))
+		records = output.split('\0')
+		tree = records[0]
+		if code == 0:
+			return (tree, [], [])
+		# Conflicted file info, as "<mode> <object> <stage>\t<path>", up to an empty record
+		stages = {}
+		order = []
+		for record in records[1:]:
+			if len(record) == 0:
+				break
+			(info, path) = record.split('\t', 1)
+			(mode, sha, stage) = info.split(' ')
+			if path not in stages:
+				stages[path] = {}
+				order.append(path)
+			stages[path][int(stage)] = (mode, sha)
+		indexInfo = []
+		unresolved = []
+		deleted = []
+		for path in order:
+			entry = stages[path]
+			if 1 in entry and 3 in entry and 2 not in entry:
+				# Deleted on ours and modified on theirs ("DU"): resolve by deleting
+				deleted.append(path)
+				indexInfo.append("0 {0}\t{1}".format(NullHash, path))
+			elif 2 in entry and 3 in entry:
+				# Both sides changed the file: merge the contents, favouring theirs where hunks conflict
+				(mode, sha) = self.MergeBlobs(entry.get(1), entry[2], entry[3])
+				indexInfo.append("0 {0}\t{1}".format(NullHash, path))
+				indexInfo.append("{0} {1} 0\t{2}".format(mode, sha, path))
+			else:
+				unresolved.append(path)
+		if len(unresolved) > 0:
+			return (None, unresolved, [])
+		return (self.UpdateTree(tree, indexInfo), [], deleted)
+
+	def MergeBlobs(self, base, ours, theirs):
+		# Each of base, ours and theirs is (mode, sha); base may be None. Returns the merged (mode, sha).
+		(oursMode, oursSha) = ours
+		(theirsMode, theirsSha) = theirs
+		# Symlinks and submodules can't be merged by content, and a mode change is taken from theirs
+		if oursMode != theirsMode or theirsMode in ("120000", "160000"):
+			return theirs
+		temps = []
+		try:
+			for blob in [ours, base, theirs]:
+				with tempfile.NamedTemporaryFile(mode='wb', delete=False) as f:
+					if blob is not None:
+						f.write(self.reader.ReadObject(blob[1])[1])
+					temps.append(f.name)
+			(code, merged) = RunGitCommand(["merge-file", "-p", "--theirs"] + temps, silent=True, returnerrorcode=True, mergeStderr=False)
+		finally:
+			for temp in temps:
+				os.remove(temp)
+		if code != 0:
+			# Binary files can't be merged, and recursive -Xtheirs takes their version
+			return theirs
+		sha = RunGitCommandWithErrorCheck(["hash-object", "-w", "--stdin"], "Failed to write merged blob", silent=True, input=merged, mergeStderr=False).strip()
+		return (theirsMode, sha)
+
+	def UpdateTree(self, tree, indexInfo):
+		# Apply index-info lines to tree using a temporary index, and return the new tree
+		if len(indexInfo) == 0:
+			return tree
+		(handle, indexFile) = tempfile.mkstemp(suffix=".index")
+		os.close(handle)
+		os.remove(indexFile)
+		env = {'GIT_INDEX_FILE': indexFile}
+		try:
+			RunGitCommandWithErrorCheck(["read-tree", tree], "Failed to read tree {0}".format(tree), silent=True, env=env)
+			RunGitCommandWithErrorCheck(["update-index", "-z", "--index-info"], "Failed to update temporary index", silent=True, input='\0'.join(indexInfo) + '\0', env=env)
+			return RunGitCommandWithErrorCheck(["write-tree"], "Failed to write tree", silent=True, env=env, mergeStderr=False).strip()
+		finally:
+			if os.path.exists(indexFile):
+				os.remove(indexFile)
+
+	def Reuse(self, commit):
+		self.head = commit
+
+	def AmendMessage(self, source_branch, revision):
+		# Replace the head commit with one that has the source branch/revision added to its message, as ModifyLastCommitMessage does
+		(tree, parents, author, message) = self.ReadCommit(self.head)
+		subject = ' '.join(message.split('\n\n', 1)[0].strip('\n').split('\n'))
+		self.head = self.CommitTree(tree, parents, subject + '\n\n' + FormatSourceTrailer(source_branch, revision) + '\n', author)
+
+	def UpdateBranch(self, dest_branch):
+		RunGitCommandWithErrorCheck(["update-ref", "refs/heads/" + dest_branch, self.head], "Failed to update {0}".format(dest_branch))
+
+	def Publish(self, dest_branch, force=False):
+		self.UpdateBranch(dest_branch)
+		PushDestBranch(dest_branch, force)
+
+def ParseFastExport(stream):
+	# Yields (original oid, author line, message, changes) for each commit in the output of 'git fast-export --no-data --show-original-ids'.
+	# changes is a list of ('M', mode, sha, path), ('D', None, None, path) and ('deleteall', None, None, None), with unquoted paths.
+	commit = None
+	position = 0
+	while position < len(stream):
+		end = stream.find('\n', position)
+		if end < 0:
+			end = len(stream)
+		line = stream[position:end]
+		position = end + 1
+		if line.startswith("data "):
+			size = int(line[5:])
+			data = stream[position:position + size]
+			position += size
+			if commit is not None:
+				commit['message'] = data
+		elif commit is not None and line.startswith("original-oid "):
+			commit['oid'] = line[13:]
+		elif commit is not None and line.startswith("author "):
+			commit['author'] = line[7:]
+		elif commit is not None and line.startswith("M "):
+			(mode, sha, path) = line[2:].split(' ', 2)
+			commit['changes'].append(('M', mode, sha, UnquotePath(path)))
+		elif commit is not None and line.startswith("D "):
+			commit['changes'].append(('D', None, None, UnquotePath(line[2:])))
+		elif commit is not None and line == "deleteall":
+			commit['changes'].append(('deleteall', None, None, None))
+		elif line.startswith("commit "):
+			if commit is not None:
+				yield (commit['oid'], commit['author'], commit['message'], commit['changes'])
+			commit = {'oid': None, 'author': None, 'message': '', 'changes': []}
+		elif line == "" or line.split(' ')[0] in ("reset", "tag", "feature", "progress", "done", "blob"):
+			# The end of a commit
+			if commit is not None:
+				yield (commit['oid'], commit['author'], commit['message'], commit['changes'])
+			commit = None
+	if commit is not None:
+		yield (commit['oid'], commit['author'], commit['message'], commit['changes'])
+
+def UnquotePath(path):
+	# Paths with unusual characters are quoted C-style
+	if path.startswith('"') and path.endswith('"'):
+		return path[1:-1].decode('string_escape')
+	return path
+
+def QuotePath(path):
+	# fast-import needs a path to be quoted if it starts with a quote or contains a line feed
+	if not path.startswith('"') and '\n' not in path:
+		return path
+	quoted = ''
+	for c in path:
+		if c in '"\\':
+			quoted += '\\' + c
+		elif c == '\n':
+			quoted += '\\n'
+		elif ord(c) < 32:
+			quoted += '\\{0:03o}'.format(ord(c))
+		else:
+			quoted += c
+	return '"' + quoted + '"'
+
+def ListTree(commit):
+	# Returns {path: (mode, sha)} for every file (and submodule) in the tree of commit
+	tree = {}
+	for record in StreamGitCommand(["ls-tree", "-r", "-z", "--full-tree", commit]):
+		if len(record) > 0:
+			(info, path) = record.split('\t', 1)
+			(mode, kind, sha) = info.split(' ')
+			tree[path] = (mode, sha)
+	return tree
+
+class BulkEngine(PlumbingEngine):
+	# Replays a whole range in one go: 'git fast-export --no-data' lists the files changed by every revision (by blob hash,
+	# without their contents), a linear history is worked out in memory, and a single 'git fast-import' writes it to the
+	# destination branch. Each cherry-picked revision sets the files it changed to its versions of them, which is what
+	# cherry-picking with 'theirs' does for conflicting files, but without merging changes to different parts of a file; the
+	# last merge and the last commit are still resolved to the source trees, so the flattened branch ends up the same.
+	# The per-revision methods (used for the start of a branch) are those of PlumbingEngine.
+	name = "bulk"
+	bulk = True
+	# Replaying is cheap enough that a much larger range can be replayed commit by commit before the history is dropped
+	MaxCommitsToCherryPick = 10000
+
+	def Replay(self, dest_branch, source_branch, previous_commit, current_commit, revisions, lastMerge, lastCommit):
+		# revisions is in the order they are to be applied. Returns the (source revision, flattened commit) mappings, as FlattenGit's loop would,
+		# and leaves dest_branch (and Head) at the last commit made, with the source branch and revision in its message.
+		stream = RunGitCommandWithErrorCheck(["fast-export", "--no-data", "--reference-excluded-parents", "--show-original-ids", "--signed-tags=strip", "--reencode=yes",
+			"{0}..{1}".format(previous_commit, current_commit)], "Failed to export {0}..{1}".format(previous_commit, current_commit), silent=True, mergeStderr=False)
+		exported = dict((oid, (author, message, changes)) for (oid, author, message, changes) in ParseFastExport(stream))
+		# The committer, and the date used for resolves, as 'git commit' would
+		committer = RunGitCommandWithErrorCheck(["var", "GIT_COMMITTER_IDENT"], "Failed to find the committer identity", silent=True, mergeStderr=False).strip()
+		now = ' '.join(committer.split(' ')[-2:])
+		tree = ListTree(self.head)
+		# (revision, author line, message, changes) for each commit to be made
+		commits = []
+		skipped = 0
+		for revision in revisions:
+			if self.graph.IsMerge(revision) and revision != lastMerge:
+				continue
+			if revision == lastMerge or revision == lastCommit:
+				target = ListTree(revision)
+				changes = [('D', None, None, path) for path in sorted(tree) if path not in target]
+				changes += [('M', mode, sha, path) for (path, (mode, sha)) in sorted(target.items()) if tree.get(path) != (mode, sha)]
+				if len(changes) > 0:
+					commits.append((revision, "{0} <{1}> {2}".format(self.graph.Author(revision), self.graph.Email(revision), now), self.graph.Subject(revision) + '\n', changes))
+				tree = target
+				continue
+			(author, message, exportedChanges) = exported[revision]
+			changes = []
+			for (op, mode, sha, path) in exportedChanges:
+				if op == 'deleteall':
+					changes += [('D', None, None, existing) for existing in sorted(tree)]
+					tree = {}
+				elif op == 'D':
+					# A path that isn't a file is a directory, all of whose files are deleted
+					removed = [path] if path in tree else [existing for existing in tree if existing.startswith(path + '/')]
+					for existing in removed:
+						del tree[existing]
+					changes += [('D', None, None, existing) for existing in removed]
+				elif tree.get(path) != (mode, sha):
+					tree[path] = (mode, sha)
+					changes.append((op, mode, sha, path))
+			if len(changes) == 0 and len(exportedChanges) > 0:
+				# As with cherry-pick, a revision whose changes are all already there makes no commit
+				skipped += 1
+				continue
+			commits.append((revision, author, message, changes))
+		if skipped > 0:
+			print "{0} revisions made no changes, as they were already on {1}".format(skipped, dest_branch)
+		if len(commits) == 0:
+			return []
+		# The last commit made stands for the last revision too, and names it (as AmendMessage does)
+		(revision, author, message, changes) = commits[-1]
+		subject = ' '.join(message.split('\n\n', 1)[0].strip('\n').split('\n'))
+		commits[-1] = (revision, author, subject + '\n\n' + FormatSourceTrailer(source_branch, revisions[-1]) + '\n', changes)
+
+		output = []
+		for (mark, (revision, author, message, changes)) in enumerate(commits, 1):
+			output.append("commit refs/heads/{0}\nmark :{1}\nauthor {2}\ncommitter {3}\ndata {4}\n{5}\n".format(dest_branch, mark, author, committer, len(message), message))
+			if mark == 1:
+				output.append("from {0}\n".format(self.head))
+			for (op, mode, sha, path) in changes:
+				if op == 'D':
+					output.append("D {0}\n".format(QuotePath(path)))
+				else:
+					output.append("M {0} {1} {2}\n".format(mode, sha, QuotePath(path)))
+			output.append("\n")
+		output.append("done\n")
+		(handle, marksFile) = tempfile.mkstemp(suffix=".marks")
+		os.close(handle)
+		try:
+			RunGitCommandWithErrorCheck(["fast-import", "--quiet", "--force", "--done", "--export-marks=" + marksFile], "Failed to import the flattened commits", silent=True, input=''.join(output))
+			with open(marksFile, 'r') as f:
+				marks = dict(line.split() for line in f if len(line.strip()) > 0)
+		finally:
+			os.remove(marksFile)
+		mappings = [(revision, marks[":{0}".format(mark)]) for (mark, (revision, author, message, changes)) in enumerate(commits, 1)]
+		self.head = mappings[-1][1]
+		if mappings[-1][0] != revisions[-1]:
+			mappings.append((revisions[-1], self.head))
+		print "Replayed {0} revisions as {1} commits".format(len(revisions), len(commits))
+		return mappings
+
+Engines = dict((engine.name, engine) for engine in [WorktreeEngine, PlumbingEngine, BulkEngine])
+
+def GitVersionError(engine):
+	# Returns why the named engine can't be used with the installed git, or None if it can
+	minimum = Engines[engine].MinimumGitVersion
+	if minimum is None or GetGitVersion() >= minimum:
+		return None
+	return "The {0} engine needs git {1} or later, for 'merge-tree --write-tree'; this is git {2}".format(engine, ".".join(str(part) for part in minimum), ".".join(str(part) for part in GetGitVersion()))
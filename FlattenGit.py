@@ -11,6 +11,31 @@
 #	--current-commit=<hash>			The current commit that we're flattening up to.
 #	--branch=<branch>				The name of the branch being flattened. "develop" will be flattened to "teamcity/develop"
 #	--working-repo=<location>		The git repo to work within. e.g. E:\Flatten\Project
+#	--branches <branch> ...			Flatten several branches (TeamCity names or source branch wildcards) concurrently, with one fetch and one atomic push
+#	--jobs=<count>					How many of the --branches to flatten at once
+#	--lookup-source=<hash>			Print the source commit of a flattened commit, from the index kept in the working repo (see FlattenIndex.py)
+#	--lookup-flattened=<hash>		Print the flattened commit(s) of a source commit (restricted to --branch, if given)
+#	--segment-squash=<never|over-limit|always>	Squash the commits between merges into one commit each ('over-limit': only above --maxCommitsToCherryPick)
+#	--time-budget=<seconds>			Collapse the remaining revisions into one commit once applying them individually would overrun this budget
+#	--engine=<worktree|plumbing|bulk>	How to build the flattened commits. 'plumbing' never checks out any files; 'bulk' replays the whole range with one fast-export and fast-import (see FlattenEngines.py). Both need git 2.38 or later
+#	--no-batch						Start git for every read-only query, instead of answering them over persistent cat-file processes (see GitBatch.py)
+#	--partial-clone					Make a new working repo a blob-less partial clone, which only downloads the files of the revisions that are replayed
+#	--clone-depth=<count>			Make a new working repo a shallow clone; more history is fetched when the previous commit isn't reached
+#	--object-cache=<location>		A bare repo shared by the working repos on the agent, which is fetched into first and whose objects the working repo borrows
+#	--maintenance					Run repository maintenance (commit-graph, incremental repack, bitmaps) on the working repo and its object cache, and exit (see GitMaintenance.py)
+#	--background-maintenance		After flattening, start maintenance in a low priority background process (at most every --maintenance-interval seconds)
+#	--trace=<file>					Record every git command (phase, duration, exit status, output size) to a JSON-lines file, and print a summary (see GitTrace.py)
+#	--teamcity-statistics			Report the git command timings to TeamCity as build statistics
+#	--no-skip-applied				Try to cherry-pick every revision, even those whose change is already on the destination branch (see PatchIdIndex.py)
+#	--verify						Check that the head of teamcity/<branch> has the same tree as its source revision, without a checkout, and exit (see FlattenVerify.py)
+#	--verify-history				As --verify, for every flattened head in the history of teamcity/<branch>
+#	--predict-conflicts				Work out how each revision will cherry-pick with in-memory merges before replaying, apply them instead of cherry-picking where that saves work, and report them against the outcomes (see ConflictPrediction.py)
+#	--no-reuse						Don't reuse flattened commits from identical earlier replays (see ReplayCache.py), or start a new branch from the flattened history of a related one
+#	--performance-profile=<default|fast>	Apply the index settings (untracked cache, split index, index v4, fsmonitor, ...) of this profile to the working repo (see GitPerformance.py)
+#	--sparse-exclude <pattern> ...	Leave these directories out of the working repo's checkout
+#	--worktree-dir=<location>		Put the working repo's working tree here instead, e.g. on a tmpfs
+#	--concurrent-network			Fetch from both remotes and list the teamcity heads at the same time, start replaying once the source revisions are fetched, and index while pushing (see NetworkPhase.py)
+#	--lock-timeout=<seconds>		How long to wait for another job on the same agent to release the working repo or the branch (see RepoLock.py)
 
 # This script works on a separate check out folder from the repo which it is running from. If this repo doesn't exist yet, it will start by creating it.
 # In this separate check out folder, the following steps are taken:
@@ -22,9 +47,9 @@
 #	* else
 #		* create branch origin/teamcity/<branch> based on the HEAD of origin/<branch> [git checkout -b teamcity/<branch> origin/<branch> --no-track]
 #	****
-#   * list all revisions between <previous-commit> and <current-commit>: [git log <previous-commit>..<current-commit> --format=format:%H]
+#   * load all revisions between <previous-commit> and <current-commit>, with their parents, authors and subjects: [CommitGraph.LoadCommitGraph]
 #	* for each revision in the reverse of this list:
-#		* if the revision has more than 1 (generally 2) parents, it is a merge. [GitFunctions.CountParentsOfCommit(revision) > 1]
+#		* if the revision has more than 1 (generally 2) parents, it is a merge. [graph.IsMerge(revision)]
 #			* if this is the LAST merge:
 #				* record the current revision, to return to in a sec.
 #				* hard reset to this revision in the source branch [git reset --hard <revision>]
@@ -38,198 +63,750 @@
 import sys
 import os
 import re
-from GitFunctions import RunGitCommand, RunGitCommandWithErrorCheck, CountParentsOfCommit, PrepareGitWorkingFolder
-import argparse
-import tempfile
-import urllib2
-import base64
-from xml.etree import ElementTree
-
-def ModifyLastCommitMessage(source_branch, revision):
-	# Modify the last commit message to include the source branch/revision.
-	head = RunGitCommandWithErrorCheck(["log", "-n", "1", "HEAD", "--format=%H"], "Failed to retrieve current head revision").replace('\n','')
-	message = RunGitCommandWithErrorCheck(["log", "-n", "1", head, '--format=%s'], "Failed to retrieve commit message for revision {0}".format(revision))
-	with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
-		f.write(message)
-		# Write out the source revision number, for TeamCity to use to label the build, etc.
-		f.write('\nbranch: {0}, revision: {1}\n\n'.format(source_branch, revision))
-		temp = f.name
-	RunGitCommandWithErrorCheck(["commit", "--amend", "--file={0}".format(temp)], "Failed to amend commit message to include source branch and revision")
-
-def FlattenGit(current_commit, branch, working_repo, max_commits_to_cherry_pick=100):
-	# Before doing ANYTHING else git-related, disable the auto Garbage Collection. This takes ages to do nothing, and this is a good way of getting this setting onto all of the TeamCity agents.
-	RunGitCommand(["config", "--global", "gc.auto", "0"])
+from GitFunctions import RunGitCommand, RunGitCommandWithErrorCheck, PrepareGitWorkingFolder, GetOriginBranches, IsShallowRepository, GetShallowCommits, DeepenUntil, IsPartialClone, PrefetchChangedBlobs, GetGitVersion
+from CommitGraph import LoadCommitGraph
+from FlattenEngines import Engines, WorktreeEngine, PlumbingEngine, BulkEngine, ModifyLastCommitMessage, PushArgs, GitVersionError
+from FlattenIndex import FlattenIndex, ResolveCommit
+from FlattenCheckpoint import FlattenCheckpoint
+from PatchIdIndex import PatchIdIndex, PatchIds, Applied
+from GitTrace import StartTrace, SetPhase
+from GitMaintenance import RunMaintenance, StartBackgroundMaintenance, DefaultInterval
+from RepoLock import RepoLock, DefaultTimeout
+from FlattenVerify import VerifyHead, VerifyHistory
+from ConflictPrediction import PredictConflicts, PrintReport
+from ReplayCache import ReplayCache, NoCommit
+from GitPerformance import Profiles, MakeProfile
+from NetworkPhase import NetworkPhase
+import GitFunctions
+import time
+import fnmatch
+import traceback
+
+def FlattenGit(current_commit, branch, working_repo, max_commits_to_cherry_pick=100, engine="worktree", prepare=True, publish=True, remote_heads=None, segment_squash="never", time_budget=None, partial_clone=False, clone_depth=None, object_cache=None, skip_applied=True, predict_conflicts=False, prediction_jobs=None, reuse=True, performance_profile=None, concurrent_network=False, locks=True, lock_timeout=DefaultTimeout):
+	# Returns (dest_branch, head, force, mappings) for the commit that was (or, if publish is False, needs to be) pushed, or None if there was nothing to push.
+	# With locks, the branch is locked for the whole flatten, and the working repo while its shared state is used (see RepoLock.py),
+	# so that other jobs on the agent can use the same working repo. Without, the caller is responsible for locking (see FlattenBranches).
+	options = dict(max_commits_to_cherry_pick=max_commits_to_cherry_pick, engine=engine, prepare=prepare, publish=publish, remote_heads=remote_heads, segment_squash=segment_squash,
+		time_budget=time_budget, partial_clone=partial_clone, clone_depth=clone_depth, object_cache=object_cache, skip_applied=skip_applied,
+		predict_conflicts=predict_conflicts, prediction_jobs=prediction_jobs, reuse=reuse, performance_profile=performance_profile,
+		network=StartNetworkPhase() if concurrent_network and prepare else None)
+	if not locks:
+		return _FlattenGitReplayingIfMoved(current_commit, branch, working_repo, None, options)
+	repoLock = RepoLock(working_repo, "repo", lock_timeout)
+	with RepoLock(working_repo, "branch-teamcity/" + branch, lock_timeout):
+		try:
+			return _FlattenGitReplayingIfMoved(current_commit, branch, working_repo, repoLock, options)
+		finally:
+			while repoLock.count > 0:
+				repoLock.Release()
+
+class RemoteHeadMoved(Exception):
+	# Raised by ConfirmRemoteHead when a flatten was replayed onto a flattened head that is no longer the head of the branch
+	def __init__(self, heads):
+		Exception.__init__(self, "The flattened branch has moved on")
+		self.heads = heads
 
+def _FlattenGitReplayingIfMoved(current_commit, branch, working_repo, repoLock, options):
+	# Run _FlattenGit, and if it replayed onto a flattened head that had moved on by the time it was fetched (see NetworkPhase.py), replay again from the new head
+	network = options['network']
+	try:
+		return _FlattenGit(current_commit, branch, working_repo, repoLock=repoLock, **options)
+	except RemoteHeadMoved as e:
+		network.Finish()
+		if repoLock is not None:
+			while repoLock.count > 0:
+				repoLock.Release()
+		# Everything has been fetched by now
+		return _FlattenGit(current_commit, branch, working_repo, repoLock=repoLock, **dict(options, prepare=False, remote_heads=e.heads, network=None))
+	finally:
+		if network is not None:
+			network.Finish()
+
+def _FlattenGit(current_commit, branch, working_repo, max_commits_to_cherry_pick, engine, prepare, publish, remote_heads, segment_squash, time_budget, partial_clone, clone_depth, object_cache, skip_applied, predict_conflicts, prediction_jobs, reuse, performance_profile, network, repoLock):
+	startTime = time.time()
 	source_branch = branch
 	dest_branch = "teamcity/"+branch
 	previous_commit = None
+	usesWorkingTree = engine == WorktreeEngine.name
+
+	SetPhase("prepare")
+	if repoLock is not None:
+		repoLock.Acquire()
+	if prepare:
+		# Before doing ANYTHING else git-related, disable the auto Garbage Collection. This takes ages to do nothing, and this is a good way of getting this setting onto all of the TeamCity agents.
+		RunGitCommand(["config", "--global", "gc.auto", "0"])
+
+		# First, prepare the working folder, which is a git repo
+		PrepareGitWorkingFolder(working_repo, branch=source_branch, add_teamcity_remote=True, default_email="noreply@company.com", default_name="TeamCity", reset_working_copy=usesWorkingTree, partial_clone=partial_clone, clone_depth=clone_depth, object_cache=object_cache, performance_profile=performance_profile, network=network)
+	else:
+		# The working folder (e.g. a worktree created by FlattenBranches) has already been prepared and fetched
+		os.chdir(working_repo)
+		if usesWorkingTree:
+			RunGitCommandWithErrorCheck(["reset", "--hard"], "Failed to hard reset")
 
-	# First, prepare the working folder, which is a git repo
-	PrepareGitWorkingFolder(working_repo, branch=source_branch, add_teamcity_remote=True, default_email="noreply@company.com", default_name="TeamCity")
+	if usesWorkingTree:
+		# Abort any active cherry-picks
+		RunGitCommand(["cherry-pick", "--abort"])
 
-	# Abort any active cherry-picks
-	RunGitCommand(["cherry-pick", "--abort"])
+	flattener = Engines[engine]()
 
-	heads = RunGitCommandWithErrorCheck(["ls-remote", "--heads", "teamcity"], "Unable to list remote heads")
+	SetPhase("lookup")
+	heads = remote_heads
+	# The flattened head that the replay starts from before the network steps have finished, if any
+	speculativeHead = None
+	if heads is None and network is not None:
+		network.Start("ls-remote", ["ls-remote", "--heads", "teamcity"], "Unable to list remote heads")
+		speculativeHead = SpeculativeRemoteHead(network, dest_branch, current_commit)
+		if speculativeHead is None:
+			network.WaitAll()
+			heads = network.Wait("ls-remote")
+	elif heads is None:
+		heads = RunGitCommandWithErrorCheck(["ls-remote", "--heads", "teamcity"], "Unable to list remote heads")
+	index = FlattenIndex()
 	# Check whether the destination branch already exists on the remote.
-	if  "\trefs/heads/teamcity/{0}\n".format(branch) in heads:
-		# Checkout the current state of the destination branch, over-writing any existing local branch of the same name
-		RunGitCommandWithErrorCheck(["checkout", "-B", dest_branch, "teamcity/"+dest_branch], "Checkout failed")
-		# Get the latest commit message of this branch, in order to get the correct previous commit hash. Note that there are now >1 Flatten Git jobs, so this is the only reliable method.
-		commitMessage = RunGitCommandWithErrorCheck(["log", "-1", "--pretty=%B"], "Log failed")
-		print "Previous commit message:"
-		print commitMessage
-		p = re.compile("revision: ([a-f0-9]+)")
-		revisions = p.findall(commitMessage)
-		numFound = len(revisions)
-		if numFound > 0:
-			previous_commit = revisions[numFound-1]
+	remoteHead = None
+	if speculativeHead is not None:
+		remoteHead = speculativeHead
+		previous_commit = index.SourceOf(remoteHead)
+		print "Previous commit: {0} (flattened as {1}, as of the last fetch; replaying while fetching)".format(previous_commit, remoteHead)
+	elif "\trefs/heads/teamcity/{0}\n".format(branch) in heads:
+		# Look up the source commit of the current state of the destination branch, which doesn't need a checkout.
+		# If it isn't in the index, it's taken from the latest commit message. Note that there are now >1 Flatten Git jobs, so the remote branch is the only reliable starting point.
+		remoteHead = RunGitCommandWithErrorCheck(["rev-parse", "--verify", "teamcity/{0}^{{commit}}".format(dest_branch)], "Unable to find teamcity/{0}".format(dest_branch), silent=True).strip()
+		previous_commit = index.SourceOf(remoteHead)
+		print "Previous commit: {0} (flattened as {1})".format(previous_commit, remoteHead)
+	# The flattened commit to start from. While the teamcity fetch may still be updating the remote-tracking branch, it is the hash.
+	startPoint = "teamcity/" + dest_branch if speculativeHead is None else speculativeHead
+	if remoteHead is None and reuse:
+		# A new branch (e.g. a new alpha branch) usually shares most of its history with a branch that is already flattened.
+		# Rather than starting it as a copy of the source history, start from the nearest ancestor of the current commit that has
+		# been flattened, and replay the rest as usual.
+		nearest = index.NearestFlattened(current_commit, max_commits_to_cherry_pick)
+		if nearest is not None:
+			(previous_commit, startPoint, relatedBranch) = nearest
+			print "Starting {0} from {1}, the flattened commit of {2} on {3}".format(dest_branch, startPoint, previous_commit, relatedBranch)
 
 	revisions = None
+	graph = None
+	squashSegments = segment_squash == "always"
+	if previous_commit is not None and IsShallowRepository():
+		# A shallow working repo needs enough history to reach the previous commit, and to list the revisions since then without running into the shallow boundary
+		DeepenUntil(lambda: HistoryReaches(previous_commit, current_commit))
 	if previous_commit is not None:
 		# Check whether the previous revision is actually an ancestor of the current revision.
 		(code,output) = RunGitCommand(["merge-base", "--is-ancestor", previous_commit, current_commit], returnerrorcode=True)
 		if code == 0:
 			# The current commit is indeed a descendent of the previous commit
-			# Now get the list of revisions that we need to apply
-			revisionList = RunGitCommandWithErrorCheck(["log", "{0}..{1}".format(previous_commit, current_commit), "--format=%H"], "Failed to retrieve log of changes between {0} and {1}".format(previous_commit, current_commit))
-			revisions = revisionList.split('\n')[:-1]
+			# Now load the revisions that we need to apply, along with their parents and metadata, in a single git call
+			graph = LoadCommitGraph(previous_commit, current_commit)
+			revisions = graph.revisions[:]
 			# Limit the number of revisions to cherry-pick. Above a certain amount, no time is saved by cherry-picking to a flat branch, as the cherry-picking can take too long
 			num_commits = len(revisions)
 			if num_commits > max_commits_to_cherry_pick:
-				print "{0} commits is too many to cherry pick".format(num_commits)
-				revisions = None
+				if segment_squash == "over-limit":
+					print "{0} commits is too many to cherry pick, so squashing the commits between merges".format(num_commits)
+					squashSegments = True
+				else:
+					print "{0} commits is too many to cherry pick".format(num_commits)
+					revisions = None
 			else:
 				print "{0} (<{1}) commits to cherry pick".format(num_commits, max_commits_to_cherry_pick)
 
+	SetPhase("replay")
+	copyFrom = current_commit
+	if revisions is not None and len(revisions) == 0 and remoteHead is None:
+		# A new branch whose current commit has already been flattened on another branch starts as a copy of that flattened commit
+		copyFrom = startPoint
+		revisions = None
 	if revisions is None:
-		# The remote branch does not exist, or so checkout the previous commit, and push it to the remote as the destination branch
-		RunGitCommandWithErrorCheck(["checkout", "-B", dest_branch, current_commit, "--no-track"], "Checkout failed")
+		# The remote branch does not exist, or so start from the current commit, and push it to the remote as the destination branch
+		flattener.Start(dest_branch, copyFrom)
 		# Amend last commit message to include the source branch and commit
-		ModifyLastCommitMessage(source_branch, current_commit)
+		flattener.AmendMessage(source_branch, current_commit)
 		# Force-push, in case the branch already existed (which will be the case if there were too many commits)
-		RunGitCommandWithErrorCheck(["push", "--force", "--set-upstream", "teamcity", dest_branch], "Failed to set upstream branch")
+		mappings = [(current_commit, flattener.Head())]
+		ConfirmRemoteHead(network, branch, speculativeHead)
+		SetPhase("publish")
+		if repoLock is not None:
+			repoLock.Acquire()
+		if publish:
+			flattener.Publish(dest_branch, force=True)
+			index.Record(mappings, dest_branch)
+		else:
+			flattener.UpdateBranch(dest_branch)
+		return (dest_branch, flattener.Head(), True, mappings)
 
 	# If there is nothing to do, just return, as TeamCity would ignore empty commits.
-	if revisions is None or len(revisions) == 0:
-		return
+	if len(revisions) == 0:
+		ConfirmRemoteHead(network, branch, speculativeHead)
+		return None
 
+	flattener.graph = graph
 	# Find the last merge revision (this list is about to be reversed, so this is the first one found in the list)
-	lastMerge = None
-	for revision in revisions:
-		if CountParentsOfCommit(revision) > 1:
-			lastMerge = revision
-			break
+	lastMerge = graph.LastMerge()
 	lastCommit = revisions[0]
+	if not squashSegments and IsPartialClone():
+		# Download the files that the cherry-picks will need in one go (resolves only need the whole tree, for the worktree engine)
+		PrefetchChangedBlobs([revision for revision in revisions if not graph.IsMerge(revision) and revision != lastCommit])
+	if flattener.bulk and not squashSegments:
+		# The whole range is replayed at once (see FlattenEngines.BulkEngine), which is quick enough not to need a checkpoint or time budget
+		flattener.Start(dest_branch, startPoint)
+		if repoLock is not None and (network is None or network.Done()):
+			repoLock.Release()
+		mappings = flattener.Replay(dest_branch, source_branch, previous_commit, current_commit, list(reversed(revisions)), lastMerge, lastCommit)
+		ConfirmRemoteHead(network, branch, speculativeHead)
+		if len(mappings) == 0:
+			return None
+		SetPhase("publish")
+		if repoLock is not None:
+			repoLock.Acquire()
+		if publish:
+			flattener.Publish(dest_branch)
+			index.Record(mappings, dest_branch)
+		else:
+			flattener.UpdateBranch(dest_branch)
+		return (dest_branch, flattener.Head(), False, mappings)
+	# The patch-ids of the revisions, and of the changes already on the destination branch. A revision whose change is
+	# already there (e.g. it also came in through another merged branch) would cherry-pick to nothing, so it is skipped.
+	# The patch-ids of the reversed diffs of the revisions are those of the changes that they revert, which are no longer there.
+	patchIndex = None
+	sourcePatchIds = {}
+	sourceRevertedIds = {}
+	presentPatchIds = set()
+	skippedCount = 0
+	if skip_applied and not squashSegments:
+		patchIndex = PatchIdIndex(dest_branch)
+		patchIndex.Update(remoteHead)
+		presentPatchIds = set(patchIndex.patchIds)
+		sourcePatchIds = PatchIds(["{0}..{1}".format(previous_commit, current_commit)])
+		sourceRevertedIds = PatchIds(["{0}..{1}".format(previous_commit, current_commit)], reverse=True)
 	# Go through the list of revisions, applying each one to dest_branch
 	revisions.reverse()
 	commitsMade = False
-	for revision in revisions:
-		resolveToRevision = False
-		# Check whether this is a merge. If it is the last merge, resolve all changes to this revision. All other merges are ignored.
-		if CountParentsOfCommit(revision) > 1:
-			# If this is the last merge, do something, otherwise, do nothing
-			if revision == lastMerge:
-				resolveToRevision = True
-			else:
-				continue
-		# On the last commit in the list, also resolve this way, to ensure that the result is the same as the source branch
-		if revision == lastCommit:
-			resolveToRevision = True
-		if resolveToRevision:
-			# Get the current head commit, to reset back to
-			head = RunGitCommandWithErrorCheck(["log", "-n", "1", "HEAD", "--format=%H"], "Failed to retrieve current head revision").replace('\n','')
-			# Hard reset to the merge commit.
-			RunGitCommandWithErrorCheck(["reset", "--hard", revision], "Failed to reset to source branch")
-			# Soft reset back to the destination branch
-			RunGitCommandWithErrorCheck(["reset", "--soft", head], "Failed to reset back to destination branch")
-			# Commit the index (unless it is empty, except for the last commit).
-			filesInIndex = False
-			fileList = RunGitCommandWithErrorCheck(["status", "--porcelain"], "Failed to check the index")
-			files = fileList.split('\n')[:-1]
-			# If a line starts with an 'A', 'M' or 'D' then a file has been added, modified or deleted in the index.
-			# If it starts with a space, then it has been added or deleted but not in the index.
-			# If it starts with '??' then it is a new file that has not been added.
-			for file in files:
-				if file[0] != ' ' and file[0] != '?':
-					filesInIndex = True
-			if filesInIndex:
-				# Retrieve the commit message and author details
-				message = RunGitCommandWithErrorCheck(["log", "-n", "1", revision, '--format=%s'], "Failed to retrieve commit message for revision {0}".format(revision))
-				author = RunGitCommandWithErrorCheck(["log", "-n", "1", revision, '--format=%an'], "Failed to retrieve commit author for revision {0}".format(revision)).replace('\n', '')
-				email = RunGitCommandWithErrorCheck(["log", "-n", "1", revision, '--format=%ae'], "Failed to retrieve commit author email for revision {0}".format(revision)).replace('\n', '')
-				# Write the message out to a file, to retain any linebreaks or quotation marks
-				with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
-					f.write(message)
-					temp = f.name
-				RunGitCommandWithErrorCheck(["commit", "--author='{0} <{1}>'".format(author, email), "--file={0}".format(temp)], "Failed to commit flattened merge")
-				os.remove(temp)
-				commitsMade = True
+	# (source revision, flattened commit) for each commit made
+	mappings = []
+	startPosition = 0
+	checkpoint = FlattenCheckpoint(dest_branch)
+	mode = "squash" if squashSegments else "pick"
+	state = checkpoint.Resume(previous_commit, current_commit, remoteHead, revisions, mode)
+	if state is not None:
+		# Carry on from where a previous run of the same flatten got to
+		flattener.Start(dest_branch, state['head'])
+		startPosition = state['position']
+		commitsMade = state['commitsMade']
+		mappings = [tuple(mapping) for mapping in state['mappings']]
+		for (source, flattened) in mappings:
+			Applied(presentPatchIds, source, sourcePatchIds, sourceRevertedIds)
+	else:
+		# Start from the current state of the destination branch, over-writing any existing local branch of the same name
+		flattener.Start(dest_branch, startPoint, track=remoteHead is not None and speculativeHead is None)
+	head = (remoteHead or startPoint) if state is None else state['head']
+	# Replays of the same revision onto the same flattened commit, e.g. on a related branch, are reused. Squashed segments aren't, as their messages depend on the whole segment.
+	replayCache = ReplayCache() if reuse and not squashSegments else None
+	# How each revision to be cherry-picked is expected to apply, and how it actually did
+	predictions = {}
+	outcomes = {}
+	if predict_conflicts and not squashSegments:
+		predictions = PredictConflicts(graph, revisions[startPosition:-1], head, lastMerge, prediction_jobs, sourcePatchIds, presentPatchIds, sourceRevertedIds)
+	predictionsUsed = 0
+	# In segment-squash mode, the single-parent revisions since the last merge, which will be squashed into one commit
+	segment = []
+	# With a time budget, the time spent applying revisions is used to estimate the cost of the rest. Once they won't
+	# fit in the budget, the remaining revisions are collapsed into the resolve of the last commit.
+	# Segment-squash mode already costs one commit per merge, so the budget only applies when picking individual revisions.
+	budget = TimeBudget(time_budget if not squashSegments else None, startTime)
+	# The plumbing engine only adds objects and updates dest_branch, so other jobs can use the working repo while it replays,
+	# once any fetches still running in the background have finished
+	releaseAfterNetwork = repoLock is not None and not usesWorkingTree
+	for position in range(startPosition, len(revisions)):
+		if releaseAfterNetwork and (network is None or network.Done()):
+			repoLock.Release()
+			releaseAfterNetwork = False
+		revision = revisions[position]
+		if revision != lastCommit and budget.ShouldCollapse(len(revisions) - position):
+			applied = False
+			if not budget.collapsed:
+				print "Out of time: collapsing the remaining {0} revisions into one commit".format(len(revisions) - position)
+			budget.Collapse()
+		elif squashSegments:
+			# Each merge (and the last commit) ends a segment. The segment's single-parent commits are squashed into one
+			# commit that resolves to the end of the segment, so the cost depends on the number of merges, not commits.
+			if not graph.IsMerge(revision):
+				segment.append(revision)
+				if revision != lastCommit:
+					continue
+			(message, author) = SquashedSegmentMessage(graph, segment, revision)
+			segment = []
+			applied = flattener.ResolveTo(revision, message, author)
+		elif graph.IsMerge(revision) and revision != lastMerge:
+			# All merges are ignored, except for the last merge
+			applied = False
+		elif revision == lastMerge or revision == lastCommit:
+			# On the last merge and the last commit in the list, resolve all changes to this revision, to ensure that the result is the same as the source branch
+			# Hard reset to this revision, soft reset back, and commit the difference
+			applied = ReplayWithCache(flattener, replayCache, 'resolve', revision, head, lambda: flattener.ResolveTo(revision))
+		elif sourcePatchIds.get(revision) in presentPatchIds:
+			print "Skipping {0}, whose change is already on {1}".format(revision, dest_branch)
+			applied = False
+			skippedCount += 1
+			outcomes[revision] = 'noop'
 		else:
-			# Only one parent, and not the last commit, so cherry-pick this revision, using conflict-resolution strategy "theirs".
-			# If any conflicts actually arose, they will be resolved later by the last merge.
-			# This call may fail if the commit made no changes, so do not use RunGitCommandsWithErrorCheck
-			success, output = RunGitCommand(["cherry-pick", "--allow-empty", "--strategy=recursive", "--strategy-option=theirs", revision])
-			if not success:
-				# It could be that "DU" (deleted/unresolved) changes exist. A file was deleted on ours and modified on theirs. Find all such files and resolve manually by deleting
-				status = RunGitCommandWithErrorCheck(["status", "--porcelain"], "Cannot retrieve status after failed cherry-pick").split('\n')[:-1]
-				resolvedDeletedFiles = False
-				otherUnresolvedFiles = False
-				for fileStatus in status:
-					if fileStatus[1] == 'U':
-						if fileStatus[0] == 'D':
-							if not resolvedDeletedFiles:
-								print "Resolving deleted files:"
-							RunGitCommandWithErrorCheck(["rm", fileStatus[3:]], "Failed to remove {0}".format(fileStatus[3:]))
-							resolvedDeletedFiles = True
-						else:
-							otherUnresolvedFiles = True
-				if otherUnresolvedFiles:
-					print "WARNING: Could not resolve some files. Check output:"
-					print output
-				if resolvedDeletedFiles:
-					# Retrieve the commit message and author details
-					message = RunGitCommandWithErrorCheck(["log", "-n", "1", revision, '--format=%s'], "Failed to retrieve commit message for revision {0}".format(revision))
-					author = RunGitCommandWithErrorCheck(["log", "-n", "1", revision, '--format=%an'], "Failed to retrieve commit author for revision {0}".format(revision)).replace('\n', '')
-					email = RunGitCommandWithErrorCheck(["log", "-n", "1", revision, '--format=%ae'], "Failed to retrieve commit author email for revision {0}".format(revision)).replace('\n', '')
-					# Write the message out to a file, to retain any linebreaks or quotation marks
-					with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
-						f.write(message)
-						temp = f.name
-					(success, output) = RunGitCommand(["commit", "--author='{0} <{1}>'".format(author, email), "--file={0}".format(temp)])
-					if not success:
-						print "Failed to commit resolved cherry-pick"
-						RunGitCommandWithErrorCheck(["cherry-pick", "--abort"], "Failed to abort failed cherry-pick")
-					os.remove(temp)
-			if success:
-				commitsMade = True
-			else:
-				print "WARNING: Failed to cherry pick revision {0}; check output below. This is probably due to the same commit existing in multiple branches that were merged together.".format(revision)
-				# Assume that this failed because that change was already in this branch (which would be sorted out by a subsequent merge) so print output for logging and reset
-				print output
-				RunGitCommandWithErrorCheck(["cherry-pick", "--abort"], "Failed to abort cherry-pick", printstdout=True)
+			# Cherry-pick with "theirs"; any conflicts that arise will be resolved later by the last merge
+			flattener.lastOutcome = None
+			flattener.lastPredicted = False
+			applied = ReplayWithCache(flattener, replayCache, 'pick', revision, head, lambda: flattener.CherryPick(revision, predictions.get(revision)))
+			if flattener.lastOutcome is not None:
+				outcomes[revision] = flattener.lastOutcome
+			if flattener.lastPredicted:
+				predictionsUsed += 1
+			if applied:
+				Applied(presentPatchIds, revision, sourcePatchIds, sourceRevertedIds)
+		budget.Applied(applied)
+		if applied:
+			commitsMade = True
+			head = flattener.Head()
+			mappings.append((revision, head))
+		# Record how far we've got, so that this can be resumed if the run dies
+		checkpoint.Save({'dest_branch': dest_branch, 'mode': mode, 'previous_commit': previous_commit, 'current_commit': current_commit, 'remote_head': remoteHead,
+			'revisions': len(revisions), 'position': position + 1, 'last_revision': revision, 'head': head, 'commitsMade': commitsMade, 'mappings': mappings})
 	
-	# Only push this if there were some changes to push
-	if commitsMade:
-		ModifyLastCommitMessage(source_branch, revision)
-	
-		# Finally, push any pending changes.
-		RunGitCommandWithErrorCheck(["push", "teamcity", dest_branch], "Failed to push")
+	if budget.seconds is not None:
+		print "{0} revisions applied individually, {1} collapsed into the last commit".format(budget.appliedCount, budget.collapsedCount)
+	if skippedCount > 0:
+		print "{0} revisions skipped, as their changes were already on {1}".format(skippedCount, dest_branch)
+	if len(predictions) > 0:
+		PrintReport(predictions, outcomes, predictionsUsed)
+	if replayCache is not None and replayCache.hits > 0:
+		print "{0} revisions reused from earlier identical replays, {1} replayed".format(replayCache.hits, replayCache.misses)
+
+	ConfirmRemoteHead(network, branch, speculativeHead)
+	# Only push this if there were some changes to push (or it is a new branch)
+	if not commitsMade and remoteHead is not None:
+		checkpoint.Clear()
+		return None
+	revision = revisions[-1]
+	flattener.AmendMessage(source_branch, revision)
+	# Amending replaced the last commit made, which now also stands for the last revision
+	head = flattener.Head()
+	if len(mappings) > 0:
+		(lastSource, lastFlattened) = mappings.pop()
+		if lastSource != revision:
+			mappings.append((lastSource, head))
+	mappings.append((revision, head))
+
+	# Finally, push any pending changes.
+	SetPhase("publish")
+	if repoLock is not None:
+		repoLock.Acquire()
+	if publish and network is not None:
+		# Index the patch-ids of the new commits while they are pushed
+		flattener.UpdateBranch(dest_branch)
+		network.Start("push", PushArgs(dest_branch), "Failed to push")
+		if patchIndex is not None:
+			patchIndex.Update(flattener.Head())
+		network.Wait("push")
+		index.Record(mappings, dest_branch)
+		checkpoint.Clear()
+	elif publish:
+		flattener.Publish(dest_branch)
+		index.Record(mappings, dest_branch)
+		if patchIndex is not None:
+			patchIndex.Update(flattener.Head())
+		checkpoint.Clear()
+	else:
+		flattener.UpdateBranch(dest_branch)
+	return (dest_branch, flattener.Head(), False, mappings)
+
+def StartNetworkPhase():
+	# Running fetches at the same time needs them not to write FETCH_HEAD
+	if GetGitVersion() < (2, 29):
+		print "Running the network steps one at a time, as running them concurrently needs git 2.29 or later"
+		return None
+	return NetworkPhase()
+
+def SpeculativeRemoteHead(network, dest_branch, current_commit):
+	# The head of dest_branch as of the last fetch, to replay onto while the teamcity fetch and ls-remote are running, or None if
+	# the replay has to wait for them. The replay needs the source revisions, so this waits for the origin fetch unless
+	# current_commit is already in the working repo. Shallow and partial clones fetch more during the replay, which mustn't
+	# run at the same time as the background fetches, so they always wait.
+	if IsShallowRepository() or IsPartialClone():
+		return None
+	success, output = RunGitCommand(["rev-parse", "--verify", "--quiet", "refs/remotes/teamcity/{0}^{{commit}}".format(dest_branch)], silent=True, noWarningDialog=True)
+	if not success:
+		return None
+	success, unused = RunGitCommand(["cat-file", "-e", current_commit + "^{commit}"], silent=True, noWarningDialog=True)
+	if not success:
+		network.Wait("fetch origin")
+	return output.strip()
+
+def ConfirmRemoteHead(network, branch, speculativeHead):
+	# Before publishing a replay onto speculativeHead (see SpeculativeRemoteHead), wait for the network steps, and raise
+	# RemoteHeadMoved if the remote branch is no longer at that head.
+	if speculativeHead is None:
+		return
+	network.WaitAll()
+	heads = network.Wait("ls-remote")
+	if RemoteHeadOf(heads, "teamcity/" + branch) != speculativeHead:
+		print "teamcity/{0} is no longer at {1}, so replaying again from its current head".format(branch, speculativeHead)
+		raise RemoteHeadMoved(heads)
+
+def RemoteHeadOf(heads, dest_branch):
+	# The hash of dest_branch in the output of 'ls-remote --heads', or None if it isn't there
+	for line in heads.split('\n'):
+		if line.endswith("\trefs/heads/" + dest_branch):
+			return line.split('\t')[0]
+	return None
+
+def ReplayWithCache(flattener, replayCache, operation, revision, parent, replay):
+	# Reuse the result of an identical earlier replay of revision onto parent (see ReplayCache.py), or call replay and remember
+	# what it made. Returns True if a commit was made.
+	if replayCache is None:
+		return replay()
+	cached = replayCache.Lookup(operation, revision, parent)
+	if cached == NoCommit:
+		return False
+	if cached is not None:
+		flattener.Reuse(cached)
+		return True
+	applied = replay()
+	replayCache.Record(operation, revision, parent, flattener.Head() if applied else None)
+	return applied
+
+def HistoryReaches(previous_commit, current_commit):
+	# Whether the previous commit is present, and the history between it and the current commit doesn't reach the boundary of a shallow repo
+	success, output = RunGitCommand(["cat-file", "-e", previous_commit + "^{commit}"], silent=True, noWarningDialog=True)
+	if not success:
+		return False
+	success, output = RunGitCommand(["rev-list", "{0}..{1}".format(previous_commit, current_commit)], silent=True, noWarningDialog=True)
+	return success and len(GetShallowCommits().intersection(output.split())) == 0
+
+class TimeBudget(object):
+	# Tracks how long applying revisions takes, to decide when the rest should be collapsed to stay within a time budget
+	def __init__(self, seconds, startTime):
+		self.seconds = seconds
+		self.startTime = startTime
+		self.lastTime = time.time()
+		self.applyTime = 0.0
+		self.appliedCount = 0
+		self.collapsedCount = 0
+		self.collapsed = False
+
+	def ShouldCollapse(self, remaining):
+		# remaining includes the revision about to be applied, and the last commit (which is always resolved)
+		if self.collapsed:
+			return True
+		if self.seconds is None or self.appliedCount == 0:
+			return False
+		estimate = remaining * self.applyTime / self.appliedCount
+		return time.time() - self.startTime + estimate > self.seconds
+
+	def Collapse(self):
+		self.collapsed = True
+		self.collapsedCount += 1
+		self.lastTime = time.time()
+
+	def Applied(self, applied):
+		# Called after each revision that was not collapsed. Revisions that were skipped (e.g. merges) count towards the cost too.
+		now = time.time()
+		if not self.collapsed:
+			self.applyTime += now - self.lastTime
+			self.appliedCount += 1
+		self.lastTime = now
+
+def SquashedSegmentMessage(graph, segment, endRevision):
+	# Returns (message, (author, email)) for a commit that squashes the single-parent revisions in segment, ending at endRevision
+	if len(segment) == 0:
+		# A merge straight after another merge
+		return (graph.Subject(endRevision) + '\n', (graph.Author(endRevision), graph.Email(endRevision)))
+	last = segment[-1]
+	if len(segment) == 1:
+		return (graph.Subject(last) + '\n', (graph.Author(last), graph.Email(last)))
+	message = "{0} (and {1} other commit{2})\n\n".format(graph.Subject(last), len(segment) - 1, "s" if len(segment) > 2 else "")
+	for revision in segment:
+		message += "* {0} ({1})\n".format(graph.Subject(revision), graph.Author(revision))
+	authors = []
+	for revision in segment:
+		author = "{0} <{1}>".format(graph.Author(revision), graph.Email(revision))
+		if author not in authors:
+			authors.append(author)
+	message += "\nAuthors: {0}\n".format(", ".join(authors))
+	return (message, (graph.Author(last), graph.Email(last)))
+
+def LookupCommits(working_repo, flattened=None, source=None, branch=None):
+	# Query the source<->flattened index of working_repo in either direction, printing the results
+	os.chdir(working_repo)
+	index = FlattenIndex()
+	if flattened is not None:
+		flattened = ResolveCommit(flattened)
+		source = index.SourceOf(flattened)
+		if source is None:
+			print "No source commit found for {0}".format(flattened)
+			return False
+		print source
+	elif source is not None:
+		source = ResolveCommit(source)
+		entries = index.FlattenedOf(source, "teamcity/" + branch if branch is not None else None)
+		if len(entries) == 0:
+			print "No flattened commit found for {0}".format(source)
+			return False
+		for (dest_branch, commit) in entries:
+			print "{0} {1}".format(commit, dest_branch)
+	return True
+
+def VerifyBranch(working_repo, branch, history=False, lock_timeout=DefaultTimeout):
+	# Compare the tree of teamcity/<branch> (or, with history, of every flattened head in its history) with its source revision
+	os.chdir(working_repo)
+	dest_branch = "teamcity/" + branch
+	with RepoLock(working_repo, "repo", lock_timeout):
+		RunGitCommandWithErrorCheck(["fetch", "--no-tags", "teamcity", "+refs/heads/{0}:refs/remotes/teamcity/{0}".format(dest_branch)], "Could not fetch {0}".format(dest_branch), silent=True)
+	head = RunGitCommandWithErrorCheck(["rev-parse", "--verify", "refs/remotes/teamcity/{0}^{{commit}}".format(dest_branch)], "Unable to find teamcity/{0}".format(dest_branch), silent=True).strip()
+	index = FlattenIndex()
+	if history:
+		return VerifyHistory(head, index)
+	return VerifyHead(head, index)
+
+def _FlattenBranchWorker(job):
+	# Runs in a pool process: flatten one branch in its own worktree, without pushing
+	# Pool processes are reused, so the git commands traced by this job are passed back to be included in the summary
+	(branch, current_commit, worktree, options) = job
+	start = time.time()
+	if GitFunctions.Trace is not None:
+		GitFunctions.Trace.records = []
+	try:
+		# The parent process holds the locks
+		result = FlattenGit(current_commit, branch, worktree, prepare=False, publish=False, locks=False, **options)
+		error = None
+	except Exception:
+		result = None
+		error = traceback.format_exc()
+	return (branch, result, error, time.time() - start, GitFunctions.Trace.records if GitFunctions.Trace is not None else [])
+
+def FlattenBranches(branches, working_repo, jobs=None, **options):
+	# Flatten several branches in one go. branches are TeamCity branch names or, for branches that TeamCity doesn't rename,
+	# wildcard patterns of source branch names (e.g. 'beta*'). Everything is fetched once, the branches are flattened
+	# concurrently in separate worktrees of working_repo (which share its object store), and all of the updated
+	# teamcity/* branches are pushed in a single atomic push. options are passed on to FlattenGit.
+	start = time.time()
+	lockTimeout = options.pop('lock_timeout', DefaultTimeout)
+	repoLock = RepoLock(working_repo, "repo", lockTimeout)
+	branchLocks = []
+	# The branches are flattened with prepare=False, so only the fetches, ls-remote and push here are run concurrently
+	network = StartNetworkPhase() if options.get('concurrent_network') else None
+	try:
+		return _FlattenBranches(branches, working_repo, jobs, start, repoLock, branchLocks, lockTimeout, network, options)
+	finally:
+		if network is not None:
+			network.Finish()
+		while repoLock.count > 0:
+			repoLock.Release()
+		for lock in branchLocks:
+			lock.Release()
+
+def _FlattenBranches(branches, working_repo, jobs, start, repoLock, branchLocks, lockTimeout, network, options):
+	SetPhase("prepare")
+	repoLock.Acquire()
+	RunGitCommand(["config", "--global", "gc.auto", "0"])
+	# With no branch, everything is fetched from both remotes
+	PrepareGitWorkingFolder(working_repo, add_teamcity_remote=True, default_email="noreply@company.com", default_name="TeamCity", reset_working_copy=False, partial_clone=options.get('partial_clone', False), clone_depth=options.get('clone_depth'), object_cache=options.get('object_cache'), performance_profile=options.get('performance_profile'), network=network)
+	if network is not None:
+		network.Start("ls-remote", ["ls-remote", "--heads", "teamcity"], "Unable to list remote heads")
+	# A branch can only be checked out in one worktree, so don't leave one checked out here
+	RunGitCommand(["checkout", "--detach"], silent=True)
+	if network is not None:
+		# The branches to flatten are found from the fetched origin branches
+		network.WaitAll()
+		heads = network.Wait("ls-remote")
+	else:
+		heads = RunGitCommandWithErrorCheck(["ls-remote", "--heads", "teamcity"], "Unable to list remote heads")
+	originBranches = RunGitCommandWithErrorCheck(["for-each-ref", "--format=%(refname:strip=3)", "refs/remotes/origin"], "Unable to list origin branches", silent=True).split('\n')[:-1]
+
+	# Work out which commit each branch is being flattened up to
+	targets = []
+	# The TeamCity branch names are all looked up in the branchSpec in one go
+	mapped = GetOriginBranches([pattern for pattern in branches if not any(c in pattern for c in "*?[")])
+	for pattern in branches:
+		if any(c in pattern for c in "*?["):
+			targets += [(originBranch, originBranch) for originBranch in fnmatch.filter(originBranches, pattern) if originBranch != "HEAD"]
+		else:
+			targets.append((pattern, mapped[pattern] if mapped[pattern] is not None else pattern))
+	profile = options.get('performance_profile')
+	# The worktrees go next to the working tree, so on a tmpfs if it is
+	worktreeRoot = (profile.worktree_dir if profile is not None and profile.worktree_dir is not None else os.path.abspath(working_repo)) + "-worktrees"
+	# Lock the branches, always in the same order, and without holding the working repo lock, so that jobs can't deadlock
+	repoLock.Release()
+	for branch in sorted(set(branch for (branch, originBranch) in targets)):
+		lock = RepoLock(working_repo, "branch-teamcity/" + branch, lockTimeout)
+		lock.Acquire()
+		branchLocks.append(lock)
+	repoLock.Acquire()
+	poolJobs = []
+	seen = set()
+	for (branch, originBranch) in targets:
+		if branch in seen:
+			continue
+		seen.add(branch)
+		current_commit = RunGitCommandWithErrorCheck(["rev-parse", "--verify", "refs/remotes/origin/{0}^{{commit}}".format(originBranch)], "Unable to find origin/{0}".format(originBranch), silent=True).strip()
+		worktree = PrepareWorktree(worktreeRoot, branch)
+		if profile is not None:
+			# Each worktree has its own sparse-checkout
+			profile.ApplySparseCheckout(worktree)
+		poolJobs.append((branch, current_commit, worktree, dict(options, remote_heads=heads)))
+	if len(poolJobs) == 0:
+		print "No branches match {0}".format(" ".join(branches))
+		return False
+
+	# Each branch is replayed in its own worktree, so other jobs can use the working repo meanwhile
+	repoLock.Release()
+	import multiprocessing
+	pool = multiprocessing.Pool(jobs or min(len(poolJobs), multiprocessing.cpu_count()))
+	try:
+		results = pool.map(_FlattenBranchWorker, poolJobs)
+	finally:
+		pool.close()
+		pool.join()
+	os.chdir(working_repo)
+	if GitFunctions.Trace is not None:
+		for result in results:
+			GitFunctions.Trace.records += result[4]
+	results = [result[:4] for result in results]
+
+	# Push every branch that changed in one atomic push, so that TeamCity never sees a partial set of updates
+	refspecs = []
+	for (branch, result, error, duration) in results:
+		if result is not None:
+			(dest_branch, head, force, mappings) = result
+			refspecs.append("{0}refs/heads/{1}:refs/heads/{1}".format("+" if force else "", dest_branch))
+	pushDuration = 0
+	SetPhase("publish")
+	repoLock.Acquire()
+	if len(refspecs) > 0:
+		pushStart = time.time()
+		pushArgs = ["push", "--atomic", "teamcity"] + refspecs
+		if network is not None:
+			network.Start("push", pushArgs, "Failed to push")
+		else:
+			RunGitCommandWithErrorCheck(pushArgs, "Failed to push", printstdout=True)
+		# (With the push running in the background, the patch-ids of the new commits are indexed while they are pushed)
+		for (branch, result, error, duration) in results:
+			if result is not None and options.get('skip_applied', True) and not result[2]:
+				PatchIdIndex(result[0]).Update(result[1])
+		if network is not None:
+			network.Wait("push")
+			pushDuration = network.tasks["push"].end - network.tasks["push"].start
+		else:
+			pushDuration = time.time() - pushStart
+		index = FlattenIndex()
+		for (branch, result, error, duration) in results:
+			if result is not None:
+				index.Record(result[3], result[0])
+				FlattenCheckpoint(result[0]).Clear()
+
+	print "Branch timings:"
+	failed = False
+	for (branch, result, error, duration) in results:
+		if error is not None:
+			failed = True
+			status = "FAILED"
+		elif result is None:
+			status = "no changes"
+		else:
+			status = "force-pushed" if result[2] else "pushed"
+		print "\t{0:<40} {1:>8.1f}s  {2}".format(branch, duration, status)
+		if error is not None:
+			print error
+	print "\t{0:<40} {1:>8.1f}s".format("(push)", pushDuration)
+	print "\t{0:<40} {1:>8.1f}s".format("(total)", time.time() - start)
+	return not failed
+
+def PrepareWorktree(worktreeRoot, branch):
+	# Each branch gets its own worktree, which is kept between runs so that its checkout stays warm
+	worktree = os.path.join(worktreeRoot, re.sub(r"[^A-Za-z0-9._-]", "_", branch))
+	if not os.path.exists(os.path.join(worktree, ".git")):
+		RunGitCommand(["worktree", "prune"], silent=True)
+		RunGitCommandWithErrorCheck(["worktree", "add", "--force", "--detach", "--no-checkout", worktree], "Unable to create worktree {0}".format(worktree))
+	return worktree
 
 
 def main():
+	# argparse is only needed when run from the command line
+	import argparse
 	parser = argparse.ArgumentParser(description='Maintain a flattened version of a development branch in Git.')
 	parser.add_argument('--current-commit', default=None, help='The current commit that we are flattening up to.')
-	parser.add_argument('--branch', default='develop', help='The development branch (e.g. develop) that we are flattening')
+	parser.add_argument('--branch', default=None, help='The development branch (e.g. develop) that we are flattening')
 	parser.add_argument('--working-repo', default=r'E:\Flatten\Project', help='The disk location of the working repo. This should be separate to any active build folders.')
 	parser.add_argument('--tc-server', default='', help='The URL of the TeamCity server (project-tc.rw), used to find the previous commit hash.')
 	parser.add_argument('--tc-buildid', default='', help='The build configuration ID of the TeamCity configuration being used (ProjectContinuousBuilds_FlattenGit_FlattenGit), used to find the previous commit hash')
 	parser.add_argument('--tc-username', default='', help='The username to login with in TeamCity, used to find the previous commit hash')
 	parser.add_argument('--tc-password', default='', help='The password to login with in TeamCity, used to find the previous commit hash')
-	parser.add_argument('--maxCommitsToCherryPick', default=100, type=int, help='The maximum number of commits to cherry pick. If exceeded, the TeamCity branch will just be a copy of the source branch (with the last commit modified to include the source commit and branch)')
+	parser.add_argument('--maxCommitsToCherryPick', default=None, type=int, help='The maximum number of commits to cherry pick. If exceeded, the TeamCity branch will just be a copy of the source branch (with the last commit modified to include the source commit and branch). Defaults to 100, or {0} for the bulk engine.'.format(BulkEngine.MaxCommitsToCherryPick))
+	parser.add_argument('--branches', nargs='+', default=None, help="Flatten several branches concurrently instead of --branch/--current-commit, flattening each up to the head of its source branch and pushing them all atomically. Each is a TeamCity branch name, or a wildcard pattern of source branch names (e.g. 'beta*').")
+	parser.add_argument('--jobs', default=None, type=int, help='The number of branches to flatten at once with --branches, and of processes for --predict-conflicts. Defaults to the number of CPUs.')
+	parser.add_argument('--lookup-source', default=None, metavar='FLATTENED', help='Print the source commit that a flattened commit was made from, using the index in the working repo, and exit.')
+	parser.add_argument('--lookup-flattened', default=None, metavar='SOURCE', help='Print the flattened commit(s) made from a source commit (on --branch, if given), using the index in the working repo, and exit.')
+	parser.add_argument('--segment-squash', default='never', choices=['never', 'over-limit', 'always'], help="Squash each run of single-parent commits between merges into one commit, instead of cherry-picking every commit. 'over-limit' only does this when there are more than maxCommitsToCherryPick commits, instead of dropping the history.")
+	parser.add_argument('--time-budget', default=None, type=float, metavar='SECONDS', help='Keep applying revisions individually while the estimated time to apply the rest fits within this many seconds (from the start of the run). Once it does not, the remaining revisions are collapsed into one commit that resolves to the current commit.')
+	parser.add_argument('--engine', default=WorktreeEngine.name, choices=sorted(Engines.keys()), help="How to build the flattened commits. 'worktree' cherry-picks in a checked out working tree; 'plumbing' builds the same trees in the object database without checking anything out; 'bulk' replays the whole range with one fast-export and one fast-import, applying whole files rather than merging them.")
+	parser.add_argument('--no-batch', dest='batch', action='store_false', help='Start git for every read-only query (object types, commit headers, parents, tree ids), instead of answering them over persistent cat-file processes.')
+	parser.add_argument('--partial-clone', action='store_true', help='Make a new working repo a blob-less partial clone, which only fetches the requested branches, and only downloads the files of the revisions that are replayed.')
+	parser.add_argument('--clone-depth', default=None, type=int, help='Make a new working repo a shallow clone with this much history. More history is fetched as needed to reach the previous commit.')
+	parser.add_argument('--object-cache', default=None, help='A bare repo shared by all of the working repos on the agent. It is fetched into first, and the working repo borrows its objects, so that they are only downloaded and stored once.')
+	parser.add_argument('--maintenance', action='store_true', help='Run repository maintenance (commit-graph, incremental repack and bitmaps) on the working repo and the object caches it uses, and exit.')
+	parser.add_argument('--background-maintenance', action='store_true', help='After flattening, start repository maintenance in a low priority background process, so that it runs between jobs.')
+	parser.add_argument('--maintenance-interval', default=DefaultInterval, type=float, help='Only maintain a repo if it has not been maintained for this many seconds.')
+	parser.add_argument('--trace', default=None, metavar='FILE', help='Record every git command (its phase, duration, exit status and output size) to this JSON-lines file, and print a summary of the timings at the end.')
+	parser.add_argument('--teamcity-statistics', action='store_true', help='Report the timings of the git commands to TeamCity as build statistics (buildStatisticValue service messages).')
+	parser.add_argument('--no-skip-applied', dest='skip_applied', action='store_false', help='Try to cherry-pick every revision, instead of skipping those whose change (by patch-id) is already on the destination branch.')
+	parser.add_argument('--verify', action='store_true', help='Check that the head of the flattened --branch has the same tree as the source revision it was made from (without checking anything out), list any differing paths, and exit.')
+	parser.add_argument('--verify-history', action='store_true', help='As --verify, but check every commit in the history of the flattened branch that was pushed as its head, in one batch.')
+	parser.add_argument('--predict-conflicts', action='store_true', help='Before replaying, work out which revisions will apply cleanly, hit delete/modify conflicts or make no changes, and the trees they leave, using chains of in-memory merges across --jobs processes. The engines apply them instead of cherry-picking where that saves work (see ConflictPrediction.py), and the predictions are reported against the actual outcomes.')
+	parser.add_argument('--no-reuse', dest='reuse', action='store_false', help='Replay every revision, instead of reusing the flattened commits of identical earlier replays (on any branch), and start a new branch as a copy of its source history, instead of from the flattened history of a related branch.')
+	parser.add_argument('--performance-profile', default=None, choices=sorted(Profiles.keys()), help="Apply these index settings to the working repo, to speed up resets and status over a large checkout. 'fast' turns on index preloading, the untracked cache, the split index, index version 4 and a filesystem monitor (if there is one); 'default' turns them off again.")
+	parser.add_argument('--sparse-exclude', nargs='+', default=None, metavar='PATTERN', help="Leave the directories matching these wildcard patterns (e.g. 'Content/Movies') out of the working repo's checkout, e.g. large assets that the flatten doesn't need to look at. The flattened commits still include them.")
+	parser.add_argument('--worktree-dir', default=None, help="Put the working repo's working tree in this folder (e.g. on a tmpfs), keeping its git directory in --working-repo.")
+	parser.add_argument('--concurrent-network', action='store_true', help="Run the network steps in the background: fetch from both remotes and list the teamcity heads at the same time, start replaying (from the flattened head fetched last time) as soon as the source revisions have been fetched, and index the new commits while they are pushed. Reports how much of the network time overlapped local work.")
+	parser.add_argument('--lock-timeout', default=DefaultTimeout, type=float, metavar='SECONDS', help='How long to wait for other jobs on the agent to finish with the working repo, or with the branch being flattened.')
 	args = parser.parse_args()
+	# Fail now, rather than after fetching and when the first revision is merged
+	versionError = GitVersionError(args.engine)
+	if versionError is None and args.predict_conflicts and GitVersionError(PlumbingEngine.name) is not None:
+		versionError = "--predict-conflicts merges with the plumbing engine. " + GitVersionError(PlumbingEngine.name)
+	if versionError is not None:
+		parser.error(versionError)
+
+	trace = None
+	if args.trace is not None or args.teamcity_statistics:
+		trace = StartTrace(args.trace)
 
-	FlattenGit(args.current_commit, args.branch, args.working_repo, args.maxCommitsToCherryPick)
+	GitFunctions.UseBatchBackend = args.batch
+
+	if args.maxCommitsToCherryPick is None:
+		args.maxCommitsToCherryPick = BulkEngine.MaxCommitsToCherryPick if args.engine == BulkEngine.name else 100
+	options = {'max_commits_to_cherry_pick': args.maxCommitsToCherryPick, 'engine': args.engine, 'segment_squash': args.segment_squash, 'time_budget': args.time_budget, 'partial_clone': args.partial_clone, 'clone_depth': args.clone_depth, 'object_cache': args.object_cache, 'skip_applied': args.skip_applied, 'lock_timeout': args.lock_timeout,
+		'predict_conflicts': args.predict_conflicts, 'prediction_jobs': args.jobs, 'reuse': args.reuse,
+		'performance_profile': MakeProfile(args.performance_profile, args.sparse_exclude, args.worktree_dir), 'concurrent_network': args.concurrent_network}
+	success = True
+	try:
+		if args.maintenance:
+			RunMaintenance(args.working_repo, args.maintenance_interval)
+		elif args.verify or args.verify_history:
+			success = VerifyBranch(args.working_repo, args.branch or 'develop', history=args.verify_history, lock_timeout=args.lock_timeout)
+		elif args.lookup_source is not None or args.lookup_flattened is not None:
+			success = LookupCommits(args.working_repo, flattened=args.lookup_source, source=args.lookup_flattened, branch=args.branch)
+		elif args.branches is not None:
+			success = FlattenBranches(args.branches, args.working_repo, args.jobs, **options)
+		else:
+			FlattenGit(args.current_commit, args.branch or 'develop', args.working_repo, **options)
+		if args.background_maintenance and not args.maintenance:
+			StartBackgroundMaintenance([args.working_repo], args.maintenance_interval)
+	finally:
+		# Report the timings even if the flatten failed, as that is when they are most useful
+		if trace is not None and (len(trace.records) > 0 or len(trace.lockWaits) > 0):
+			if args.trace is not None:
+				trace.PrintSummary()
+			if args.teamcity_statistics:
+				trace.PrintTeamCityStatistics()
+	if not success:
+		sys.exit(1)
 
 if __name__ == "__main__":
     main()
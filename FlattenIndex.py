@@ -0,0 +1,103 @@
+# A persistent index mapping source commits to the flattened commits made from them, and back.
+# FlattenGit used to find the previous commit by checking out the destination branch and parsing "revision: <hash>" out of
+# its last commit message. The index answers that without a checkout, and also lets a TeamCity build's flattened commit be
+# mapped back to its source commit.
+#
+# The index is an append-only text file in the working repo's git directory (shared by all of its worktrees), with one
+# "<source> <flattened> <dest-branch>" line per mapping. Later lines take precedence over earlier ones.
+
+import os
+import re
+from GitFunctions import RunGitCommand, RunGitCommandWithErrorCheck, GetGitCommonDir, StreamGitCommand
+
+TrailerPattern = re.compile("revision: ([a-f0-9]+)")
+
+def FindSourceRevisionInMessage(message):
+	# The flattened commit message ends with "branch: <branch>, revision: <hash>" (see FlattenEngines.FormatSourceTrailer)
+	revisions = TrailerPattern.findall(message)
+	return revisions[-1] if len(revisions) > 0 else None
+
+class FlattenIndex(object):
+	def __init__(self, path=None):
+		if path is None:
+			path = os.path.join(GetGitCommonDir(), "flatten", "index")
+		self.path = path
+		self.flattenedToSource = {}
+		# Per source commit, a list of (dest_branch, flattened) in the order they were recorded
+		self.sourceToFlattened = {}
+		self.Load()
+
+	def Load(self):
+		self.flattenedToSource = {}
+		self.sourceToFlattened = {}
+		if not os.path.exists(self.path):
+			return
+		with open(self.path, 'r') as f:
+			for line in f:
+				fields = line.split()
+				if len(fields) == 3:
+					self._Add(fields[0], fields[1], fields[2])
+
+	def _Add(self, source, flattened, dest_branch):
+		self.flattenedToSource[flattened] = source
+		entries = self.sourceToFlattened.setdefault(source, [])
+		if (dest_branch, flattened) in entries:
+			entries.remove((dest_branch, flattened))
+		entries.append((dest_branch, flattened))
+
+	def Record(self, mappings, dest_branch):
+		# mappings is a list of (source, flattened) pairs
+		mappings = [(source, flattened) for (source, flattened) in mappings if self.flattenedToSource.get(flattened) != source]
+		if len(mappings) == 0:
+			return
+		directory = os.path.dirname(self.path)
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		# One write per call, so that concurrent flattens of different branches don't interleave their lines
+		with open(self.path, 'a') as f:
+			f.write(''.join("{0} {1} {2}\n".format(source, flattened, dest_branch) for (source, flattened) in mappings))
+		for (source, flattened) in mappings:
+			self._Add(source, flattened, dest_branch)
+
+	def SourceOf(self, flattened):
+		# Returns the source commit of a flattened commit. If it isn't in the index, it is read from the commit message and recorded.
+		if flattened in self.flattenedToSource:
+			return self.flattenedToSource[flattened]
+		success, message = RunGitCommand(["log", "-1", "--pretty=%B", flattened], silent=True)
+		source = FindSourceRevisionInMessage(message) if success else None
+		if source is not None:
+			self.Record([(source, flattened)], "unknown")
+		return source
+
+	def FlattenedOf(self, source, dest_branch=None):
+		# Returns the flattened commits made from source, as a list of (dest_branch, flattened), most recent last.
+		# If the index doesn't know about source, the teamcity remote's branches are searched for the trailer that names it.
+		entries = self.sourceToFlattened.get(source, [])
+		if len(entries) == 0:
+			output = RunGitCommandWithErrorCheck(["log", "--remotes=teamcity", "--format=%H", "--fixed-strings", "--grep=revision: " + source], "Failed to search the flattened branches", silent=True)
+			for line in output.split('\n'):
+				if len(line) > 0:
+					self.Record([(source, line)], "unknown")
+			entries = self.sourceToFlattened.get(source, [])
+		if dest_branch is not None:
+			entries = [entry for entry in entries if entry[0] in (dest_branch, "unknown")]
+		return entries
+
+	def NearestFlattened(self, commit, limit):
+		# Returns (source, flattened, dest_branch) for the most recent ancestor of commit (looking at no more than limit commits)
+		# that has been flattened on any branch, and whose flattened commit is in this repo, or None if there isn't one
+		records = StreamGitCommand(["rev-list", "--max-count={0}".format(limit + 1), commit], separator='\n')
+		try:
+			for source in records:
+				for (dest_branch, flattened) in reversed(self.sourceToFlattened.get(source, [])):
+					success, output = RunGitCommand(["cat-file", "-e", flattened + "^{commit}"], silent=True, noWarningDialog=True)
+					if success:
+						return (source, flattened, dest_branch)
+		finally:
+			records.close()
+		return None
+
+def ResolveCommit(commit):
+	# Expand an abbreviated hash (or any other revision) to a full hash, if this repo has it
+	success, output = RunGitCommand(["rev-parse", "--verify", "--quiet", commit + "^{commit}"], silent=True, noWarningDialog=True)
+	return output.strip() if success else commit
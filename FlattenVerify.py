@@ -0,0 +1,89 @@
+# Verification that a flattened branch has the same content as the source commits it was made from, without checking anything out.
+# Every commit of a flattened branch that FlattenGit pushed ends with the "branch: <branch>, revision: <hash>" trailer
+# (see FlattenEngines.FormatSourceTrailer), and is resolved to the tree of that source revision, so the two tree hashes must be
+# the same. Comparing them only needs the commit objects. When they differ, the differing paths are listed from a diff of the
+# two trees.
+#
+# VerifyHistory checks every such commit of a branch in one go: one 'git log' lists the flattened commits with their trees and
+# messages, and one 'git cat-file --batch-check' looks up the trees of all of their source revisions. The other flattened
+# commits (individual cherry-picks) are mapped to their source through the FlattenIndex, and counted, but as the history
+# between them is flattened, their trees are only expected to match the source's when no merged changes are missing.
+
+from GitFunctions import RunGitCommand, RunGitCommandWithErrorCheck, StreamGitCommand, StreamLogRecords
+from FlattenIndex import FlattenIndex, FindSourceRevisionInMessage
+
+# How many differing paths to list for each commit
+MaxPathsShown = 50
+
+def DifferingPaths(source, flattened):
+	# Returns a list of (status, path) for the files that differ between the trees of two commits, e.g. ('M', 'src/main.c')
+	records = StreamGitCommand(["diff-tree", "-r", "--no-renames", "--name-status", "-z", source, flattened])
+	return [(status, next(records)) for status in records if len(status) > 0]
+
+def PrintDifferences(source, flattened):
+	paths = DifferingPaths(source, flattened)
+	for (status, path) in paths[:MaxPathsShown]:
+		print "\t{0} {1}".format(status, path)
+	if len(paths) > MaxPathsShown:
+		print "\t... and {0} more".format(len(paths) - MaxPathsShown)
+
+def TreesOf(commits):
+	# Returns {commit: tree} for the commits that exist in this repo, looked up in one batch
+	if len(commits) == 0:
+		return {}
+	output = RunGitCommandWithErrorCheck(["cat-file", "--batch-check=%(objectname)"], "Failed to look up trees", silent=True, input=''.join(commit + "^{tree}\n" for commit in commits), mergeStderr=False)
+	trees = {}
+	for (commit, line) in zip(commits, output.split('\n')):
+		if not line.endswith(" missing"):
+			trees[commit] = line.strip()
+	return trees
+
+def VerifyHead(flattened, index=None):
+	# Compare the tree of a flattened commit with the tree of its source revision. Returns True if they match.
+	if index is None:
+		index = FlattenIndex()
+	source = index.SourceOf(flattened)
+	if source is None:
+		print "{0} has no source revision recorded".format(flattened)
+		return False
+	trees = TreesOf([source, flattened])
+	if source not in trees:
+		print "The source revision {0} of {1} isn't in the working repo".format(source, flattened)
+		return False
+	if trees[source] == trees[flattened]:
+		print "{0} matches its source revision {1} (tree {2})".format(flattened, source, trees[flattened])
+		return True
+	print "{0} DIFFERS from its source revision {1}:".format(flattened, source)
+	PrintDifferences(source, flattened)
+	return False
+
+def VerifyHistory(head, index=None):
+	# Verify every commit in the history of head that was pushed as the head of a flattened branch. Returns True if they all match.
+	if index is None:
+		index = FlattenIndex()
+	# (flattened, tree, source) for the commits that name their source revision, and for the rest that the index knows about
+	heads = []
+	picks = []
+	for (flattened, tree, message) in StreamLogRecords(["--first-parent", head], ['%H', '%T', '%B']):
+		source = FindSourceRevisionInMessage(message)
+		if source is not None:
+			heads.append((flattened, tree, source))
+		elif flattened in index.flattenedToSource:
+			picks.append((flattened, tree, index.flattenedToSource[flattened]))
+	sourceTrees = TreesOf(sorted(set(source for (flattened, tree, source) in heads + picks)))
+	differing = []
+	missing = 0
+	for (flattened, tree, source) in heads:
+		if source not in sourceTrees:
+			missing += 1
+		elif sourceTrees[source] != tree:
+			differing.append((flattened, source))
+	for (flattened, source) in differing:
+		print "{0} DIFFERS from its source revision {1}:".format(flattened, source)
+		PrintDifferences(source, flattened)
+	print "{0} flattened heads: {1} match their source revision, {2} differ, {3} have a source revision that isn't in the working repo".format(len(heads),
+		len(heads) - len(differing) - missing, len(differing), missing)
+	if len(picks) > 0:
+		matching = len([flattened for (flattened, tree, source) in picks if sourceTrees.get(source) == tree])
+		print "{0} of the other {1} flattened commits recorded in the index have the same tree as their source revision".format(matching, len(picks))
+	return len(differing) == 0
@@ -1,19 +1,214 @@
 # Helper script to get the current branch in Git and set the 'branch' env-var to its name
 # This tries to find the TeamCity branch that this branched from, if the branch is not built on TeamCity
 
+# json (and requests) are only imported when the branchSpec has to be read, and argparse when run from the command line, to keep startup fast
 import os
 import sys
-import json
 import re
-import argparse
-import traceback
+import time
+
+# If set, this branchSpec is used instead of the one in the GitFlatten vcs root on TeamCity (e.g. by Benchmark.py, which has no TeamCity server)
+BranchSpec = None
+
+# The vcs root that the branchSpec is read from. This can be replaced by a local stub: a file:// URL of a saved copy of the JSON, or a local server.
+VcsRootUrl = 'https://teamcity.company.com/app/rest/vcs-roots/id:GitFlatten'
+
+# The branchSpec is cached on disk, and only revalidated with TeamCity (using ETag/Last-Modified) once it is older than BranchSpecCacheTTL seconds.
+# By default (None) the cache is kept in the user's cache directory (see PackageManager.UserCacheDirectory), which is only looked up
+# when the cache is used. An empty string disables the cache.
+BranchSpecCacheFile = None
+BranchSpecCacheTTL = 300
+
+class BranchSpecMatcher(object):
+	# The '+:refs/heads/' lines of a branchSpec, compiled into one regex for each direction of look-up.
+	# The lines are tried in order, and each line's pattern can match anywhere in the branch name, as TeamCity does.
+	# activeBranches will contain a list like ['(develop)', '(beta*)', '(alpha10.6.6)', '(alpha10.6.7)', '(alpha10.6.8)', 'features/(deathcon)sequences', 'feature/wpg/(props)']
+	def __init__(self, branchSpec):
+		activeBranchPrefix = '+:refs/heads/'
+		self.activeBranches = [line[len(activeBranchPrefix):] for line in branchSpec.split('\n') if line.startswith(activeBranchPrefix)]
+		forward = []
+		reverse = []
+		for activeBranch in self.activeBranches:
+			# Convert the spec to a regex by escaping '.' and converting '*' to '.*'. The brackets will define a group in the regex.
+			forward.append(activeBranch.replace('.','\\.').replace('*','.*'))
+			if '(' in activeBranch and ')' in activeBranch:
+				# For a reverse look-up, the text within the brackets is matched against the TeamCity branch
+				(start,rest) = activeBranch.split('(')
+				(middle,end) = rest.split(')')
+				reverse.append((middle.replace('.', '\\.'), (start, end)))
+			else:
+				reverse.append((forward[-1], None))
+		(self.forwardRegex, self.forwardGroups) = self._combine(forward)
+		(self.reverseRegex, self.reverseGroups) = self._combine([regex for (regex, surround) in reverse])
+		self.reverseSurrounds = [surround for (regex, surround) in reverse]
+
+	def _combine(self, regexes):
+		# One alternative per line, each of which can start anywhere, so that the first line (rather than the leftmost match) wins.
+		# Returns the regex and, for each line, the number of its own group (for the whole match) and how many groups it has within that.
+		alternatives = []
+		groups = []
+		group = 1
+		for regex in regexes:
+			inner = re.compile(regex).groups
+			alternatives.append('.*?({0})'.format(regex))
+			groups.append((group, inner))
+			group += 1 + inner
+		if len(alternatives) == 0:
+			return (None, [])
+		return (re.compile('^(?:{0})'.format('|'.join(alternatives)), re.DOTALL), groups)
+
+	def _match(self, regex, groups, branch):
+		# Returns (line index, match) for the first line that matches branch, or (None, None)
+		if regex is None:
+			return (None, None)
+		result = regex.match(branch)
+		if result is None:
+			return (None, None)
+		for (index, (group, inner)) in enumerate(groups):
+			if result.group(group) is not None:
+				return (index, result)
+		return (None, None)
+
+	def forward(self, branch):
+		# The TeamCity branch name of a branch, or None
+		(index, result) = self._match(self.forwardRegex, self.forwardGroups, branch)
+		if index is None:
+			return None
+		(group, inner) = self.forwardGroups[index]
+		return result.group(group + 1) if inner >= 1 else result.group(group)
+
+	def reverse(self, branch):
+		# The branch name of a TeamCity branch, or None
+		(index, result) = self._match(self.reverseRegex, self.reverseGroups, branch)
+		if index is None:
+			return None
+		surround = self.reverseSurrounds[index]
+		if surround is None:
+			# The branch matches exactly, so return it.
+			return branch
+		# Replace the bracketted part of activeBranch with branch
+		return surround[0] + branch + surround[1]
+
+	def resolve(self, branches, reverse=False):
+		# Look up many branches at once. Returns a dict of branch -> mapped branch (or None).
+		lookup = self.reverse if reverse else self.forward
+		return dict((branch, lookup(branch)) for branch in branches)
+
+_matchers = {}
+
+def getBranchSpecMatcher(branchSpec):
+	# Each branchSpec is only compiled once per process
+	if branchSpec not in _matchers:
+		_matchers[branchSpec] = BranchSpecMatcher(branchSpec)
+	return _matchers[branchSpec]
+
+def _branchSpecCacheFile():
+	if BranchSpecCacheFile is None:
+		from PackageManager import UserCacheDirectory
+		return os.path.join(UserCacheDirectory(), 'GitFlatten-branchSpec.json')
+	return BranchSpecCacheFile
+
+def _loadBranchSpecCache():
+	import json
+	cacheFile = _branchSpecCacheFile()
+	if not cacheFile or not os.path.exists(cacheFile):
+		return None
+	try:
+		with open(cacheFile, 'r') as f:
+			cache = json.load(f)
+	except ValueError:
+		return None
+	return cache if cache.get('url') == VcsRootUrl else None
+
+def _saveBranchSpecCache(cache):
+	import json
+	cacheFile = _branchSpecCacheFile()
+	if not cacheFile:
+		return
+	# Write to a temporary file first, so that a concurrent reader never sees a half-written cache
+	temp = '{0}.{1}.tmp'.format(cacheFile, os.getpid())
+	try:
+		directory = os.path.dirname(cacheFile)
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+		with open(temp, 'w') as f:
+			json.dump(cache, f)
+		if os.path.exists(cacheFile):
+			os.remove(cacheFile)
+		os.rename(temp, cacheFile)
+	except (IOError, OSError):
+		# The branchSpec is just downloaded again next time
+		pass
+
+def _branchSpecOfVcsRoot(vcsRoot):
+	# The vcs root contains properties, including "teamcity:branchSpec", which contains the mapping we're looking for
+	for property in vcsRoot['properties']['property']:
+		if property['name'] == 'teamcity:branchSpec':
+			return property['value']
+	return ''
+
+def getBranchSpec(brief=False):
+	# Returns the branchSpec of the GitFlatten vcs root ('' if it has none), or None if the vcs root doesn't exist.
+	# https://teamcity.company.com/app/rest/vcs-roots/id:GitFlatten
+	if BranchSpec is not None:
+		return BranchSpec
+	import json
+	if VcsRootUrl.startswith('file://'):
+		with open(VcsRootUrl[len('file://'):], 'r') as f:
+			return _branchSpecOfVcsRoot(json.load(f))
+
+	cache = _loadBranchSpecCache()
+	if cache is not None and BranchSpecCacheTTL is not None and time.time() - cache['fetched'] < BranchSpecCacheTTL:
+		return cache['branchSpec']
+
+	# Use the 'PackageManager.py' script to ensure that requests is installed
+	import PackageManager
+	PackageManager.ensurePackage('requests', silent=brief)
+	import requests
+
+	headers = {'Accept': 'application/json', 'Authorization': 'Basic $$$ENCODED-AUTH$$$'}
+	if cache is not None:
+		# Only download the vcs root again if it has changed
+		if cache.get('etag'):
+			headers['If-None-Match'] = cache['etag']
+		if cache.get('lastModified'):
+			headers['If-Modified-Since'] = cache['lastModified']
+	try:
+		r = requests.get(VcsRootUrl, headers = headers)
+	except Exception as e:
+		if cache is not None:
+			print "Exception raised contacting {0}, so using the branchSpec cached {1:.0f} minutes ago: {2}".format(VcsRootUrl, (time.time() - cache['fetched']) / 60, e)
+			return cache['branchSpec']
+		# Report error and re-raise the exception
+		print "Exception raised contacting https://teamcity.company.com/. Python upgrade (to 2.7.13) should fix this."
+		raise(e)
+	if r.status_code == 304 and cache is not None:
+		cache['fetched'] = time.time()
+		_saveBranchSpecCache(cache)
+		return cache['branchSpec']
+	if r.status_code != 200:
+		if r.status_code == 404:
+			return None
+		else:
+			r.raise_for_status()
+	branchSpec = _branchSpecOfVcsRoot(json.loads(r.text))
+	_saveBranchSpecCache({'url': VcsRootUrl, 'branchSpec': branchSpec, 'etag': r.headers.get('ETag'), 'lastModified': r.headers.get('Last-Modified'), 'fetched': time.time()})
+	return branchSpec
+
+def getBranches(branches, reverse=False, brief=True):
+	# Look up many branches with one fetch of the branchSpec. Returns a dict of branch -> mapped branch, or None for branches with
+	# no mapping (unlike getBranch, there is no fall back to a build folder or FindMatchingBuild).
+	branchSpec = getBranchSpec(brief)
+	if branchSpec is None:
+		return dict((branch, None) for branch in branches)
+	return getBranchSpecMatcher(branchSpec).resolve(branches, reverse)
 
 def getBranch(brief=False, branch=None, reverse=False):
 	if branch is None:
 		if 'gitbranch' in os.environ:
 			# If this is run from within TeamCity, then there is no local git repo and the %gitbranch% envvar should be set
 			return os.environ['gitbranch']
-		from GitFunctions import RunGitCommand, RunGitCommandWithErrorCheck, CountParentsOfCommit, PrepareGitWorkingFolder
+		from GitFunctions import RunGitCommand, RunGitCommandWithErrorCheck, PrepareGitWorkingFolder
 		# This returns the upstream branch (tracked branch)
 		success, remoteBranch = RunGitCommand(['rev-parse', '--abbrev-ref', '--symbolic-full-name', '@{u}'], silent=brief)
 		if success:
@@ -36,78 +231,22 @@ def getBranch(brief=False, branch=None, reverse=False):
 	if not brief:
 		print 'Searching for branch "{0}"'.format(branch)
 
-	# Having got hold of a branch name, look it up in the FlattenGit vcs repo on TeamCity
-	# https://teamcity.company.com/app/rest/vcs-roots/id:GitFlatten
-
-	# Use the 'PackageManager.py' script to ensure that requests is installed
-	import PackageManager
-	PackageManager.ensurePackage('requests', silent=brief)
-	import requests
-
-	try:
-		r = requests.get('https://teamcity.company.com/app/rest/vcs-roots/id:GitFlatten', headers = {'Accept': 'application/json', 'Authorization': 'Basic $$$ENCODED-AUTH$$$'})
-	except Exception as e:
-		# Report error and re-raise the exception
-		print "Exception raised contacting https://teamcity.company.com/. Python upgrade (to 2.7.13) should fix this."
-		raise(e)
-	if r.status_code != 200:
-		if r.status_code == 404:
-			if not brief:
-				print "GitFlatten vcs root not found"
-			return branch
-		else:
-			r.raise_for_status()
-	vcsRoot = json.loads(r.text)
-	# The vcs root contains properties, including "teamcity:branchSpec", which contains the mapping we're looking for
-	properties = vcsRoot['properties']
-	newBranch = None
-	for property in properties['property']:
-		if property['name'] == 'teamcity:branchSpec':
-			branchSpec = property['value']
-			branches = branchSpec.split('\n')
-			activeBranchPrefix = '+:refs/heads/'
-			# activeBranches will contain a list like ['(develop)', '(beta*)', '(alpha10.6.6)', '(alpha10.6.7)', '(alpha10.6.8)', 'features/(deathcon)sequences', 'feature/wpg/(props)']
-			activeBranches = [line[len(activeBranchPrefix):] for line in branches if line.startswith(activeBranchPrefix)]
-			for activeBranch in activeBranches:
-				if reverse:
-					# For a reverse look-up, we extract the text within the brackets and see if it matches the branch.
-					useGroup = '(' in activeBranch and ')' in activeBranch
-					if useGroup:
-						(start,rest) = activeBranch.split('(')
-						(middle,end) = rest.split(')')
-						regex = middle.replace('.', '\\.')
-					else:
-						regex = activeBranch.replace('.','\\.').replace('*','.*')
-					p = re.compile(regex)
-					result = p.search(branch)
-					if result is not None:
-						if useGroup:
-							# Replace the bracketted part of activeBranch with branch
-							newBranch = start + branch + end
-						else:
-							# The branch matches exactly, so return it.
-							newBranch = branch
-						if not brief:
-							print "TeamCity branch '{0}' maps to '{1}'".format(branch, newBranch)
-						branch = newBranch
-						break
-				else:
-					# Convert the spec to a regex by escaping '.' and converting '*' to '.*'. The brackets will define a group in the regex.
-					regex = activeBranch.replace('.','\\.').replace('*','.*')
-					p = re.compile(regex)
-					result = p.search(branch)
-					if result is not None:
-						groups = len(result.groups())
-						if groups < 1:
-							newBranch = result.group()
-						else:
-							newBranch = result.group(1)
-						if not brief:
-							print "Branch '{0}' maps to '{1}' on TeamCity".format(branch, newBranch)
-						branch = newBranch
-						break
-			break
-	if newBranch is None:
+	# Having got hold of a branch name, look it up in the branchSpec of the FlattenGit vcs root on TeamCity
+	branchSpec = getBranchSpec(brief)
+	if branchSpec is None:
+		if not brief:
+			print "GitFlatten vcs root not found"
+		return branch
+	matcher = getBranchSpecMatcher(branchSpec)
+	newBranch = matcher.reverse(branch) if reverse else matcher.forward(branch)
+	if newBranch is not None:
+		if not brief:
+			if reverse:
+				print "TeamCity branch '{0}' maps to '{1}'".format(branch, newBranch)
+			else:
+				print "Branch '{0}' maps to '{1}' on TeamCity".format(branch, newBranch)
+		branch = newBranch
+	else:
 		if reverse:
 			if not brief:
 				print "No branch found for TeamCity branch '{0}'".format(branch)
@@ -136,11 +275,17 @@ def getBranch(brief=False, branch=None, reverse=False):
 
 
 if __name__ == '__main__':
+	import argparse
 	parser = argparse.ArgumentParser(description='Return a mapping between a TeamCity branch name and a dev branch name.')
 	parser.add_argument('--brief', action='store_true', help='Minimize stdout output to the result, with none of the working. NB: stderr may have output if (for example) requests is installed.')
 	parser.add_argument('--branch', default=None, help='The branch to search for. If not set, use the current remote (or local) branch name, unless %gitbranch% is set, in which case return that.')
 	parser.add_argument('--reverse', action='store_true', help='If set, reverse the look-up: a TeamCity branch name is given, and the actual branch name is returned')
+	parser.add_argument('--vcs-root-url', default=VcsRootUrl, help='The URL of the vcs root to read the branchSpec from (e.g. a file:// URL of a local stub).')
+	parser.add_argument('--no-cache', action='store_true', help='Always download the branchSpec, instead of using the copy cached for up to {0} seconds.'.format(BranchSpecCacheTTL))
 	args = parser.parse_args()
+	VcsRootUrl = args.vcs_root_url
+	if args.no_cache:
+		BranchSpecCacheTTL = 0
 	branch = getBranch(brief = args.brief, branch = args.branch, reverse = args.reverse)
 	if args.brief:
 		print branch
@@ -0,0 +1,231 @@
+# Long-lived 'git cat-file --batch' and '--batch-check' processes, one pair per working repo.
+# Starting git for every small read-only query costs far more than the query itself, so lookups of object types, sizes,
+# commit headers, parents and tree ids are answered over the pipes of processes that stay open for the whole run.
+# GitFunctions.RunGitCommand will route suitable commands through here when GitFunctions.UseBatchBackend is set (as FlattenGit
+# does unless --no-batch is given).
+
+import subprocess
+import atexit
+import os
+import re
+
+# Started processes, keyed by (process id, repo, mode). Pool processes (see FlattenGit.FlattenBranches) inherit the
+# processes of their parent, but must start their own rather than share its pipes.
+_processes = {}
+
+class BatchProcessError(Exception):
+	pass
+
+class BatchProcess(object):
+	# A single 'git cat-file' process in --batch or --batch-check mode
+	def __init__(self, git_executable, repo, mode):
+		self.repo = repo
+		self.mode = mode
+		self.process = subprocess.Popen([git_executable, "cat-file", mode], stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=repo)
+
+	def IsAlive(self):
+		return self.process.poll() is None
+
+	def Request(self, obj):
+		# Returns (hash, type, size, content); content is None in --batch-check mode. Returns None if the object is missing.
+		if '\n' in obj:
+			raise BatchProcessError("Object names cannot contain line breaks: {0!r}".format(obj))
+		self.process.stdin.write(obj + '\n')
+		self.process.stdin.flush()
+		header = self.process.stdout.readline()
+		if len(header) == 0:
+			raise BatchProcessError("git cat-file {0} exited unexpectedly in {1}".format(self.mode, self.repo))
+		fields = header.rstrip('\n').split(' ')
+		if len(fields) != 3:
+			# "<obj> missing" or "<obj> ambiguous"
+			return None
+		(sha, type, size) = fields
+		size = int(size)
+		content = None
+		if self.mode == "--batch":
+			content = self.process.stdout.read(size)
+			# Each object is followed by a line feed
+			self.process.stdout.read(1)
+		return (sha, type, size, content)
+
+	def Close(self):
+		if self.IsAlive():
+			try:
+				self.process.stdin.close()
+				self.process.wait()
+			except:
+				pass
+
+def GetBatchProcess(git_executable, mode, repo=None):
+	if repo is None:
+		repo = os.getcwd()
+	key = (os.getpid(), os.path.normcase(os.path.abspath(repo)), mode)
+	process = _processes.get(key)
+	if process is None or not process.IsAlive():
+		process = BatchProcess(git_executable, repo, mode)
+		_processes[key] = process
+	return process
+
+def CloseBatchProcesses():
+	for (key, process) in _processes.items():
+		if key[0] == os.getpid():
+			process.Close()
+	_processes.clear()
+
+atexit.register(CloseBatchProcesses)
+
+class GitObjectReader(object):
+	# Read-only object lookups for one working repo, answered by persistent cat-file processes
+	def __init__(self, git_executable, repo=None):
+		self.git_executable = git_executable
+		self.repo = repo
+
+	def _check(self, obj):
+		return GetBatchProcess(self.git_executable, "--batch-check", self.repo).Request(obj)
+
+	def _read(self, obj):
+		return GetBatchProcess(self.git_executable, "--batch", self.repo).Request(obj)
+
+	def ResolveObject(self, obj):
+		result = self._check(obj)
+		return result[0] if result is not None else None
+
+	def ObjectType(self, obj):
+		result = self._check(obj)
+		return result[1] if result is not None else None
+
+	def ObjectSize(self, obj):
+		result = self._check(obj)
+		return result[2] if result is not None else None
+
+	def ReadObject(self, obj):
+		# Returns (type, content), or None if the object does not exist
+		result = self._read(obj)
+		return (result[1], result[3]) if result is not None else None
+
+	def CommitHeaders(self, commit):
+		# Returns (hash, headers, message) where headers is a list of (name, value) pairs in the order they appear,
+		# or None if commit is not a commit
+		result = self._read(commit + "^{commit}")
+		if result is None:
+			return None
+		(header, _, message) = result[3].partition('\n\n')
+		headers = []
+		for line in header.split('\n'):
+			if line.startswith(' ') and len(headers) > 0:
+				# Continuation of a multi-line header (e.g. gpgsig)
+				headers[-1] = (headers[-1][0], headers[-1][1] + '\n' + line[1:])
+			else:
+				(name, _, value) = line.partition(' ')
+				headers.append((name, value))
+		return (result[0], headers, message)
+
+	def Parents(self, commit):
+		commit = self.CommitHeaders(commit)
+		if commit is None:
+			return None
+		return [value for (name, value) in commit[1] if name == 'parent']
+
+	def Tree(self, commit):
+		return self.ResolveObject(commit + "^{tree}")
+
+# Author and committer headers look like "Name <email> timestamp timezone"
+_identityPattern = re.compile(r"^(.*) <(.*)> (\d+) ([+-]\d{4})$")
+
+def _FormatCommit(details, format):
+	# Expand a pretty format for a single commit, given its CommitHeaders. Returns None if the format uses anything unsupported.
+	(sha, headers, message) = details
+	values = {'%H': sha, '%B': message}
+	values['%P'] = ' '.join([value for (name, value) in headers if name == 'parent'])
+	for (name, value) in headers:
+		if name == 'tree':
+			values['%T'] = value
+		elif name == 'author':
+			match = _identityPattern.match(value)
+			if match is None:
+				return None
+			values['%an'] = match.group(1)
+			values['%ae'] = match.group(2)
+	# The subject is the first paragraph of the message, folded onto one line
+	values['%s'] = ' '.join(message.split('\n\n', 1)[0].strip('\n').split('\n'))
+	output = ''
+	for token in re.split(r"(%an|%ae|%[HPTBs])", format):
+		if token in values:
+			output += values[token]
+		elif '%' in token:
+			return None
+		else:
+			output += token
+	return output
+
+def Missing(obj):
+	# The exit code and message of git for an object that doesn't exist
+	return (128, "fatal: Not a valid object name {0}\n".format(obj))
+
+def RunBatched(git_executable, args):
+	# Answer a read-only git command over the batch processes if possible. Returns (exit code, output) as git would have
+	# returned them, or None if the command isn't one that can be answered this way (in which case it should be run normally).
+	reader = GitObjectReader(git_executable)
+	command = args[0]
+	rest = args[1:]
+	if command == "cat-file" and len(rest) == 2:
+		(option, obj) = rest
+		if option == "-t":
+			type = reader.ObjectType(obj)
+			return (0, type + '\n') if type is not None else Missing(obj)
+		if option == "-s":
+			size = reader.ObjectSize(obj)
+			return (0, str(size) + '\n') if size is not None else Missing(obj)
+		if option in ("-p", "commit", "blob", "tag"):
+			result = reader.ReadObject(obj)
+			if result is None:
+				return Missing(obj)
+			(type, content) = result
+			# Trees are pretty-printed by 'cat-file -p', so leave those to git
+			if option == "-p" and type == "tree":
+				return None
+			if option != "-p" and option != type:
+				return None
+			return (0, content)
+	elif command == "rev-parse":
+		if len(rest) == 2 and rest[0] == "--verify":
+			rest = rest[1:]
+		if len(rest) == 1 and not rest[0].startswith('-'):
+			sha = reader.ResolveObject(rest[0])
+			return (0, sha + '\n') if sha is not None else Missing(rest[0])
+	elif command == "log":
+		# Only single-commit logs with a simple format, e.g. log -n 1 <commit> --format=%P
+		format = None
+		count = None
+		revisions = []
+		i = 0
+		while i < len(rest):
+			arg = rest[i]
+			if arg == "-n" and i + 1 < len(rest):
+				count = rest[i + 1]
+				i += 1
+			elif arg == "-1":
+				count = "1"
+			elif arg.startswith("--format=") or arg.startswith("--pretty="):
+				format = arg.split('=', 1)[1]
+				if format.startswith("tformat:"):
+					format = format[len("tformat:"):]
+				elif format.startswith("format:") or '%' not in format:
+					# 'format:' leaves out the line feed that is added below, and anything else without a '%' is a named
+					# format (e.g. oneline), so leave those to git
+					return None
+			elif arg.startswith('-'):
+				return None
+			else:
+				revisions.append(arg)
+			i += 1
+		if count != "1" or format is None or len(revisions) > 1:
+			return None
+		revision = revisions[0] if len(revisions) > 0 else "HEAD"
+		details = reader.CommitHeaders(revision)
+		if details is None:
+			return Missing(revision)
+		output = _FormatCommit(details, format)
+		# git log terminates a single formatted commit with a line feed
+		return (0, output + '\n') if output is not None else None
+	return None
@@ -6,9 +6,34 @@ Created on 2 Oct 2014
 import subprocess
 import sys
 import os
+import re
+import time
 
 ShowWarningDialogByDefault = False
 
+# git is run directly rather than through a shell, so the executable name has to include the extension on Windows
+GitExecutable = "git.exe" if sys.platform == "win32" else "git"
+
+# If set, read-only queries (object types, commit headers, parents, tree ids) are answered by persistent
+# 'git cat-file --batch' processes instead of starting a new git process for each one. See GitBatch.py, and FlattenGit's --no-batch.
+UseBatchBackend = False
+
+# The remotes that PrepareGitWorkingFolder clones from and pushes to. Benchmark.py points these at local bare repos.
+OriginUrl = "git@git.company.com:Project"
+TeamCityUrl = "git@git.company.com:TeamCityProject"
+
+# The number of git processes started by RunGitCommand, and the number of commands answered by the batch backend instead
+GitInvocationCount = 0
+BatchInvocationCount = 0
+
+# If set (see GitTrace.StartTrace), every git command is recorded with its phase, duration, exit status and output size
+Trace = None
+
+# How long to wait for another git process to release index.lock, and how old an index.lock has to be before it is taken to
+# have been left behind by a git process that died (a live one could be writing a large index for that long)
+IndexLockTimeout = 30
+IndexLockStaleAfter = 10 * 60
+
 ui_logging_function = None
 
 def logging_function(message, waitForUserInput=False, offerAbort=False):
@@ -18,7 +43,8 @@ def logging_function(message, waitForUserInput=False, offerAbort=False):
 		DoPrint(message, waitForUserInput)
 		return True
 		
-def RunGitCommand(args, wait=True, silent=False, printstdout=False, returnerrorcode=False, noWarningDialog=None, ignoreWhiteSpace=False, returnAbort=False):
+def RunGitCommand(args, wait=True, silent=False, printstdout=False, returnerrorcode=False, noWarningDialog=None, ignoreWhiteSpace=False, returnAbort=False, input=None, env=None, mergeStderr=True):
+	global GitInvocationCount, BatchInvocationCount
 	if noWarningDialog is None:
 		noWarningDialog = not ShowWarningDialogByDefault
 
@@ -30,16 +56,48 @@ def RunGitCommand(args, wait=True, silent=False, printstdout=False, returnerrorc
 
 	if ignoreWhiteSpace:
 		args.insert(1, "-Xignore-space-change")
-	args.insert(0, "git.exe")
 
-	# Check that index.lock doesn't exist. If it does ask the user to stop any other git processes or delete index.lock if it has been left behind
+	if env is not None:
+		# Extra environment variables (e.g. GIT_INDEX_FILE) on top of the current environment
+		env = dict(os.environ, **env)
+
+	if UseBatchBackend and wait and not ignoreWhiteSpace and input is None and env is None:
+		import GitBatch
+		startTime = time.time()
+		result = GitBatch.RunBatched(GitExecutable, args)
+		if result is not None:
+			(code, output) = result
+			BatchInvocationCount += 1
+			if Trace is not None:
+				Trace.Record(args, time.time() - startTime, code, output, batched=True)
+			if not silent:
+				logging_function(("...->" + "\t" * 9) + "git " + " ".join(args) + " (batch)")
+			if code != 0:
+				# As for a failed git process, but there is nothing to try again
+				if returnerrorcode:
+					logging_function("\nGit command returned error code {0} with output: {1}\n".format(code, output))
+				else:
+					logging_function("\nGit command failed:\n")
+					logging_function(output)
+				if not mergeStderr:
+					# git's message would have gone to stderr
+					output = ''
+			elif printstdout:
+				print output[:-1]
+			if returnerrorcode:
+				success = code
+			else:
+				success = code == 0
+			if returnAbort:
+				return success, output, abort
+			return success, output
+
+	args.insert(0, GitExecutable)
+
+	# If index.lock exists, another git process is probably using the index, so give it a chance to finish first
 	index_lock_file = os.path.join(os.getcwd(), ".git", "index.lock")
-	while os.path.isfile(index_lock_file):
-		try:
-			logging_function("index.lock file exists, which will probably make the next Git command fail.\nPlease check for running Git processes and, if there aren't any, press OK to delete it automatically:\n\n" + index_lock_file, waitForUserInput=True)
-			os.remove(index_lock_file)
-		except:
-			pass
+	if os.path.isfile(index_lock_file):
+		WaitForIndexLock(index_lock_file)
 
 	output = ''
 	success = 0 if returnerrorcode else False
@@ -48,27 +106,35 @@ def RunGitCommand(args, wait=True, silent=False, printstdout=False, returnerrorc
 	while tryAgain:
 		tryAgain = False
 		numberOfTries += 1
+		GitInvocationCount += 1
+		startTime = time.time()
 		try:
 			if not silent:
 				# Show the git command but way off to the right to keep the user-friendly messages segregated
 				logging_function(("...->" + "\t" * 9) + "git " + " ".join(args))
 
 			if wait:
-				if printstdout:
-					process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-					while process.poll() is None:
-						line = process.stdout.readline()
+				if input is not None or env is not None or not mergeStderr:
+					output = RunAndCapture(args, input, env, mergeStderr)
+				elif printstdout:
+					process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False)
+					# Read until the end of the output, rather than until the process exits, so that the last lines aren't lost
+					for line in iter(process.stdout.readline, ''):
 						output += line
-						if len(line) > 0:
-							print line[:-1]
+						print line.rstrip('\n')
+					process.wait()
 				else:
-					output = subprocess.check_output(args, stderr=subprocess.STDOUT,shell=True)
+					output = subprocess.check_output(args, stderr=subprocess.STDOUT,shell=False)
 			else:
-				subprocess.Popen(args, stderr=subprocess.STDOUT,shell=True)
+				subprocess.Popen(args, stderr=subprocess.STDOUT,shell=False)
+			if Trace is not None:
+				Trace.Record(args[1:], time.time() - startTime, 0 if wait else None, output)
 			if not returnerrorcode:
 				success = True
 
 		except subprocess.CalledProcessError, e:
+			if Trace is not None:
+				Trace.Record(args[1:], time.time() - startTime, e.returncode, e.output)
 			if returnerrorcode:
 				logging_function("\nGit command returned error code {0} with output: {1}\n".format(e.returncode, e.output))
 				success = e.returncode
@@ -109,8 +175,132 @@ def RunGitCommand(args, wait=True, silent=False, printstdout=False, returnerrorc
 		return success, output, abort
 	return success, output
 
-def RunGitCommandWithErrorCheck(command, errorstring, silent = False, printstdout=False):
-	success, results = RunGitCommand(command, silent=silent, printstdout=printstdout, noWarningDialog=True) # errors handled below
+def WaitForIndexLock(path, staleAfter=IndexLockStaleAfter):
+	# Wait (up to IndexLockTimeout) for index.lock to be released. If it is still there, and is older than staleAfter, it was
+	# left behind by a git process that died, so it is removed; otherwise the next git command will report the problem.
+	start = time.time()
+	while os.path.isfile(path) and time.time() - start < IndexLockTimeout:
+		time.sleep(0.1)
+	try:
+		age = time.time() - os.path.getmtime(path)
+	except OSError:
+		# Released
+		return
+	if age >= staleAfter:
+		logging_function("Removing {0}, which was left behind {1:.0f}s ago by a git process that is no longer running".format(path, age))
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+	else:
+		logging_function("{0} is still held by another git process after {1:.0f}s".format(path, time.time() - start))
+
+def RunAndCapture(args, input=None, env=None, mergeStderr=True):
+	# Like subprocess.check_output, but can also feed stdin, and can leave stderr out of the output (so that it can be parsed)
+	process = subprocess.Popen(args, stdin=subprocess.PIPE if input is not None else None, stdout=subprocess.PIPE, stderr=subprocess.STDOUT if mergeStderr else None, env=env)
+	output = process.communicate(input)[0]
+	if process.returncode != 0:
+		raise subprocess.CalledProcessError(process.returncode, args, output)
+	return output
+
+def StreamGitCommand(args, separator='\0', silent=True, env=None, chunkSize=65536):
+	# Run a git command and yield its output one record at a time (split on separator) as it arrives, so that memory use doesn't
+	# depend on the size of the output. Raises an exception, after the last record, if the command failed.
+	# If the caller stops early (e.g. by breaking out of a for loop), the command is stopped.
+	global GitInvocationCount
+	GitInvocationCount += 1
+	if not silent:
+		logging_function(("...->" + "\t" * 9) + "git " + " ".join(args))
+	if env is not None:
+		env = dict(os.environ, **env)
+	import tempfile
+	# stderr goes to a file rather than a pipe, as a full stderr pipe would stop the command while stdout is being read
+	errors = tempfile.TemporaryFile()
+	startTime = time.time()
+	process = subprocess.Popen([GitExecutable] + args, stdout=subprocess.PIPE, stderr=errors, env=env)
+	outputBytes = 0
+	pending = ''
+	try:
+		while True:
+			# os.read returns whatever has arrived, rather than waiting for a whole chunk
+			chunk = os.read(process.stdout.fileno(), chunkSize)
+			if len(chunk) == 0:
+				break
+			outputBytes += len(chunk)
+			records = (pending + chunk).split(separator)
+			pending = records.pop()
+			for record in records:
+				yield record
+		if len(pending) > 0:
+			yield pending
+		process.wait()
+		if process.returncode != 0:
+			errors.seek(0)
+			raise Exception("git {0} failed with exit code {1}: {2}".format(" ".join(args), process.returncode, errors.read().strip()))
+	finally:
+		if process.poll() is None:
+			process.kill()
+			process.wait()
+		process.stdout.close()
+		errors.close()
+		if Trace is not None:
+			Trace.Record(args, time.time() - startTime, process.returncode, None, outputBytes=outputBytes)
+
+def RunGitPipeline(first, second, silent=True):
+	# Run two git commands with the output of the first piped into the second (e.g. 'log -p' into 'patch-id'), without
+	# holding the intermediate output in memory. Returns the output of the second, or raises an exception if either failed.
+	global GitInvocationCount
+	GitInvocationCount += 2
+	if not silent:
+		logging_function(("...->" + "\t" * 9) + "git " + " ".join(first) + " | git " + " ".join(second))
+	startTime = time.time()
+	producer = subprocess.Popen([GitExecutable] + first, stdout=subprocess.PIPE)
+	consumer = subprocess.Popen([GitExecutable] + second, stdin=producer.stdout, stdout=subprocess.PIPE)
+	# Only the consumer holds the pipe now, so the producer sees it closed if the consumer exits early
+	producer.stdout.close()
+	output = consumer.communicate()[0]
+	producer.wait()
+	if Trace is not None:
+		duration = time.time() - startTime
+		Trace.Record(first, duration, producer.returncode, None, outputBytes=0)
+		Trace.Record(second, duration, consumer.returncode, output)
+	if producer.returncode != 0 or consumer.returncode != 0:
+		raise Exception("git {0} | git {1} failed".format(" ".join(first), " ".join(second)))
+	return output
+
+def StreamLogRecords(args, fields):
+	# Yield a tuple of the given format fields (e.g. ['%H', '%P', '%s']) for each commit listed by 'git log <args>'
+	for record in StreamGitCommand(["log", "-z", "--format=" + '\x1f'.join(fields)] + args):
+		record = record.strip('\n')
+		if len(record) > 0:
+			yield tuple(record.split('\x1f', len(fields) - 1))
+
+# The number of space-separated fields before the path, for each type of 'status --porcelain=v2' entry
+StatusFieldCounts = {'1': 8, '2': 9, 'u': 10, '?': 1, '!': 1}
+
+def StreamStatus(args=[], silent=True):
+	# Yield (type, XY, path, original path) for each entry of 'git status --porcelain=v2'. type is '1' (changed), '2' (renamed or
+	# copied), 'u' (unmerged), '?' (untracked) or '!' (ignored). XY is e.g. 'M.' or 'DU' ('.' for unchanged), or None for '?' and '!'.
+	# The original path is only set for renames and copies.
+	records = StreamGitCommand(["status", "--porcelain=v2", "-z"] + args, silent=silent)
+	for record in records:
+		kind = record[0]
+		if kind not in StatusFieldCounts:
+			# e.g. '#' headers from --branch
+			continue
+		fields = record.split(' ', StatusFieldCounts[kind])
+		originalPath = next(records) if kind == '2' else None
+		yield (kind, fields[1] if kind not in '?!' else None, fields[-1], originalPath)
+
+def StreamRemoteHeads(remote):
+	# Yield (hash, branch name) for each branch on remote
+	for line in StreamGitCommand(["ls-remote", "--heads", remote], separator='\n'):
+		if '\t' in line:
+			(sha, ref) = line.split('\t', 1)
+			yield (sha, ref[len("refs/heads/"):] if ref.startswith("refs/heads/") else ref)
+
+def RunGitCommandWithErrorCheck(command, errorstring, silent = False, printstdout=False, input=None, env=None, mergeStderr=True):
+	success, results = RunGitCommand(command, silent=silent, printstdout=printstdout, noWarningDialog=True, input=input, env=env, mergeStderr=mergeStderr) # errors handled below
 	if not success:
 		print results
 		raise Exception(errorstring)
@@ -118,24 +308,63 @@ def RunGitCommandWithErrorCheck(command, errorstring, silent = False, printstdou
 		print results
 	return results
 
+def GetOriginBranch(branch):
+	# Use GetBranch.py (with reverse lookup) to find the source branch of a TeamCity branch
+	sys.path.insert(1, os.path.normpath(os.path.join(__file__, "..", "..", "..", "Game", "Scripts", "Common")))
+	from GetBranch import getBranch
+	return getBranch(branch=branch, reverse=True)
+
+def GetOriginBranches(branches):
+	# Find the source branches of several TeamCity branches at once. Returns a dict of branch -> source branch (or None if it has no mapping).
+	sys.path.insert(1, os.path.normpath(os.path.join(__file__, "..", "..", "..", "Game", "Scripts", "Common")))
+	from GetBranch import getBranches
+	return getBranches(branches, reverse=True)
+
+def GetTeamCityBranches(branches):
+	# Find the TeamCity branches of several source branches at once. Returns a dict of branch -> TeamCity branch (or None if TeamCity doesn't build it).
+	sys.path.insert(1, os.path.normpath(os.path.join(__file__, "..", "..", "..", "Game", "Scripts", "Common")))
+	from GetBranch import getBranches
+	return getBranches(branches)
+
 # PrepareGitWorkingFolder is used by several TeamCity scripts to set up (or update) the local git repo on a TeamCity agent
-def PrepareGitWorkingFolder(working_repo, branch=None, add_teamcity_remote=False, default_email=None, default_name=None):
+# With partial_clone, a new working repo is a blob-less partial clone: commits and trees are fetched, but the contents of
+# files are only downloaded when they are first needed, and only the requested branch is fetched from each remote.
+# With clone_depth, a new working repo only has that much history to begin with (see DeepenUntil to get more).
+# With object_cache, the working repo borrows objects from a bare repo shared by all of the working repos on the agent, which
+# is fetched into first, so that each object is only downloaded and stored once (see GitMaintenance.py to keep it in shape).
+def PrepareGitWorkingFolder(working_repo, branch=None, add_teamcity_remote=False, default_email=None, default_name=None, reset_working_copy=True, partial_clone=False, clone_depth=None, object_cache=None, performance_profile=None, network=None):
+	# performance_profile, if given, is a GitPerformance.PerformanceProfile to apply to the repo.
+	# network, if given, is a NetworkPhase.NetworkPhase that the fetches are started in ("fetch teamcity" and "fetch origin"),
+	# rather than waiting for them. They don't write FETCH_HEAD, which both would otherwise write at once.
+	fetchOptions = ["--no-write-fetch-head"] if network is not None else []
 	if not os.path.exists(working_repo):
 		os.makedirs(working_repo)
 
-	# Use GetBranch.py (with reverse lookup) to find the source branch
-	sys.path.insert(1, os.path.normpath(os.path.join(__file__, "..", "..", "..", "Game", "Scripts", "Common")))
-	from GetBranch import getBranch
-	originBranch = getBranch(branch=branch, reverse=True)
+	originBranch = GetOriginBranch(branch)
+
+	if object_cache is not None:
+		object_cache = os.path.abspath(object_cache)
+		UpdateObjectCache(object_cache, originBranch if branch is not None else None, "teamcity/{0}".format(branch) if branch is not None and add_teamcity_remote else None, add_teamcity_remote)
 
 	if not os.path.exists(os.path.join(working_repo, ".git")):
-		RunGitCommandWithErrorCheck(["clone", "--verbose", "--no-checkout"] + (["--branch={0}".format(originBranch)] if originBranch is not None else []) + ["git@git.company.com:Project", working_repo], "Unable to clone into {0}".format(working_repo), printstdout=True)
+		cloneOptions = []
+		if partial_clone:
+			cloneOptions.append("--filter=blob:none")
+		if clone_depth is not None:
+			# --depth implies --single-branch, which is only wanted if there is a branch
+			cloneOptions += ["--depth={0}".format(clone_depth)] + (["--no-single-branch"] if originBranch is None else [])
+		if object_cache is not None:
+			cloneOptions.append("--reference-if-able={0}".format(object_cache))
+		RunGitCommandWithErrorCheck(["clone", "--verbose", "--no-checkout"] + cloneOptions + (["--branch={0}".format(originBranch)] if originBranch is not None else []) + [OriginUrl, working_repo], "Unable to clone into {0}".format(working_repo), printstdout=True)
 	os.chdir(working_repo)
+	if object_cache is not None:
+		AddAlternate(os.path.join(object_cache, "objects"))
 
-	# In case a previous Git operation was interrupted, delete the index.lock file
+	# In case a previous Git operation was interrupted, delete the index.lock file. The caller should hold the working repo's lock
+	# (see RepoLock.py), so that this can't be another job's git process, but wait a little in case one is still finishing.
 	indexLockFile = os.path.join(working_repo, ".git", "index.lock")
 	if os.path.exists(indexLockFile):
-		os.remove(indexLockFile)
+		WaitForIndexLock(indexLockFile, staleAfter=0)
 
 	# New versions of git don't like having executables as git hooks, so delete the three Meandros git hooks (if their size suggests they are the exes).
 	# The 'PushChangesBackToGit' script will re-create these properly.
@@ -153,22 +382,121 @@ def PrepareGitWorkingFolder(working_repo, branch=None, add_teamcity_remote=False
 		success, name = RunGitCommand(["config", "--get", "user.name"], noWarningDialog=True)
 		if not success:
 			RunGitCommandWithErrorCheck(["config", "user.name", default_name], "Could not set user.name")
+	if performance_profile is not None:
+		performance_profile.Apply(working_repo)
 	if add_teamcity_remote:
 		# Now add the teamcity remote, unless it already exists
 		remotes = RunGitCommandWithErrorCheck(["remote"], "Can't get list of remotes").split('\n')[:-1]
 		if not 'teamcity' in remotes:
-			RunGitCommandWithErrorCheck(["remote", "add", "teamcity", "git@git.company.com:TeamCityProject"], "Can't add 'teamcity' remote")
-		RunGitCommandWithErrorCheck(["fetch", "--verbose", "teamcity"] + (["teamcity/{0}".format(branch)] if branch is not None else []), "Could not fetch changes from teamcity", printstdout=True)
+			RunGitCommandWithErrorCheck(["remote", "add", "teamcity", TeamCityUrl], "Can't add 'teamcity' remote")
+		fetchArgs = ["fetch", "--verbose"] + fetchOptions + (["--filter=blob:none"] if partial_clone else []) + ["teamcity"] + (["teamcity/{0}".format(branch)] if branch is not None else [])
+		if network is not None:
+			network.Start("fetch teamcity", fetchArgs, "Could not fetch changes from teamcity")
+		else:
+			RunGitCommandWithErrorCheck(fetchArgs, "Could not fetch changes from teamcity", printstdout=True)
+
+	if partial_clone and branch is not None:
+		# Name the remote-tracking branch explicitly, as a single-branch clone's fetch refspec only covers the branch it was cloned with
+		fetchArgs = ["fetch", "--verbose"] + fetchOptions + ["--filter=blob:none", "origin", "+refs/heads/{0}:refs/remotes/origin/{0}".format(originBranch)]
+	else:
+		fetchArgs = ["fetch", "--verbose"] + fetchOptions + (["--filter=blob:none"] if partial_clone else []) + ["origin"] + ([originBranch] if branch is not None else [])
+	if network is not None:
+		network.Start("fetch origin", fetchArgs, "Could not fetch changes from origin")
 
-	# Ensure a clean working copy
-	RunGitCommandWithErrorCheck(["reset", "--hard"], "Failed to hard reset")
+	# Ensure a clean working copy (unless the caller never uses the working copy)
+	if reset_working_copy:
+		RunGitCommandWithErrorCheck(["reset", "--hard"], "Failed to hard reset")
 
-	RunGitCommandWithErrorCheck(["fetch", "--verbose", "origin"] + ([originBranch] if branch is not None else []), "Could not fetch changes from origin", printstdout=True)
+	if network is None:
+		RunGitCommandWithErrorCheck(fetchArgs, "Could not fetch changes from origin", printstdout=True)
+
+def UpdateObjectCache(object_cache, originBranch=None, teamcityBranch=None, fetchTeamCity=False):
+	# Fetch into the shared object cache, creating it if need be. Its refs are never pruned, so that objects that working repos borrow aren't lost.
+	if not os.path.exists(os.path.join(object_cache, "objects")):
+		RunGitCommandWithErrorCheck(["init", "--bare", object_cache], "Unable to create object cache {0}".format(object_cache))
+		RunGitCommandWithErrorCheck(["-C", object_cache, "config", "gc.auto", "0"], "Unable to configure object cache {0}".format(object_cache))
+	remotes = [("origin", OriginUrl, originBranch)] + ([("teamcity", TeamCityUrl, teamcityBranch)] if fetchTeamCity else [])
+	for (remote, url, fetchBranch) in remotes:
+		if fetchBranch is not None:
+			refspec = "+refs/heads/{0}:refs/remotes/{1}/{0}".format(fetchBranch, remote)
+		else:
+			refspec = "+refs/heads/*:refs/remotes/{0}/*".format(remote)
+		RunGitCommandWithErrorCheck(["-C", object_cache, "fetch", "--no-tags", url, refspec], "Could not fetch {0} into the object cache".format(remote), printstdout=True)
+
+def AddAlternate(objects):
+	# Let the current repo use the objects in another repo's object store, unless it already does
+	path = os.path.join(GetGitCommonDir(), "objects", "info", "alternates")
+	alternates = []
+	if os.path.exists(path):
+		with open(path, 'r') as f:
+			alternates = [line.strip() for line in f]
+	if os.path.abspath(objects) not in [os.path.abspath(alternate) for alternate in alternates if len(alternate) > 0]:
+		with open(path, 'a') as f:
+			f.write(os.path.abspath(objects) + '\n')
+
+def GetGitCommonDir():
+	# The .git folder of the current repo, shared by all of its worktrees
+	gitDir = RunGitCommandWithErrorCheck(["rev-parse", "--git-common-dir"], "Not in a git repo", silent=True).strip()
+	return os.path.abspath(gitDir)
+
+def IsShallowRepository():
+	success, output = RunGitCommand(["rev-parse", "--is-shallow-repository"], silent=True)
+	return success and output.strip() == "true"
+
+def GetShallowCommits():
+	# The commits at the boundary of a shallow repo's history, whose parents haven't been fetched
+	path = os.path.join(GetGitCommonDir(), "shallow")
+	if not os.path.exists(path):
+		return set()
+	with open(path, 'r') as f:
+		return set(line.strip() for line in f if len(line.strip()) > 0)
+
+def DeepenUntil(isDeepEnough, remote="origin", step=100, maxSteps=6):
+	# Fetch more of the history of a shallow repo until isDeepEnough() returns True, doubling the amount each time.
+	# After maxSteps, the rest of the history is fetched. Returns isDeepEnough().
+	while IsShallowRepository() and not isDeepEnough():
+		if maxSteps == 0:
+			RunGitCommandWithErrorCheck(["fetch", "--unshallow", remote], "Could not fetch the rest of the history from {0}".format(remote), printstdout=True)
+			break
+		RunGitCommandWithErrorCheck(["fetch", "--deepen={0}".format(step), remote], "Could not fetch more history from {0}".format(remote), printstdout=True)
+		step *= 2
+		maxSteps -= 1
+	return isDeepEnough()
+
+def IsPartialClone(remote="origin"):
+	success, output = RunGitCommand(["config", "--get", "remote.{0}.promisor".format(remote)], silent=True, noWarningDialog=True)
+	return success and output.strip() == "true"
+
+def PrefetchChangedBlobs(revisions, remote="origin"):
+	# In a partial clone, fetch the contents of the files changed by revisions (before and after) in one request,
+	# rather than git fetching each missing file separately when it first needs it. Only trees are read to find them.
+	if len(revisions) == 0:
+		return
+	output = RunGitCommandWithErrorCheck(["diff-tree", "-r", "--no-renames", "--no-commit-id", "--stdin"], "Failed to list changed files", silent=True, input='\n'.join(revisions) + '\n', mergeStderr=False)
+	blobs = set()
+	for line in output.split('\n'):
+		# :<old mode> <new mode> <old sha> <new sha> <status>\t<path>
+		if not line.startswith(':'):
+			continue
+		fields = line[1:].split('\t', 1)[0].split(' ')
+		for (mode, sha) in [(fields[0], fields[2]), (fields[1], fields[3])]:
+			if mode != "160000" and sha.strip('0') != '':
+				blobs.add(sha)
+	if len(blobs) > 0:
+		print "Prefetching {0} files changed by {1} revisions".format(len(blobs), len(revisions))
+		RunGitCommandWithErrorCheck(["fetch", "--no-tags", "--no-write-fetch-head", "--recurse-submodules=no", "--filter=blob:none", "--stdin", remote], "Could not prefetch files from {0}".format(remote), silent=True, input='\n'.join(sorted(blobs)) + '\n')
+
+_gitVersion = None
+
+def GetGitVersion():
+	# Returns the version of git as a tuple of ints, e.g. (2, 39, 5)
+	global _gitVersion
+	if _gitVersion is None:
+		success, output = RunGitCommand(["version"], silent=True)
+		match = re.search(r"(\d+)\.(\d+)(?:\.(\d+))?", output) if success else None
+		_gitVersion = tuple(int(part or 0) for part in match.groups()) if match is not None else (0, 0, 0)
+	return _gitVersion
 
-def CountParentsOfCommit(commit):
-	success, output = RunGitCommand(["log", "--pretty=%P", "-n", "1", commit])
-	return len(output.split(" "))
-		
 def DoPrint(output, waitForUserInput):
 	if type(output)=='string' and output[0] == '&':
 		print 'Working...'
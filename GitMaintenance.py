@@ -0,0 +1,109 @@
+# Repository maintenance for the working repos on an agent, and the object caches they share (see PrepareGitWorkingFolder's object_cache).
+# FlattenGit turns off automatic gc, because it takes ages at the wrong moment. Without any maintenance, a working repo builds up
+# loose objects and hundreds of packs, and history walks (merge-base, log, cherry-pick) get steadily slower. RunMaintenance:
+#	* writes commit-graph files, so that history walks don't need to parse every commit
+#	* packs loose objects and incrementally repacks small packs, via a multi-pack-index (never a full repack, and never pruning,
+#	  as other working repos may be using a cache's objects)
+#	* writes reachability bitmaps for the multi-pack-index, when the repo has all of its objects (no alternates, not a partial clone)
+# It is throttled (at most once per interval for each repo), only one maintenance runs on a repo at a time, and
+# StartBackgroundMaintenance runs it at low priority in a separate process, so that it happens between jobs without blocking them.
+
+import os
+import sys
+import glob
+import time
+import subprocess
+from GitFunctions import RunGitCommand, GetGitVersion
+
+DefaultInterval = 6 * 60 * 60
+
+def GetGitDir(repo):
+	success, output = RunGitCommand(["-C", repo, "rev-parse", "--absolute-git-dir"], silent=True, noWarningDialog=True)
+	return output.strip() if success else None
+
+def GetAlternateRepos(gitDir):
+	# The repos whose object stores this repo borrows objects from, as listed in objects/info/alternates
+	path = os.path.join(gitDir, "objects", "info", "alternates")
+	repos = []
+	if os.path.exists(path):
+		with open(path, 'r') as f:
+			for line in f:
+				line = line.strip()
+				if len(line) > 0 and not line.startswith('#'):
+					objects = line if os.path.isabs(line) else os.path.normpath(os.path.join(gitDir, "objects", line))
+					repos.append(os.path.dirname(objects))
+	return repos
+
+def RunMaintenance(repo, interval=DefaultInterval, force=False, alternates=True):
+	# Maintain repo (and, with alternates, the object caches it uses). Returns the list of repos that were maintained.
+	gitDir = GetGitDir(repo)
+	if gitDir is None:
+		print "Skipping maintenance of {0}, which isn't a git repo".format(repo)
+		return []
+	maintained = []
+	if alternates:
+		for alternate in GetAlternateRepos(gitDir):
+			maintained += RunMaintenance(alternate, interval, force, alternates=False)
+	stampFile = os.path.join(gitDir, "flatten", "maintenance")
+	if not force and os.path.exists(stampFile) and time.time() - os.path.getmtime(stampFile) < interval:
+		print "Skipping maintenance of {0}, which was maintained {1:.0f} minutes ago".format(repo, (time.time() - os.path.getmtime(stampFile)) / 60)
+		return maintained
+	lockFile = os.path.join(gitDir, "flatten", "maintenance.lock")
+	if not os.path.exists(os.path.dirname(lockFile)):
+		os.makedirs(os.path.dirname(lockFile))
+	try:
+		lock = os.open(lockFile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+	except OSError:
+		if time.time() - os.path.getmtime(lockFile) < interval:
+			print "Skipping maintenance of {0}, which is already being maintained".format(repo)
+			return maintained
+		# Left behind by a maintenance that died; take it over
+		print "Removing stale maintenance lock {0}".format(lockFile)
+		os.remove(lockFile)
+		lock = os.open(lockFile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+	try:
+		os.write(lock, str(os.getpid()))
+		os.close(lock)
+		start = time.time()
+		print "Maintaining {0}".format(repo)
+		version = GetGitVersion()
+		if version >= (2, 29):
+			RunGitCommand(["-C", repo, "maintenance", "run", "--task=commit-graph", "--task=loose-objects", "--task=incremental-repack"], noWarningDialog=True)
+		else:
+			RunGitCommand(["-C", repo, "commit-graph", "write", "--reachable", "--split"], noWarningDialog=True)
+			RunGitCommand(["-C", repo, "repack", "-d", "--quiet"], noWarningDialog=True)
+		partialClone = len(glob.glob(os.path.join(gitDir, "objects", "pack", "*.promisor"))) > 0
+		if version >= (2, 34) and len(GetAlternateRepos(gitDir)) == 0 and not partialClone:
+			# Bitmaps need every reachable object to be in this repo's packs
+			success, output = RunGitCommand(["-C", repo, "multi-pack-index", "write", "--bitmap"], noWarningDialog=True)
+			if not success:
+				print "Could not write bitmaps for {0}".format(repo)
+		with open(stampFile, 'w') as f:
+			f.write("{0}\n".format(time.time()))
+		print "Maintained {0} in {1:.1f}s".format(repo, time.time() - start)
+		maintained.append(repo)
+	finally:
+		os.remove(lockFile)
+	return maintained
+
+def StartBackgroundMaintenance(repos, interval=DefaultInterval):
+	# Run maintenance in a separate, low priority process that outlives this one, so that the job finishes without waiting for it
+	args = [sys.executable, os.path.splitext(os.path.abspath(__file__))[0] + ".py", "--interval", str(interval)] + [os.path.abspath(repo) for repo in repos]
+	if sys.platform == "win32":
+		# BELOW_NORMAL_PRIORITY_CLASS | CREATE_NEW_PROCESS_GROUP, so it isn't killed with the build step
+		subprocess.Popen(args, creationflags=0x00004000 | 0x00000200, close_fds=True)
+	else:
+		subprocess.Popen(["nice", "-n", "10"] + args, close_fds=True, preexec_fn=os.setpgrp)
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(description='Maintain git working repos and the object caches they share: commit-graphs, incremental repacks and bitmaps.')
+	parser.add_argument('repos', nargs='+', help='The working repos (or object caches) to maintain.')
+	parser.add_argument('--interval', default=DefaultInterval, type=float, help='Skip repos that were maintained less than this many seconds ago.')
+	parser.add_argument('--force', action='store_true', help='Maintain the repos even if they were maintained recently.')
+	args = parser.parse_args()
+	for repo in args.repos:
+		RunMaintenance(repo, args.interval, args.force)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,188 @@
+# Performance profiles for the working repo's index and checkout (see PrepareGitWorkingFolder's performance_profile).
+# The worktree engine runs 'reset --hard', 'reset --soft' and 'status' over a game-sized checkout for every resolve, and each of
+# those reads (and usually rewrites) the whole index and looks at every file. A profile applies the settings that make this cheap:
+#	* core.preloadIndex: compare the index with the working tree using several threads
+#	* core.untrackedCache: remember which directories have no untracked files, so that status doesn't read them again
+#	* core.splitIndex: keep most of the index in a shared file, so that each command only writes the entries it changed
+#	* index.version=4: prefix-compress the paths in the index, which makes it much smaller to read and write
+#	* core.fsmonitor: ask a filesystem monitor which files changed, instead of checking every one of them (git's own
+#	  daemon on Windows and macOS with git 2.36 or later, or the watchman hook if watchman is installed)
+# It can also:
+#	* leave directories that the flatten doesn't need out of the checkout, with a (cone mode) sparse-checkout. The index still
+#	  has every path, so the flattened commits are the same; only the files that are written out and scanned change.
+#	* put the working tree in another folder, e.g. on a tmpfs (or a RAM disk), with core.worktree. The git directory stays
+#	  where it is, so nothing but the checkout is lost when the machine restarts, and the next hard reset writes it out again.
+# The 'default' profile undoes the others. Settings are only changed when they differ, so applying a profile is cheap.
+#
+# Benchmark.py --filesystem times reset and status over a large synthetic tree with and without each profile.
+
+import os
+import sys
+import fnmatch
+from GitFunctions import RunGitCommand, RunGitCommandWithErrorCheck, GetGitVersion
+
+# The settings of each profile, by name. None unsets a setting (leaving git's default), and core.fsmonitor=True uses whichever
+# filesystem monitor is available.
+Profiles = {
+	'default': {'core.preloadIndex': None, 'core.untrackedCache': None, 'core.splitIndex': None, 'index.version': None, 'core.fsmonitor': None},
+	'fast': {'core.preloadIndex': 'true', 'core.untrackedCache': 'true', 'core.splitIndex': 'true', 'index.version': '4', 'core.fsmonitor': True},
+}
+
+# Filesystems that are held in memory (see IsInMemory)
+MemoryFilesystems = ['tmpfs', 'ramfs']
+
+def FindFsMonitor():
+	# The core.fsmonitor setting for the best filesystem monitor available, or None if there isn't one
+	if sys.platform in ("win32", "darwin") and GetGitVersion() >= (2, 36):
+		return 'true'
+	from distutils.spawn import find_executable
+	if find_executable("watchman") is None:
+		return None
+	# The sample hook that git installs in every repo talks to watchman
+	hooks = os.path.abspath(RunGitCommandWithErrorCheck(["rev-parse", "--git-path", "hooks"], "Not in a git repo", silent=True).strip())
+	hook = os.path.join(hooks, "query-watchman")
+	if not os.path.exists(hook):
+		sample = os.path.join(hooks, "fsmonitor-watchman.sample")
+		if not os.path.exists(sample):
+			return None
+		with open(sample, 'r') as f:
+			content = f.read()
+		with open(hook, 'w') as f:
+			f.write(content)
+		os.chmod(hook, 0755)
+	return hook
+
+def IsInMemory(path):
+	# Whether path is on a tmpfs (or other filesystem held in memory), going by the longest mount point that contains it.
+	# Returns None if that can't be told (e.g. on Windows).
+	if not os.path.exists("/proc/mounts"):
+		return None
+	path = os.path.realpath(path)
+	best = ("", None)
+	with open("/proc/mounts", 'r') as f:
+		for line in f:
+			fields = line.split()
+			if len(fields) < 3:
+				continue
+			mountPoint = fields[1].replace("\\040", " ")
+			if (path == mountPoint or path.startswith(mountPoint.rstrip('/') + '/')) and len(mountPoint) >= len(best[0]):
+				best = (mountPoint, fields[2])
+	return best[1] in MemoryFilesystems
+
+class PerformanceProfile(object):
+	def __init__(self, name=None, sparse_exclude=None, worktree_dir=None):
+		# name is one of Profiles, or None to leave the index settings as they are. sparse_exclude is a list of wildcard patterns of the
+		# directories to leave out of the checkout (see IncludedDirectories). worktree_dir is where to put the working tree, e.g. on a tmpfs.
+		self.name = name
+		self.settings = Profiles[name] if name is not None else {}
+		self.sparse_exclude = sparse_exclude or []
+		self.worktree_dir = os.path.abspath(worktree_dir) if worktree_dir is not None else None
+
+	def Apply(self, working_repo):
+		# Apply the profile to working_repo, which is the current directory
+		self.ApplyWorktreeDir(working_repo)
+		self.ApplySettings()
+		self.ApplySparseCheckout()
+
+	def ApplyWorktreeDir(self, working_repo):
+		success, current = RunGitCommand(["config", "--local", "--get", "core.worktree"], silent=True, noWarningDialog=True)
+		current = current.strip() if success else None
+		if self.worktree_dir is None:
+			if current is not None:
+				print "Moving the working tree of {0} back from {1}".format(working_repo, current)
+				RunGitCommandWithErrorCheck(["config", "--local", "--unset", "core.worktree"], "Could not unset core.worktree")
+			return
+		if not os.path.exists(self.worktree_dir):
+			# e.g. a tmpfs that was emptied by a restart; the next hard reset writes the files out again
+			os.makedirs(self.worktree_dir)
+		# So that git also finds the repo from inside the working tree
+		gitFile = os.path.join(self.worktree_dir, ".git")
+		if not os.path.exists(gitFile):
+			with open(gitFile, 'w') as f:
+				f.write("gitdir: {0}\n".format(os.path.join(os.path.abspath(working_repo), ".git")))
+		if current != self.worktree_dir:
+			print "Moving the working tree of {0} to {1}".format(working_repo, self.worktree_dir)
+			RunGitCommandWithErrorCheck(["config", "--local", "core.worktree", self.worktree_dir], "Could not set core.worktree")
+		if IsInMemory(self.worktree_dir) is False:
+			print "WARNING: {0} is not on a tmpfs".format(self.worktree_dir)
+
+	def ApplySettings(self):
+		if len(self.settings) == 0:
+			return
+		# The current settings, in one call (git lower-cases the names)
+		success, output = RunGitCommand(["config", "--local", "--get-regexp", r"^(core\.(preloadindex|untrackedcache|splitindex|fsmonitor)|index\.version)$"], silent=True, noWarningDialog=True)
+		current = dict(line.split(' ', 1) for line in output.split('\n') if ' ' in line) if success else {}
+		changed = []
+		for (name, value) in sorted(self.settings.items()):
+			if value is True and name == 'core.fsmonitor':
+				value = FindFsMonitor()
+				if value is None:
+					print "No filesystem monitor is available (git 2.36 or later on Windows or macOS, or watchman), so every file is checked for changes"
+			if current.get(name.lower()) == value:
+				continue
+			if value is None:
+				RunGitCommand(["config", "--local", "--unset", name], silent=True, noWarningDialog=True)
+			else:
+				RunGitCommandWithErrorCheck(["config", "--local", name, value], "Could not set {0}".format(name))
+			changed.append((name, value))
+		if len(changed) == 0:
+			return
+		print "Applied the '{0}' performance profile: {1}".format(self.name, ", ".join("{0}={1}".format(name, value if value is not None else "(unset)") for (name, value) in changed))
+		# Rewrite the existing index with the new settings now, rather than whenever it is next written
+		index = os.path.abspath(RunGitCommandWithErrorCheck(["rev-parse", "--git-path", "index"], "Not in a git repo", silent=True).strip())
+		if os.path.exists(index):
+			enabled = lambda name: self.settings.get(name) is not None
+			RunGitCommandWithErrorCheck(["update-index", "--index-version={0}".format(self.settings.get('index.version') or 2),
+				"--split-index" if enabled('core.splitIndex') else "--no-split-index",
+				"--untracked-cache" if enabled('core.untrackedCache') else "--no-untracked-cache"], "Could not update the index")
+
+	def ApplySparseCheckout(self, worktree=None):
+		# Set the sparse-checkout of the current repo (or of a worktree of it) to exclude sparse_exclude, or turn it off if there is nothing to exclude
+		location = ["-C", worktree] if worktree is not None else []
+		success, output = RunGitCommand(location + ["config", "--get", "core.sparseCheckout"], silent=True, noWarningDialog=True)
+		enabled = success and output.strip() == "true"
+		if len(self.sparse_exclude) == 0:
+			if enabled:
+				RunGitCommandWithErrorCheck(location + ["sparse-checkout", "disable"], "Could not turn off the sparse-checkout")
+			return
+		version = GetGitVersion()
+		if version < (2, 25):
+			print "WARNING: sparse-checkout needs git 2.25 or later, so every path is checked out"
+			return
+		success, output = RunGitCommand(location + ["ls-tree", "-r", "-d", "-z", "--name-only", "HEAD"], silent=True, noWarningDialog=True)
+		if not success:
+			# Nothing checked out yet
+			return
+		directories = IncludedDirectories([path for path in output.split('\0') if len(path) > 0], self.sparse_exclude)
+		if enabled:
+			success, output = RunGitCommand(location + ["sparse-checkout", "list"], silent=True, noWarningDialog=True, mergeStderr=False)
+			if success and sorted(line for line in output.split('\n') if len(line) > 0) == directories:
+				return
+		print "Leaving {0} out of the checkout".format(", ".join(self.sparse_exclude))
+		if version < (2, 35):
+			RunGitCommandWithErrorCheck(location + ["sparse-checkout", "init", "--cone"], "Could not set the sparse-checkout")
+		RunGitCommandWithErrorCheck(location + ["sparse-checkout", "set", "--stdin"] + (["--cone"] if version >= (2, 35) else []), "Could not set the sparse-checkout", input=''.join(directory + '\n' for directory in directories))
+
+def IncludedDirectories(directories, excluded):
+	# A cone mode sparse-checkout lists the directories to include, which is much quicker for git to match than a list of exclusions.
+	# Returns the directories (out of all of those in the tree) that include everything but the excluded directories (wildcard
+	# patterns of directory paths, e.g. 'Content/Movies' or 'Tools*'): the siblings of each excluded directory and of its parents.
+	# Files directly in those parents are always included.
+	patterns = [pattern.strip('/').split('/') for pattern in excluded]
+	def IsExcluded(parts):
+		return any(len(pattern) == len(parts) and all(fnmatch.fnmatchcase(part, component) for (part, component) in zip(parts, pattern)) for pattern in patterns)
+	def IsParentOfExcluded(parts):
+		return any(len(pattern) > len(parts) and all(fnmatch.fnmatchcase(part, component) for (part, component) in zip(parts, pattern)) for pattern in patterns)
+	included = []
+	for directory in directories:
+		parts = directory.split('/')
+		# Only the children of the top level and of the parents of excluded directories are listed
+		if (len(parts) == 1 or IsParentOfExcluded(parts[:-1])) and not IsExcluded(parts) and not IsParentOfExcluded(parts):
+			included.append(directory)
+	return sorted(included)
+
+def MakeProfile(name=None, sparse_exclude=None, worktree_dir=None):
+	# The profile for the command line options, or None if none of them were given
+	if name is None and not sparse_exclude and worktree_dir is None:
+		return None
+	return PerformanceProfile(name, sparse_exclude, worktree_dir)
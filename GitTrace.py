@@ -0,0 +1,138 @@
+# Tracing of the git commands run by GitFunctions.RunGitCommand, to find out where the time of a slow job goes.
+# Once StartTrace has been called, each invocation is recorded with its command, the phase of the job it was run in
+# (see SetPhase), its duration, exit status and output size. Records can be written to a JSON-lines trace file as they
+# happen, and summarised per command (counts and latency percentiles) and per phase at the end of the job, optionally
+# as TeamCity service messages so that the timings are charted per build. The time spent waiting for the locks that let
+# several jobs share a working repo (see RepoLock.py) is recorded too, as is how much of the time spent on the network
+# overlapped local work (see NetworkPhase.py).
+
+import os
+import json
+import math
+import time
+import GitFunctions
+
+class GitTrace(object):
+	def __init__(self, path=None):
+		self.path = path
+		self.phase = None
+		self.records = []
+		# (lock name, seconds waited) for each lock acquired
+		self.lockWaits = []
+		# (total, wall, waited) for each NetworkPhase, in seconds
+		self.network = []
+		if path is not None and os.path.exists(path):
+			os.remove(path)
+
+	def Record(self, args, duration, status, output, batched=False, outputBytes=None):
+		# args excludes the git executable. status is the exit code, or None if the command wasn't waited for.
+		# For output that was streamed rather than kept, output is None and outputBytes is its size.
+		if outputBytes is None:
+			outputBytes = len(output) if output is not None else 0
+		record = {'time': round(time.time() - duration, 3), 'pid': os.getpid(), 'phase': self.phase, 'command': CommandName(args), 'args': args,
+			'duration': round(duration, 4), 'status': status, 'bytes': outputBytes, 'batch': batched}
+		self.records.append(record)
+		if self.path is not None:
+			# One write per record, so that the records of pool processes (see FlattenBranches) don't interleave
+			with open(self.path, 'a') as f:
+				f.write(json.dumps(record, sort_keys=True) + '\n')
+
+	def RecordLockWait(self, name, duration):
+		self.lockWaits.append((name, duration))
+
+	def RecordNetwork(self, total, wall, waited):
+		self.network.append((total, wall, waited))
+
+	def LockWaitTotals(self):
+		totals = {}
+		for (name, duration) in self.lockWaits:
+			totals[name] = totals.get(name, 0.0) + duration
+		return totals
+
+	def Summary(self):
+		# Returns ({command: stats}, {phase: stats}), where stats has count, failures, bytes, total, p50, p90, p99 and max (durations in seconds)
+		commands = {}
+		phases = {}
+		for record in self.records:
+			commands.setdefault(record['command'], []).append(record)
+			phases.setdefault(record['phase'] or "(none)", []).append(record)
+		return (dict((name, Statistics(records)) for (name, records) in commands.items()), dict((name, Statistics(records)) for (name, records) in phases.items()))
+
+	def PrintSummary(self):
+		(commands, phases) = self.Summary()
+		print "Git commands:"
+		print "\t{0:<20} {1:>6} {2:>6} {3:>6} {4:>9} {5:>8} {6:>8} {7:>8} {8:>8} {9:>12}".format("command", "count", "batch", "failed", "total", "p50", "p90", "p99", "max", "output")
+		for name in sorted(commands, key=lambda name: -commands[name]['total']):
+			stats = commands[name]
+			print "\t{0:<20} {1:>6} {2:>6} {3:>6} {4:>8.2f}s {5:>7.3f}s {6:>7.3f}s {7:>7.3f}s {8:>7.3f}s {9:>12}".format(name, stats['count'], stats['batched'], stats['failures'],
+				stats['total'], stats['p50'], stats['p90'], stats['p99'], stats['max'], stats['bytes'])
+		print "Phases:"
+		for name in sorted(phases, key=lambda name: -phases[name]['total']):
+			print "\t{0:<20} {1:>6} git commands {2:>8.2f}s".format(name, phases[name]['count'], phases[name]['total'])
+		if len(self.lockWaits) > 0:
+			print "Lock waits:"
+			totals = self.LockWaitTotals()
+			for name in sorted(totals, key=lambda name: -totals[name]):
+				print "\t{0:<40} {1:>8.2f}s".format(name, totals[name])
+		if len(self.network) > 0:
+			(total, wall, waited) = [sum(values) for values in zip(*self.network)]
+			print "Network: {0:.2f}s in all, {1:.2f}s of wall time, {2:.2f}s overlapped local work".format(total, wall, wall - waited)
+
+	def PrintTeamCityStatistics(self, prefix="flatten"):
+		# Service messages that TeamCity turns into build statistics, which can be charted across builds
+		(commands, phases) = self.Summary()
+		for name in sorted(commands):
+			stats = commands[name]
+			for key in ['count', 'batched', 'failures']:
+				PrintBuildStatistic("{0}.git.{1}.{2}".format(prefix, name, key), stats[key])
+			for key in ['total', 'p50', 'p90', 'p99', 'max']:
+				PrintBuildStatistic("{0}.git.{1}.{2}Ms".format(prefix, name, key), int(stats[key] * 1000))
+		for name in sorted(phases):
+			PrintBuildStatistic("{0}.phase.{1}.totalMs".format(prefix, name), int(phases[name]['total'] * 1000))
+		PrintBuildStatistic("{0}.git.invocations".format(prefix), len(self.records))
+		if len(self.lockWaits) > 0:
+			totals = self.LockWaitTotals()
+			for name in sorted(totals):
+				PrintBuildStatistic("{0}.lock.{1}.waitMs".format(prefix, name), int(totals[name] * 1000))
+			PrintBuildStatistic("{0}.lock.waitMs".format(prefix), int(sum(totals.values()) * 1000))
+		if len(self.network) > 0:
+			(total, wall, waited) = [sum(values) for values in zip(*self.network)]
+			PrintBuildStatistic("{0}.network.totalMs".format(prefix), int(total * 1000))
+			PrintBuildStatistic("{0}.network.wallMs".format(prefix), int(wall * 1000))
+			PrintBuildStatistic("{0}.network.overlapMs".format(prefix), int((wall - waited) * 1000))
+			PrintBuildStatistic("{0}.network.waitMs".format(prefix), int(waited * 1000))
+
+def CommandName(args):
+	# The git command, after any options to git itself (e.g. '-C <repo>')
+	i = 0
+	while i < len(args) and args[i].startswith('-'):
+		i += 2 if args[i] in ("-C", "-c") else 1
+	return args[i] if i < len(args) else "git"
+
+def Statistics(records):
+	durations = sorted(record['duration'] for record in records)
+	return {'count': len(records), 'failures': len([record for record in records if record['status'] not in (0, None)]),
+		'batched': len([record for record in records if record.get('batch')]),
+		'bytes': sum(record['bytes'] for record in records), 'total': sum(durations),
+		'p50': Percentile(durations, 50), 'p90': Percentile(durations, 90), 'p99': Percentile(durations, 99), 'max': durations[-1]}
+
+def Percentile(values, percent):
+	# Nearest-rank percentile of a sorted, non-empty list
+	rank = int(math.ceil(percent / 100.0 * len(values)))
+	return values[min(max(rank, 1), len(values)) - 1]
+
+def EscapeTeamCityValue(value):
+	return ''.join("|" + c if c in "|'[]" else c for c in str(value)).replace('\n', '|n').replace('\r', '|r')
+
+def PrintBuildStatistic(key, value):
+	print "##teamcity[buildStatisticValue key='{0}' value='{1}']".format(EscapeTeamCityValue(key), EscapeTeamCityValue(value))
+
+def StartTrace(path=None):
+	# Start recording every git command, to path (a JSON-lines file) if given as well as in memory
+	GitFunctions.Trace = GitTrace(os.path.abspath(path) if path is not None else None)
+	return GitFunctions.Trace
+
+def SetPhase(phase):
+	# The phase of the job (e.g. "prepare", "replay", "publish") that subsequent git commands belong to
+	if GitFunctions.Trace is not None:
+		GitFunctions.Trace.phase = phase
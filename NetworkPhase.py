@@ -0,0 +1,133 @@
+# The network steps of a flatten (fetching from both remotes, listing the teamcity heads, pushing), run in background threads
+# so that they overlap with each other and with local work, rather than one after the other before and after it.
+# Over a high-latency link to the git server these steps take longer than replaying a short flatten, and each one is mostly
+# spent waiting for the server, so running them at the same time costs little more than the slowest of them.
+#
+# FlattenGit (with --concurrent-network) starts both fetches and the ls-remote together in PrepareGitWorkingFolder, and
+# starts replaying as soon as the source revisions are in the working repo: from the flattened head that the last run
+# fetched, which is nearly always still the head, as only FlattenGit pushes to it and a branch is only flattened by one job
+# at a time (see RepoLock.py). Before publishing, it waits for the ls-remote, and if the head has moved on, replays again
+# (see FlattenGit.ConfirmRemoteHead). The patch-ids of the new commits are indexed while they are being pushed.
+#
+# Each step's output is printed when it is waited for, so that it isn't mixed up with the output of the local work.
+# PrintSummary reports how long the network steps took, and how much of that time overlapped local work rather than
+# keeping the job waiting.
+
+import os
+import time
+import threading
+import GitFunctions
+from GitFunctions import RunGitCommand
+
+class NetworkTask(object):
+	# One git command, run in a thread
+	def __init__(self, name, args, errorstring):
+		self.name = name
+		# The working repo is fixed when the step starts, in case the current directory changes while it runs
+		self.args = ["-C", os.getcwd()] + args
+		self.errorstring = errorstring
+		self.success = None
+		self.output = None
+		self.start = None
+		self.end = None
+		self.reported = False
+		self.thread = threading.Thread(target=self.Run, name=name)
+		# Don't keep the process alive for a step that nobody is going to wait for (e.g. after an exception)
+		self.thread.daemon = True
+
+	def Run(self):
+		self.start = time.time()
+		try:
+			(self.success, self.output) = RunGitCommand(self.args, silent=True, noWarningDialog=True)
+		except Exception as e:
+			(self.success, self.output) = (False, str(e))
+		self.end = time.time()
+
+	def Done(self):
+		return not self.thread.is_alive()
+
+class NetworkPhase(object):
+	def __init__(self):
+		self.tasks = {}
+		# The names of the steps, in the order they were started
+		self.order = []
+		# (start, end) of each time the job waited for a step
+		self.waits = []
+		self.finished = False
+
+	def Start(self, name, args, errorstring):
+		task = NetworkTask(name, args, errorstring)
+		self.tasks[name] = task
+		self.order.append(name)
+		task.thread.start()
+		return task
+
+	def Has(self, name):
+		return name in self.tasks
+
+	def Done(self, name=None):
+		# Whether the step (or, without a name, every step) has finished
+		return all(self.tasks[task].Done() for task in ([name] if name is not None else self.order))
+
+	def Wait(self, name):
+		# Wait for a step to finish, and return its output. Raises an exception if it failed.
+		task = self.tasks[name]
+		if not task.Done():
+			start = time.time()
+			task.thread.join()
+			self.waits.append((start, time.time()))
+		if not task.reported:
+			task.reported = True
+			print ("...->" + "\t" * 9) + "git " + " ".join(task.args[2:]) + " ({0:.1f}s, in the background)".format(task.end - task.start)
+			if len(task.output.strip()) > 0:
+				print task.output.rstrip('\n')
+		if not task.success:
+			raise Exception(task.errorstring)
+		return task.output
+
+	def WaitAll(self):
+		for name in self.order:
+			self.Wait(name)
+
+	def Finish(self):
+		# Wait for anything still running (without raising if it failed, e.g. after an earlier exception), and print the summary once
+		if self.finished:
+			return
+		self.finished = True
+		for name in self.order:
+			try:
+				self.Wait(name)
+			except Exception:
+				pass
+		self.PrintSummary()
+
+	def Overlap(self):
+		# Returns (total, wall, waited): the seconds taken by all of the steps, the wall time during which any step was running,
+		# and how much of that time the job spent waiting for them. The rest of the wall time overlapped local work.
+		intervals = [(self.tasks[name].start, self.tasks[name].end) for name in self.order if self.tasks[name].end is not None]
+		total = sum(end - start for (start, end) in intervals)
+		return (total, UnionLength(intervals), UnionLength(self.waits))
+
+	def PrintSummary(self):
+		if len(self.order) == 0:
+			return
+		(total, wall, waited) = self.Overlap()
+		print "Network: {0} steps took {1:.1f}s ({2:.1f}s of wall time), of which {3:.1f}s overlapped local work and {4:.1f}s was spent waiting".format(len(self.order), total, wall, wall - waited, waited)
+		for name in self.order:
+			task = self.tasks[name]
+			if task.end is not None:
+				print "\t{0:<20} {1:>8.1f}s{2}".format(name, task.end - task.start, "" if task.success else "  FAILED")
+		if GitFunctions.Trace is not None:
+			GitFunctions.Trace.RecordNetwork(total, wall, waited)
+
+def UnionLength(intervals):
+	# The length of the union of a list of (start, end) intervals
+	length = 0.0
+	reached = None
+	for (start, end) in sorted(intervals):
+		if reached is not None and start < reached:
+			start = reached
+		if end > start:
+			length += end - start
+		reached = max(reached, end) if reached is not None else end
+	return length
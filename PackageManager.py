@@ -1,10 +1,43 @@
+# Only the modules needed to import an already installed package are imported up front; the rest are imported when installing
 import importlib
-import tempfile
-import subprocess
-import platform
+import sys
 import os
 
+def UserCacheDirectory():
+	# A directory of the user's, which (unlike a shared /tmp) won't hold another user's file that can't be written to:
+	# TEMP on Windows, and the user's cache directory elsewhere (TEMP and TMPDIR are often not set on Linux, e.g. under cron)
+	if sys.platform == "win32" and os.environ.get('TEMP'):
+		return os.environ['TEMP']
+	return os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache")
+
+# Packages that have been found (or installed) are recorded in this stamp file, for each python installation, so that later
+# runs can just import them, without importing pip or reloading site. A package that can no longer be imported is checked again.
+StampFile = os.path.join(UserCacheDirectory(), "PackageManager-stamp.txt")
+
+def _stampKey(package):
+	return "{0} {1} {2}".format(sys.executable, sys.version.split()[0], package)
+
+def isStamped(package):
+	if not os.path.exists(StampFile):
+		return False
+	with open(StampFile, 'r') as f:
+		return _stampKey(package) in [line.rstrip('\n') for line in f]
+
+def stamp(package):
+	if not isStamped(package):
+		try:
+			if not os.path.exists(os.path.dirname(StampFile)):
+				os.makedirs(os.path.dirname(StampFile))
+			with open(StampFile, 'a') as f:
+				f.write(_stampKey(package) + '\n')
+		except (IOError, OSError):
+			# The package is just checked again next time
+			pass
+
 def ensurePip(silent = False):
+	import tempfile
+	import subprocess
+	import platform
 	try:
 		pip = importlib.import_module('pip')
 		# If pip 10.x.x or greater is installed, the string test is insufficient
@@ -42,16 +75,27 @@ def ensurePip(silent = False):
 			print "get-pip.py returned {0}. Pip may not have been installed successfully.".format(result)
 	
 def ensurePackage(package, installPath = None, silent = False):
+	if isStamped(package):
+		# Checked on an earlier run, so skip all of the pip and site work
+		try:
+			globals()[package] = importlib.import_module(package)
+			return
+		except ImportError:
+			pass
+	installed = False
 	try:
 		importlib.import_module(package)
 	except ImportError:
 		ensurePip(silent)
 		import pip
 		pip.main(['install', installPath if installPath else package] + (['--quiet'] if silent else []))
+		installed = True
 	finally:
-		# Reload the site module to make sure the site-packages area is on the path, 
-		#  otherwise importing the freshly installed module may fail (if it's the first of its kind)
-		#   https://stackoverflow.com/questions/25384922/how-to-refresh-sys-path
-		import site
-		reload(site)
+		if installed:
+			# Reload the site module to make sure the site-packages area is on the path, 
+			#  otherwise importing the freshly installed module may fail (if it's the first of its kind)
+			#   https://stackoverflow.com/questions/25384922/how-to-refresh-sys-path
+			import site
+			reload(site)
 		globals()[package] = importlib.import_module(package)
+	stamp(package)
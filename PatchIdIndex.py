@@ -0,0 +1,134 @@
+# A persistent index of the patch-ids of the changes that a flattened branch already contains.
+# A revision whose change already came in through another merged branch can't be cherry-picked: the cherry-pick comes out
+# empty, and has to be aborted and the working tree reset. Knowing the patch-id (git patch-id --stable, a hash of the diff
+# that ignores line numbers and whitespace) of each change on the destination branch, FlattenGit skips such revisions up
+# front, without trying them.
+#
+# A change that was reverted is no longer there, so a revision that applies it again must not be skipped. The reversed diff of a
+# revert has the patch-id of the change that it reverts, so the commits are gone through in order, and a commit whose reversed
+# diff matches a change that is there takes it away again (see Applied).
+#
+# There is one index per destination branch, in the working repo's git directory (shared by all of its worktrees). It is an
+# append-only text file, oldest commit first, with a "<patch-id> <commit>" line per flattened commit, a "revert <patch-id> <commit>"
+# line for each commit that reverts one of those changes, and a "tip <commit>" line recording the branch head it is up to date
+# with. Update only indexes the commits since the last tip, so it stays cheap as the branch grows; if the branch was force-pushed
+# (the tip is no longer its ancestor), or the index was written before reverts were recorded, the index is rebuilt.
+
+import os
+import re
+from GitFunctions import RunGitCommand, RunGitPipeline, GetGitCommonDir, IsPartialClone, PrefetchChangedBlobs
+
+# How many of the most recent commits of a branch to index when there is no index yet. Changes are duplicated by merging
+# branches that were cut recently, so indexing the whole history of a long-lived branch would cost more than it saves.
+HistoryLimit = 1000
+
+# The format of the index file, which is rebuilt if it has an older one
+Version = "2"
+
+def OrderedPatchIds(revisionArgs, reverse=False):
+	# Returns [(commit, patch-id)] for the single-parent commits selected by revisionArgs (rev-list arguments), in the order git log
+	# lists them. Commits with an empty diff have no patch-id, so aren't included. With reverse, the patch-ids are of the reversed
+	# diffs, which are the patch-ids of the changes that the commits revert. The paths are listed without the a/ and b/ prefixes,
+	# which -R would swap.
+	output = RunGitPipeline(["log", "-p", "--no-merges", "--no-color", "--no-ext-diff", "--no-prefix", "--format=commit %H"] + (["-R"] if reverse else []) + revisionArgs, ["patch-id", "--stable"])
+	patchIds = []
+	for line in output.split('\n'):
+		fields = line.split()
+		if len(fields) == 2:
+			patchIds.append((fields[1], fields[0]))
+	return patchIds
+
+def PatchIds(revisionArgs, reverse=False):
+	# As OrderedPatchIds, as {commit: patch-id}
+	return dict(OrderedPatchIds(revisionArgs, reverse))
+
+def Applied(present, revision, patchIds, revertedIds):
+	# Update present (a set of patch-ids) for revision having been applied, given the patch-ids of the revisions (see PatchIds) and of
+	# their reversed diffs: a revert takes away the change that it reverts, and any other change is added
+	present.discard(revertedIds.get(revision))
+	if revision in patchIds:
+		present.add(patchIds[revision])
+
+class PatchIdIndex(object):
+	def __init__(self, dest_branch, path=None):
+		if path is None:
+			path = os.path.join(GetGitCommonDir(), "flatten", "patch-ids-" + re.sub(r"[^A-Za-z0-9._-]", "_", dest_branch))
+		self.dest_branch = dest_branch
+		self.path = path
+		self.patchIds = set()
+		self.tip = None
+		self.Load()
+
+	def Load(self):
+		self.patchIds = set()
+		self.tip = None
+		if not os.path.exists(self.path):
+			return
+		version = None
+		with open(self.path, 'r') as f:
+			for line in f:
+				fields = line.split()
+				if len(fields) == 3 and fields[0] == "revert":
+					self.patchIds.discard(fields[1])
+				elif len(fields) != 2:
+					continue
+				elif fields[0] == "version":
+					version = fields[1]
+				elif fields[0] == "tip":
+					self.tip = fields[1]
+				else:
+					self.patchIds.add(fields[0])
+		if version != Version:
+			# Written before reverts were recorded, so it may have changes that were reverted since
+			self.patchIds = set()
+			self.tip = None
+
+	def Update(self, head):
+		# Bring the index up to date with head, the current commit of the destination branch
+		if head is None or head == self.tip:
+			return
+		rebuild = self.tip is None
+		if not rebuild:
+			(code, output) = RunGitCommand(["merge-base", "--is-ancestor", self.tip, head], returnerrorcode=True, silent=True)
+			rebuild = code != 0
+		if rebuild:
+			revisionArgs = ["--max-count={0}".format(HistoryLimit), head]
+		else:
+			revisionArgs = ["{0}..{1}".format(self.tip, head)]
+		if IsPartialClone("teamcity"):
+			# Reading the diffs needs the files, which would otherwise be downloaded one at a time
+			success, output = RunGitCommand(["rev-list", "--no-merges"] + revisionArgs, silent=True)
+			if success:
+				PrefetchChangedBlobs(output.split(), "teamcity")
+		# Oldest first, so that reverts come after the changes that they revert
+		patchIds = OrderedPatchIds(["--reverse"] + revisionArgs)
+		revertedIds = PatchIds(revisionArgs, reverse=True)
+		present = set() if rebuild else set(self.patchIds)
+		lines = "version {0}\n".format(Version) if rebuild else ""
+		for (commit, patchId) in patchIds:
+			if revertedIds.get(commit) in present:
+				lines += "revert {0} {1}\n".format(revertedIds[commit], commit)
+			Applied(present, commit, {commit: patchId}, revertedIds)
+			lines += "{0} {1}\n".format(patchId, commit)
+		lines += "tip {0}\n".format(head)
+		directory = os.path.dirname(self.path)
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		if rebuild:
+			print "Indexing the changes of (up to) the last {0} commits of {1}".format(HistoryLimit, self.dest_branch)
+			# Write to a temporary file first, so that a crash never leaves a half-written index
+			temp = self.path + ".tmp"
+			with open(temp, 'w') as f:
+				f.write(lines)
+			if os.path.exists(self.path):
+				os.remove(self.path)
+			os.rename(temp, self.path)
+		else:
+			# One write per update, so that concurrent updates don't interleave their lines
+			with open(self.path, 'a') as f:
+				f.write(lines)
+		self.patchIds = present
+		self.tip = head
+
+	def Contains(self, patchId):
+		return patchId in self.patchIds
@@ -0,0 +1,60 @@
+# A cache of the flattened commits that replaying a source revision onto a flattened parent produced, so that an identical
+# replay (on another branch that shares the history, or a rerun of one that failed to push) reuses the commit instead of
+# cherry-picking or resolving it again.
+#
+# The cache is keyed by (operation, source revision, flattened parent), where the operation is 'pick' or 'resolve' (see
+# FlattenGit), and also remembers replays that made no commit. It is an append-only text file in the working repo's git
+# directory (shared by all of its worktrees and branches), with one "<operation> <source> <parent> <result>" line per
+# replay; the result is '-' if no commit was made. Later lines take precedence over earlier ones.
+
+import os
+from GitFunctions import RunGitCommand, GetGitCommonDir
+
+NoCommit = '-'
+
+class ReplayCache(object):
+	def __init__(self, path=None):
+		if path is None:
+			path = os.path.join(GetGitCommonDir(), "flatten", "replays")
+		self.path = path
+		self.results = {}
+		self.hits = 0
+		self.misses = 0
+		self.Load()
+
+	def Load(self):
+		self.results = {}
+		if not os.path.exists(self.path):
+			return
+		with open(self.path, 'r') as f:
+			for line in f:
+				fields = line.split()
+				if len(fields) == 4:
+					self.results[(fields[0], fields[1], fields[2])] = fields[3]
+
+	def Lookup(self, operation, source, parent):
+		# Returns the flattened commit of an earlier identical replay, NoCommit if it made no commit, or None if it isn't known
+		# (or its commit is no longer in the repo)
+		result = self.results.get((operation, source, parent))
+		if result is not None and result != NoCommit:
+			success, output = RunGitCommand(["cat-file", "-e", result + "^{commit}"], silent=True, noWarningDialog=True)
+			if not success:
+				result = None
+		if result is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+		return result
+
+	def Record(self, operation, source, parent, result):
+		# result is the flattened commit made, or None if none was
+		result = result if result is not None else NoCommit
+		if self.results.get((operation, source, parent)) == result:
+			return
+		directory = os.path.dirname(self.path)
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		# One write per line, so that concurrent flattens don't interleave their lines
+		with open(self.path, 'a') as f:
+			f.write("{0} {1} {2} {3}\n".format(operation, source, parent, result))
+		self.results[(operation, source, parent)] = result
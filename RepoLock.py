@@ -0,0 +1,159 @@
+# Advisory locks, so that several flatten jobs can share an agent (and its working repos) without corrupting each other's state.
+# There are two kinds of lock (see FlattenGit):
+#	* the working repo lock, for anything that changes the state shared by every job using the repo: cloning, fetching,
+#	  configuring, pushing, and (for the worktree engine) its checked out files and index
+#	* a lock per destination branch, held for the whole of a flatten, so that two jobs never flatten the same branch at once
+#	  (which would race on its checkpoint and push), while jobs on different branches can run concurrently
+#
+# A lock is a file created exclusively, which records the process holding it. A job waits (up to a timeout) for a lock that
+# is held, and takes over a lock whose holder has died: a process on this machine that no longer exists, or a lock older than
+# StaleAfter. The locks are kept next to the working repo (in "<working-repo>-locks"), as they are needed before it is cloned.
+# The time spent waiting is printed, and recorded in the git trace (see GitTrace.py) to help size agent concurrency.
+
+import os
+import re
+import sys
+import json
+import time
+import socket
+import GitFunctions
+
+# How long to wait for a lock by default, in seconds
+DefaultTimeout = 60 * 60
+# A lock this old is taken over even if its holder can't be shown to have died (e.g. it is on another machine)
+StaleAfter = 12 * 60 * 60
+
+class LockTimeout(Exception):
+	pass
+
+def ProcessExists(pid):
+	if sys.platform == "win32":
+		import ctypes
+		# PROCESS_QUERY_LIMITED_INFORMATION; a process that has exited has an exit code other than STILL_ACTIVE (259)
+		handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)
+		if not handle:
+			return False
+		exitCode = ctypes.c_ulong()
+		ctypes.windll.kernel32.GetExitCodeProcess(handle, ctypes.byref(exitCode))
+		ctypes.windll.kernel32.CloseHandle(handle)
+		return exitCode.value == 259
+	try:
+		os.kill(pid, 0)
+	except OSError as e:
+		# EPERM means it exists, but belongs to someone else
+		return e.errno == 1
+	return True
+
+def LockDirectory(working_repo):
+	return os.path.abspath(working_repo) + "-locks"
+
+class RepoLock(object):
+	# The locks held by this process, by path, with how many times each has been acquired (so that they can be nested)
+	held = {}
+
+	def __init__(self, working_repo, name="repo", timeout=DefaultTimeout):
+		self.name = name
+		self.path = os.path.join(LockDirectory(working_repo), re.sub(r"[^A-Za-z0-9._-]", "_", name) + ".lock")
+		self.timeout = timeout
+		self.waited = 0.0
+		# How many times this object has acquired the lock (and not released it)
+		self.count = 0
+
+	def Holder(self):
+		# The {'pid', 'host', 'time', 'command'} of the current holder, or None if the lock is free or unreadable
+		try:
+			with open(self.path, 'r') as f:
+				return json.load(f)
+		except (IOError, OSError, ValueError):
+			return None
+
+	def IsStale(self, holder):
+		try:
+			age = time.time() - os.path.getmtime(self.path)
+		except OSError:
+			# Released while we were looking
+			return False
+		if holder is None:
+			# Being written by the process that has just created it, unless it was left empty by one that died at that moment
+			return age > 60
+		if holder.get('host') == socket.gethostname() and not ProcessExists(holder.get('pid', 0)):
+			return True
+		return age > StaleAfter
+
+	def Acquire(self):
+		if RepoLock.held.get(self.path, 0) > 0:
+			RepoLock.held[self.path] += 1
+			self.count += 1
+			return
+		directory = os.path.dirname(self.path)
+		if not os.path.exists(directory):
+			try:
+				os.makedirs(directory)
+			except OSError:
+				# Created by another job at the same time
+				pass
+		start = time.time()
+		delay = 0.1
+		reported = False
+		while True:
+			try:
+				lock = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+				break
+			except OSError:
+				pass
+			holder = self.Holder()
+			if self.IsStale(holder):
+				# Unless another waiter has already taken it over
+				if self.Holder() == holder:
+					print "Taking over the {0} lock from {1}, which is no longer running".format(self.name, DescribeHolder(holder))
+					try:
+						os.remove(self.path)
+					except OSError:
+						pass
+				continue
+			if time.time() - start > self.timeout:
+				raise LockTimeout("Timed out after {0:.0f}s waiting for the {1} lock, held by {2}".format(time.time() - start, self.name, DescribeHolder(holder)))
+			if not reported:
+				print "Waiting for the {0} lock, held by {1}".format(self.name, DescribeHolder(holder))
+				reported = True
+			time.sleep(delay)
+			delay = min(delay * 2, 5.0)
+		os.write(lock, json.dumps({'pid': os.getpid(), 'host': socket.gethostname(), 'time': time.time(), 'command': " ".join(sys.argv)}))
+		os.close(lock)
+		RepoLock.held[self.path] = 1
+		self.count += 1
+		self.waited = time.time() - start
+		if reported:
+			print "Waited {0:.1f}s for the {1} lock".format(self.waited, self.name)
+		if GitFunctions.Trace is not None:
+			GitFunctions.Trace.RecordLockWait(self.name, self.waited)
+
+	def Release(self):
+		if self.count == 0:
+			return
+		self.count -= 1
+		count = RepoLock.held.get(self.path, 0)
+		if count > 1:
+			RepoLock.held[self.path] = count - 1
+			return
+		if count == 1:
+			del RepoLock.held[self.path]
+			holder = self.Holder()
+			# Don't remove a lock that has been taken over from us
+			if holder is None or holder.get('pid') == os.getpid():
+				try:
+					os.remove(self.path)
+				except OSError:
+					pass
+
+	def __enter__(self):
+		self.Acquire()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.Release()
+
+def DescribeHolder(holder):
+	if holder is None:
+		return "an unknown process"
+	return "process {0} on {1} (since {2})".format(holder.get('pid'), holder.get('host'), time.strftime("%H:%M:%S", time.localtime(holder.get('time', 0))))